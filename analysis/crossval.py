@@ -0,0 +1,222 @@
+'''
+Cross-validation of the decision tree with folds that respect the time structure of fMRI.
+
+build_model() scores one random 80/20 split, which puts neighbouring (autocorrelated) timepoints in both
+train and test and gives one noisy number. Here the model is scored over several folds instead:
+    - runs: leave-one-run-out, every run is the test set once (needs X from 2 or more runs, see stack_jobs())
+    - blocked: n_folds contiguous blocks of timepoints, the `gap` timepoints on both sides of the test block
+      are dropped from training so no training row is within the hemodynamic response of a test row
+
+Folds are fitted in parallel with joblib (n_jobs workers). X is passed as a memory map, so every worker reads
+the same file on disk instead of receiving its own pickled copy (an in-memory X is dumped to one temporary
+memory map for all folds by joblib). Each fold reads its own rows from that memory map in the worker: contiguous rows
+(a test block, one run, the training rows before or after a block) are a slice of it, not a copy (row_block), and the
+test rows are predicted chunk by chunk.
+
+Outputs (data/outputs):
+    - cv_metrics.csv: accuracy, precision, recall per fold (as in evaluation_metrics.csv) plus the mean and std over folds
+    - cv_predictions.npz: out-of-fold y_true, y_pred as label codes (as in predictions.npz, see pipeline/store.py)
+      with the row of X and the fold of every prediction
+
+Run main.py --cv blocked to execute this script,
+or main.py crossval --job SUBJECT:TASK:RUN --job ... for run-wise cross-validation over several runs.
+'''
+import os
+import logging
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from pipeline.context import PipelineContext
+from pipeline.matrix import row_block, chunk_size, create_matrix, iter_rows, open_matrix
+from analysis.model import MODEL_PARAMS, make_classifier
+from analysis.evaluate import compute_metrics
+from etl.parcellate import check_shared_columns, warn_fitted_regions
+from pipeline.store import CV_PREDICTIONS_FILE, save_predictions, record_stage
+from pipeline.precision import get_dtype
+
+SCHEMES = ("runs", "blocked")
+CV_PARAMS = dict(
+    scheme="blocked",
+    n_folds=5,
+    gap=5,          # timepoints left out of training on both sides of a test block (5 TRs = 10 s at TR 2 s)
+)
+
+
+def run_folds(runs):
+    """
+    Leave-one-run-out folds: list of (train_idx, test_idx), one per run.
+    """
+    runs = np.asarray(runs)
+    unique_runs = np.unique(runs)
+    if len(unique_runs) < 2:
+        raise ValueError("Run-wise cross-validation needs X from at least 2 runs (see stack_jobs)")
+    return [(np.flatnonzero(runs != run), np.flatnonzero(runs == run)) for run in unique_runs]
+
+
+def blocked_folds(timepoints, runs=None, n_folds=5, gap=0):
+    """
+    Contiguous-block folds: rows are ordered by (run, timepoint) and cut into n_folds blocks.
+    Training rows of the same run within `gap` timepoints of a test row are left out.
+    """
+    timepoints = np.asarray(timepoints)
+    runs = np.zeros(len(timepoints), dtype=int) if runs is None else np.asarray(runs)
+    if n_folds < 2 or n_folds > len(timepoints):
+        raise ValueError(f"n_folds must be between 2 and the number of rows ({len(timepoints)}), got {n_folds}")
+    order = np.lexsort((timepoints, runs))
+
+    folds = []
+    for test_idx in np.array_split(order, n_folds):
+        test_idx = np.sort(test_idx)
+        train = np.ones(len(timepoints), dtype=bool)
+        train[test_idx] = False
+        # Gap: for every run in the test block, drop training rows within gap timepoints of the block
+        for run in np.unique(runs[test_idx]):
+            in_run = runs[test_idx] == run
+            lo, hi = timepoints[test_idx][in_run].min() - gap, timepoints[test_idx][in_run].max() + gap
+            train &= ~((runs == run) & (timepoints >= lo) & (timepoints <= hi))
+        folds.append((np.flatnonzero(train), test_idx))
+    return folds
+
+
+def make_folds(scheme, timepoints, runs, n_folds=CV_PARAMS["n_folds"], gap=CV_PARAMS["gap"]):
+    if scheme == "runs":
+        return run_folds(runs)
+    if scheme == "blocked":
+        return blocked_folds(timepoints, runs, n_folds=n_folds, gap=gap)
+    raise ValueError(f"Unknown cross-validation scheme '{scheme}', expected one of {SCHEMES}")
+
+
+def _fit_fold(X, y, train_idx, test_idx, reduce, n_features):
+    """
+    Fit one fold and predict its test rows (runs in a joblib worker, X is a memory map shared by all folds).
+    """
+    X_train = row_block(X, train_idx, dtype=get_dtype())
+    clf = make_classifier(reduce, n_features, n_samples=X_train.shape[0], n_input_features=X_train.shape[1])
+    clf.fit(X_train, y[train_idx])
+    del X_train
+    chunk_rows = chunk_size(X.shape[1], get_dtype().itemsize)
+    y_pred = [clf.predict(row_block(X, test_idx[start:start + chunk_rows], dtype=get_dtype()))
+              for start in range(0, len(test_idx), chunk_rows)]
+    return np.concatenate(y_pred)
+
+
+def cross_validate(X, y, folds, n_jobs=1, reduce=None, n_features=None):
+    """
+    Fit the model on every (train_idx, test_idx) fold, n_jobs folds at a time.
+    Returns (fold_metrics DataFrame, out-of-fold predictions DataFrame).
+    """
+    reduce = MODEL_PARAMS["reduce"] if reduce is None else reduce
+    n_features = MODEL_PARAMS["n_features"] if n_features is None else n_features
+    y = np.asarray(y)
+
+    # max_nbytes/mmap_mode: arrays are shared with the workers as read-only memory maps, not pickled per fold
+    predictions = Parallel(n_jobs=n_jobs, max_nbytes="1M", mmap_mode="r")(
+        delayed(_fit_fold)(X, y, train_idx, test_idx, reduce, n_features) for train_idx, test_idx in folds
+    )
+
+    rows, preds = [], []
+    for fold, ((train_idx, test_idx), y_pred) in enumerate(zip(folds, predictions)):
+        metrics = compute_metrics(y[test_idx], y_pred)
+        rows.append({"fold": fold, "n_train": len(train_idx), "n_test": len(test_idx), **metrics})
+        preds.append(pd.DataFrame({"row": test_idx, "fold": fold, "y_true": y[test_idx], "y_pred": y_pred}))
+        logging.info(f"CV fold {fold}: train {len(train_idx)}, test {len(test_idx)}, "
+                     f"Accuracy={metrics['accuracy']}, Precision={metrics['precision']}, Recall={metrics['recall']}")
+    return pd.DataFrame(rows), pd.concat(preds, ignore_index=True)
+
+
+def summarize_folds(fold_df):
+    """
+    Per-fold metrics followed by a mean and a std row (fold = "mean" / "std").
+    """
+    metric_cols = ["accuracy", "precision", "recall"]
+    summary = pd.DataFrame([
+        {"fold": "mean", **fold_df[metric_cols].mean().to_dict()},
+        {"fold": "std", **fold_df[metric_cols].std(ddof=1).to_dict()},
+    ])
+    fold_df = fold_df.astype({"fold": object, "n_train": "Int64", "n_test": "Int64"})  # counts stay integers next to the empty summary cells
+    return pd.concat([fold_df, summary], ignore_index=True)
+
+
+def crossvalidate_model(ctx=None, scheme=None, n_folds=None, gap=None, n_jobs=1, reduce=None, n_features=None):
+    """
+    Cross-validate the model on one job's X and y and save cv_metrics.csv and cv_predictions.npz.
+    """
+    if ctx is None:
+        ctx = PipelineContext()
+    scheme = CV_PARAMS["scheme"] if scheme is None else scheme
+    n_folds = CV_PARAMS["n_folds"] if n_folds is None else n_folds
+    gap = CV_PARAMS["gap"] if gap is None else gap
+
+    X, y = ctx.get_X(), ctx.get_y()
+    warn_fitted_regions(ctx, "Cross-validation")
+    timepoints, runs = ctx.get_rows()
+    folds = make_folds(scheme, timepoints, runs, n_folds=n_folds, gap=gap)
+    logging.info(f"Cross-validation ({scheme}, {len(folds)} folds, gap {gap}) on X {X.shape} with {n_jobs} workers")
+
+    fold_df, preds_df = cross_validate(X, y, folds, n_jobs=n_jobs, reduce=reduce, n_features=n_features)
+    metrics_df = save_cv_results(fold_df, preds_df, ctx.paths.outputs_dir)
+    if ctx.persist:
+        outputs_dir = ctx.paths.outputs_dir
+        record_stage(ctx.paths, "crossval", [os.path.join(outputs_dir, "cv_metrics.csv"), os.path.join(outputs_dir, CV_PREDICTIONS_FILE)],
+                     params={"scheme": scheme, "n_folds": n_folds, "gap": gap, "reduce": reduce, "n_features": n_features},
+                     metrics={k: float(metrics_df.iloc[-2][k]) for k in ("accuracy", "precision", "recall")})
+    return metrics_df
+
+
+def save_cv_results(fold_df, preds_df, outputs_dir):
+    os.makedirs(outputs_dir, exist_ok=True)
+    metrics_df = summarize_folds(fold_df)
+    metrics_path = os.path.join(outputs_dir, "cv_metrics.csv")
+    metrics_df.to_csv(metrics_path, index=False)
+    save_predictions(os.path.join(outputs_dir, CV_PREDICTIONS_FILE), preds_df["y_true"].to_numpy(), preds_df["y_pred"].to_numpy(),
+                     rows=preds_df["row"].to_numpy(), fold=preds_df["fold"].to_numpy())
+    mean = metrics_df.iloc[-2]
+    logging.info(f"Cross-validation metrics: Accuracy={mean['accuracy']}, Precision={mean['precision']}, "
+                 f"Recall={mean['recall']} (mean over folds), saved to {metrics_path}")
+    return metrics_df
+
+
+def stack_jobs(paths_list, out_path, features="voxels"):
+    """
+    Concatenate the X of several jobs (e.g. the runs of one subject and task) into one memory-mapped .npy file.
+    The jobs must share their columns (one brain mask, or features="regions" with one atlas, see check_shared_columns()).
+    Returns (X, y, timepoints, runs), runs numbers the jobs 1..n in the given order: every job is its own group,
+    so the runs of different subjects that share a run number are not merged (the job's run number is only logged).
+    """
+    contexts = [PipelineContext(paths, features=features) for paths in paths_list]
+    Xs = [ctx.get_X() for ctx in contexts]
+    if len({X.shape[1] for X in Xs}) > 1:
+        raise ValueError(f"Jobs have different numbers of {features} (brain masks or regions), X cannot be stacked")
+    check_shared_columns(paths_list, features)
+
+    X = create_matrix(out_path, (sum(len(X) for X in Xs), Xs[0].shape[1]), dtype=Xs[0].dtype)
+    ys, timepoints, runs = [], [], []
+    offset = 0
+    for i, (ctx, X_job) in enumerate(zip(contexts, Xs), start=1):
+        for start, stop, block in iter_rows(X_job):
+            X[offset + start:offset + stop] = block
+        offset += len(X_job)
+        job_timepoints, _ = ctx.get_rows()
+        ys.append(ctx.get_y())
+        timepoints.append(job_timepoints)
+        runs.append(np.full(len(X_job), i))
+        logging.info(f"Stacked run {i}: {ctx.paths.prefix}, rows {offset - len(X_job)}-{offset - 1}")
+    X.flush()
+    del X
+    return open_matrix(out_path), np.concatenate(ys), np.concatenate(timepoints), np.concatenate(runs)
+
+
+def crossvalidate_jobs(paths_list, out_dir, scheme=None, n_folds=None, gap=None, n_jobs=1, features="voxels"):
+    """
+    Cross-validate over the stacked X of several processed jobs (leave-one-run-out by default) and save
+    X.npy, cv_metrics.csv and cv_predictions.npz to out_dir.
+    """
+    scheme = "runs" if scheme is None else scheme
+    n_folds = CV_PARAMS["n_folds"] if n_folds is None else n_folds
+    gap = CV_PARAMS["gap"] if gap is None else gap
+    os.makedirs(out_dir, exist_ok=True)
+    X, y, timepoints, runs = stack_jobs(paths_list, os.path.join(out_dir, "X.npy"), features=features)
+    folds = make_folds(scheme, timepoints, runs, n_folds=n_folds, gap=gap)
+    logging.info(f"Cross-validation ({scheme}, {len(folds)} folds, gap {gap}) over {len(paths_list)} stacked jobs, X {X.shape}")
+    fold_df, preds_df = cross_validate(X, y, folds, n_jobs=n_jobs)
+    return save_cv_results(fold_df, preds_df, out_dir)
@@ -8,53 +8,69 @@ Run main.py to execute this script.
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from sklearn.metrics import accuracy_score, precision_score, recall_score
 import logging
 import joblib #To load the mdoel instead of retraining it every time
+from pipeline.context import PipelineContext
+from pipeline.profiling import section
+from pipeline.store import PREDICTIONS_FILE, save_predictions, record_stage
+from pipeline.matrix import load_split
 
-def evaluate_model():
+def compute_metrics(y_true, y_pred):
+    """
+    Accuracy, macro precision and macro recall, the columns of evaluation_metrics.csv.
+    """
+    return {
+        "accuracy": accuracy_score(y_true, y_pred),
+        "precision": precision_score(y_true, y_pred, average='macro', zero_division=0),
+        "recall": recall_score(y_true, y_pred, average='macro', zero_division=0),
+    }
+
+def evaluate_model(ctx=None):
     """
     Evaluate the trained Decision Tree model and save predictions and metrics.
+    Uses the model and test set from the pipeline context, loading them only if build_model() did not run.
     """
+    if ctx is None:
+        ctx = PipelineContext()
+
     logging.info("Starting evaluation of model..")
     # Load predictions from model.py
-    outputs_dir = os.path.join("data", "outputs")
+    outputs_dir = ctx.paths.outputs_dir
     os.makedirs(outputs_dir, exist_ok=True)
 
-    #Load the trained decision tree model using joblib
-    model_path = os.path.join(outputs_dir, "decision_tree_model.joblib")
-    clf = joblib.load(model_path)
-    logging.info(f"Loaded trained model from {model_path}")
+    if ctx.predictions is not None:
+        # build_model() just predicted the test set, no need to reload or re-predict
+        y_test, y_pred = ctx.y_test, ctx.predictions
+    else:
+        #Load the trained decision tree model using joblib (instead of retraining)
+        clf = ctx.get_model()
+        logging.info(f"Loaded trained model from {os.path.join(outputs_dir, 'decision_tree_model.joblib')}")
 
-    #Load the test data: 
-    X_test = np.load(os.path.join(outputs_dir, "X_test.npy"))
-    y_test = pd.read_csv(os.path.join(outputs_dir, "y_test.csv"))["label"]
+        #Load the test data: 
+        X_test, y_test = ctx.get_test_set()
 
-    #Generate the predictions from X_test
-    y_pred = clf.predict(X_test)
+        #Generate the predictions from X_test
+        with section("predict", n_samples=X_test.shape[0]):
+            y_pred = clf.predict(X_test)
+        ctx.predictions = y_pred
 
-    #Save predictions in a dataframe
-    preds_df = pd.DataFrame({"y_true": y_test, "y_pred": y_pred})
-    preds_path = os.path.join(outputs_dir, "test_predictions.csv")
-    preds_df.to_csv(preds_path, index=False)
+    #Save predictions as label codes, with the rows of X they belong to
+    preds_path = os.path.join(outputs_dir, PREDICTIONS_FILE)
+    split_path = os.path.join(outputs_dir, "split.npz")
+    test_rows = load_split(split_path)[1] if os.path.exists(split_path) else None
+    save_predictions(preds_path, y_test, y_pred, rows=test_rows)
     logging.info(f"Predictions saved to {preds_path}")
 
     # Evaluation metrics - accuracy, precision, recall
-    accuracy = accuracy_score(y_test, y_pred)
-    precision = precision_score(y_test, y_pred, average='macro', zero_division=0)
-    recall = recall_score(y_test, y_pred, average='macro', zero_division=0)
-
     # define metrics and save them to a csv file
-    metrics = {
-        "accuracy": accuracy,
-        "precision": precision,
-        "recall": recall,
-    }
+    metrics = compute_metrics(y_test, y_pred)
 
-    logging.info(f"Evaluation metrics: Accuracy={accuracy}, Precision={precision}, Recall={recall}")
+    logging.info(f"Evaluation metrics: Accuracy={metrics['accuracy']}, Precision={metrics['precision']}, Recall={metrics['recall']}")
 
     metrics_path = os.path.join(outputs_dir, "evaluation_metrics.csv")
     pd.DataFrame([metrics]).to_csv(metrics_path, index=False)
 
-    logging.info(f"Metrics saved to {metrics_path}")
\ No newline at end of file
+    logging.info(f"Metrics saved to {metrics_path}")
+    if ctx.persist:
+        record_stage(ctx.paths, "evaluate", [preds_path, metrics_path], metrics=metrics, n_test=len(y_test))
\ No newline at end of file
@@ -0,0 +1,172 @@
+'''
+Feature reduction between loading X and fitting the DecisionTreeClassifier.
+
+A depth-5 tree uses at most 31 voxels, but fitting it sorts candidate splits over every masked voxel (~100k).
+A reducer is fitted on the training split only (no leakage from the test set) and saved together with
+the tree as one sklearn Pipeline in decision_tree_model.joblib, so evaluate_model() loads and predicts unchanged.
+
+Methods:
+    - none: all voxels (original behaviour)
+    - anova: univariate ANOVA F-test, keep the n_features best voxels (SelectKBest + f_classif)
+    - variance: keep the n_features voxels with the highest variance over the training rows (SelectKBest + training_variance),
+      unsupervised, the labels are not used
+    - pca: incremental PCA with n_components=n_features, fitted in batches
+
+The kept voxel indices are stored on the saved model as feature_indices_ (None for PCA, which mixes all voxels).
+compare_reducers() measures the accuracy / training time tradeoff and writes feature_reduction.csv.
+
+Run main.py (model step, --reduce METHOD --n-features N) to execute this script,
+or main.py compare-reducers [--job SUBJECT:TASK[:RUN]] to compare the reducers on a processed job.
+'''
+import time
+import logging
+from collections.abc import Sequence
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline
+from sklearn.feature_selection import SelectKBest, f_classif
+from sklearn.decomposition import IncrementalPCA
+
+REDUCERS = ("none", "anova", "variance", "pca")
+COMPARED_SIZES = (31, 100, 1000)  # n_features compared by compare_job_reducers() (31 = the most a depth-5 tree splits on)
+
+
+def training_variance(X, y=None):
+    # SelectKBest score of the variance reducer (module level, so the saved model can be unpickled)
+    return np.var(X, axis=0)
+
+
+def make_reducer(method="none", n_features=1000, n_samples=None, n_input_features=None, batch_size=None):
+    """
+    Build the (unfitted) reducer for `method`, None for 'none'.
+    n_samples / n_input_features clamp n_features to what the training data allows.
+    """
+    if method in (None, "none"):
+        return None
+    if method in ("anova", "variance"):
+        k = n_features if n_input_features is None else min(n_features, n_input_features)
+        return SelectKBest(f_classif if method == "anova" else training_variance, k=k)
+    if method == "pca":
+        n_components = n_features
+        if n_samples is not None:
+            n_components = min(n_components, n_samples)
+        if n_input_features is not None:
+            n_components = min(n_components, n_input_features)
+        # every batch must have at least n_components samples
+        batch_size = max(batch_size or 0, n_components)
+        return IncrementalPCA(n_components=n_components, batch_size=batch_size)
+    raise ValueError(f"Unknown feature reduction '{method}', expected one of {REDUCERS}")
+
+
+def with_reducer(clf, reducer):
+    """
+    Put the reducer in front of the classifier (the classifier itself if there is no reducer).
+    """
+    if reducer is None:
+        return clf
+    return Pipeline([("reduce", reducer), ("tree", clf)])
+
+
+def feature_indices(model):
+    """
+    Voxel indices the model's input is reduced to: all voxels (None) without a reducer or with PCA.
+    """
+    if not isinstance(model, Pipeline):
+        return None
+    reducer = model.named_steps["reduce"]
+    if hasattr(reducer, "get_support"):
+        return reducer.get_support(indices=True)
+    return None
+
+
+def final_estimator(model):
+    """
+    The classifier at the end of the model (the model itself without a reducer).
+    """
+    return model[-1] if isinstance(model, Pipeline) else model
+
+
+class FeatureNames(Sequence):
+    """
+    Feature names of a classifier's inputs, stored only for the features it uses.
+    Has the length plot_tree checks (one name per input), other names are generated when indexed.
+    """
+
+    def __init__(self, n_features, names, prefix="v"):
+        self.n_features = n_features
+        self.names = names  # {input index: name}
+        self.prefix = prefix
+
+    def __len__(self):
+        return self.n_features
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.n_features))]
+        i = int(i)
+        if i < 0:
+            i += self.n_features
+        if not 0 <= i < self.n_features:
+            raise IndexError(i)
+        return self.names.get(i, f"{self.prefix}{i}")
+
+
+def used_feature_names(model, n_voxels, prefix="v"):
+    """
+    Names of the classifier's inputs the tree splits on: v<voxel index> for voxels, pc<i> for PCA components.
+    prefix: name of the matrix columns (r for region features, r<column of X_regions>).
+    """
+    tree = final_estimator(model)
+    used = np.unique(tree.tree_.feature[tree.tree_.feature >= 0])
+    if isinstance(model, Pipeline):
+        reducer = model.named_steps["reduce"]
+        if hasattr(reducer, "get_support"):
+            voxels = reducer.get_support(indices=True)
+            return FeatureNames(len(voxels), {int(i): f"{prefix}{voxels[i]}" for i in used}, prefix=prefix)
+        return FeatureNames(reducer.n_components_, {int(i): f"pc{i}" for i in used}, prefix="pc")
+    return FeatureNames(n_voxels, {int(i): f"{prefix}{i}" for i in used}, prefix=prefix)
+
+
+def compare_reducers(X_train, y_train, X_test, y_test, make_classifier, settings, out_csv=None):
+    """
+    Fit make_classifier() with every (method, n_features) in settings and report
+    fit time, number of classifier inputs and test accuracy.
+    """
+    from sklearn.metrics import accuracy_score
+    rows = []
+    for method, n_features in settings:
+        reducer = make_reducer(method, n_features, n_samples=X_train.shape[0], n_input_features=X_train.shape[1])
+        model = with_reducer(make_classifier(), reducer)
+        start = time.perf_counter()
+        model.fit(X_train, y_train)
+        fit_seconds = time.perf_counter() - start
+        n_inputs = final_estimator(model).n_features_in_
+        accuracy = accuracy_score(y_test, model.predict(X_test))
+        rows.append({"method": method, "n_features": n_features if method != "none" else X_train.shape[1],
+                     "classifier_inputs": n_inputs, "fit_seconds": round(fit_seconds, 4), "accuracy": accuracy})
+        logging.info(f"Feature reduction {method}/{n_features}: {n_inputs} inputs, fit {fit_seconds:.3f}s, accuracy {accuracy:.3f}")
+    df = pd.DataFrame(rows)
+    if out_csv:
+        df.to_csv(out_csv, index=False)
+    return df
+
+
+def compare_job_reducers(paths=None, sizes=COMPARED_SIZES, out_csv=None, features="voxels"):
+    """
+    compare_reducers() on a processed job: the tree of analysis/model.py on the model's train/test split of X,
+    without a reducer and with every reducer at every size. Writes outputs/feature_reduction.csv by default.
+    """
+    from pipeline.context import PipelineContext
+    from pipeline.matrix import take_rows
+    from pipeline.precision import get_dtype
+    from analysis.model import make_classifier, split_indices
+
+    ctx = PipelineContext(paths, features=features)
+    X, y = ctx.get_X(), ctx.get_y()
+    train_idx, test_idx = split_indices(len(X))
+    out_csv = out_csv or ctx.paths.output("feature_reduction.csv")
+    settings = [("none", None)] + [(method, k) for method in REDUCERS[1:] for k in sizes]
+    df = compare_reducers(take_rows(X, train_idx, dtype=get_dtype()), y[train_idx], take_rows(X, test_idx, dtype=get_dtype()), y[test_idx],
+                          make_classifier, settings, out_csv=out_csv)
+    logging.info(f"Feature reduction comparison on {ctx.paths.prefix} saved to {out_csv}")
+    return df
@@ -0,0 +1,168 @@
+'''
+Out-of-core incremental classifier: trains on X in row chunks read from disk, for pooled multi-subject training.
+
+build_model() fits a DecisionTreeClassifier, which needs all training rows of X in memory at once, so the data of
+many subjects cannot be pooled beyond one machine's RAM. This engine trains a linear model (SGDClassifier,
+logistic loss) with partial_fit instead:
+    - Every job's X.npy stays memory-mapped, training rows are read in chunks of about 64 MB (pipeline/matrix.py)
+    - Several passes over the data (epochs), each pass visits the chunks of all jobs in a new random order and
+      shuffles the rows inside every chunk, so no pass sees the subjects one after the other
+    - Memory is bounded by one chunk plus the model (one weight per voxel and class), whatever the number of jobs
+    - The train/test split of every job is the one build_model() uses (split_indices), test rows are predicted in chunks too
+One job through main.py (--engine sgd) saves the model under the usual model file name with split.npz and
+predictions.npz, so evaluate_model() and inference.py load it unchanged. The decision tree figure and the
+sparse-voxel inference path only exist for trees and are skipped for this model.
+
+Pooled training over several processed jobs (train_pooled) writes the model and per-job plus pooled test metrics to --out-dir.
+
+Run main.py --engine sgd, or main.py pool --job SUBJECT:TASK[:RUN] --job ... for pooled training.
+'''
+import os
+import logging
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import SGDClassifier
+from pipeline.context import PipelineContext
+from pipeline.matrix import take_rows, chunk_size, save_split
+from pipeline.profiling import section
+from pipeline.store import PREDICTIONS_FILE, save_predictions, record_stage
+from pipeline.precision import get_dtype
+from analysis.model import MODEL_PARAMS, split_indices
+from analysis.evaluate import compute_metrics
+from etl.parcellate import check_shared_columns
+
+ENGINES = ("tree", "sgd")
+
+# Parameters of the incremental engine (also part of the stage cache fingerprint)
+INCREMENTAL_PARAMS = dict(
+    loss="log_loss",
+    alpha=1e-4,         # L2 regularization
+    epochs=5,           # passes over the training rows
+    chunk_rows=None,    # rows per chunk (default: about 64 MB of X)
+    shuffle=True,       # new chunk order and row order inside chunks every epoch
+    random_state=MODEL_PARAMS["random_state"],
+)
+
+
+def job_source(ctx):
+    """
+    Memory-mapped X, labels and train/test rows of one job (the split build_model() uses).
+    Training rows are sorted so a chunk is read from nearby places in the file.
+    """
+    X, y = ctx.get_X(), ctx.get_y()
+    train_idx, test_idx = split_indices(len(y))
+    return {"name": ctx.paths.prefix, "X": X, "y": y, "train": np.sort(train_idx), "test": test_idx}
+
+
+def iter_chunks(sources, rows="train", chunk_rows=None, rng=None):
+    """
+    Yield (source, row indices, X rows in the working precision) chunks of every source.
+    With an rng the chunks of all sources come in random order and the rows inside each chunk are shuffled.
+    """
+    chunks = []
+    for source in sources:
+        idx = source[rows]
+        step = chunk_rows or chunk_size(source["X"].shape[1], get_dtype().itemsize)
+        chunks.extend((source, idx[start:start + step]) for start in range(0, len(idx), step))
+    order = rng.permutation(len(chunks)) if rng is not None else range(len(chunks))
+    for i in order:
+        source, idx = chunks[i]
+        if rng is not None:
+            idx = rng.permutation(idx)
+        yield source, idx, take_rows(source["X"], idx, dtype=get_dtype())
+
+
+def fit_incremental(sources, epochs=None, chunk_rows=None, shuffle=None, **params):
+    """
+    Train an SGDClassifier over the training rows of every source with partial_fit, chunk by chunk.
+    """
+    settings = {**INCREMENTAL_PARAMS, **{k: v for k, v in params.items() if v is not None}}
+    epochs = settings["epochs"] if epochs is None else epochs
+    chunk_rows = settings["chunk_rows"] if chunk_rows is None else chunk_rows
+    shuffle = settings["shuffle"] if shuffle is None else shuffle
+    if len({source["X"].shape[1] for source in sources}) > 1:
+        raise ValueError("Jobs have different numbers of columns (brain masks or regions), they cannot be pooled")
+
+    # partial_fit needs every class up front, a chunk may not contain all of them
+    classes = np.unique(np.concatenate([np.asarray(source["y"]).astype(str) for source in sources]))
+    clf = SGDClassifier(loss=settings["loss"], alpha=settings["alpha"], random_state=settings["random_state"])
+    rng = np.random.default_rng(settings["random_state"])
+    n_rows = sum(len(source["train"]) for source in sources)
+    for epoch in range(epochs):
+        with section(f"epoch {epoch + 1}"):
+            for source, idx, X_chunk in iter_chunks(sources, "train", chunk_rows, rng if shuffle else None):
+                clf.partial_fit(X_chunk, np.asarray(source["y"][idx]).astype(str), classes=classes)
+        logging.info(f"Incremental training: epoch {epoch + 1}/{epochs} over {n_rows} rows of {len(sources)} jobs")
+    return clf
+
+
+def predict_rows(clf, source, rows="test", chunk_rows=None):
+    """
+    Predictions for the test (or train) rows of a source, in the order of source[rows], chunk by chunk.
+    """
+    predictions = [clf.predict(X_chunk) for _, _, X_chunk in iter_chunks([source], rows, chunk_rows)]
+    return np.concatenate(predictions) if predictions else np.array([], dtype=str)
+
+
+def incremental_model(ctx=None, epochs=None, chunk_rows=None):
+    """
+    build_model() with the incremental engine: same split and output files, X is never loaded as a whole.
+    Returns (clf, None, y_test, predictions), the test rows are not kept in memory.
+    """
+    if ctx is None:
+        ctx = PipelineContext()
+    outputs_dir = ctx.paths.outputs_dir
+    os.makedirs(outputs_dir, exist_ok=True)
+
+    source = job_source(ctx)
+    logging.info(f"Incremental training on X {source['X'].shape}: {len(source['train'])} train, {len(source['test'])} test rows")
+    clf = fit_incremental([source], epochs=epochs, chunk_rows=chunk_rows)
+    with section("predict", n_samples=len(source["test"])):
+        predictions = predict_rows(clf, source, "test", chunk_rows)
+    y_test = source["y"][source["test"]]
+
+    if ctx.persist:
+        # Same file name as the tree, so evaluate_model() and inference.py load it unchanged
+        model_path = os.path.join(outputs_dir, "decision_tree_model.joblib")
+        joblib.dump(clf, model_path)
+        logging.info(f"Trained model saved to {model_path}")
+        save_split(os.path.join(outputs_dir, "split.npz"), source["train"], source["test"])
+    ctx.clf, ctx.y_test, ctx.predictions = clf, y_test, predictions
+    if ctx.persist:
+        save_predictions(os.path.join(outputs_dir, PREDICTIONS_FILE), y_test, predictions, rows=source["test"])
+        record_stage(ctx.paths, "model", [os.path.join(outputs_dir, name) for name in ("decision_tree_model.joblib", "split.npz", PREDICTIONS_FILE)],
+                     params={"engine": "sgd", **INCREMENTAL_PARAMS, "epochs": epochs or INCREMENTAL_PARAMS["epochs"],
+                             "chunk_rows": chunk_rows or INCREMENTAL_PARAMS["chunk_rows"]},
+                     n_train=len(source["train"]), n_test=len(source["test"]), classes=list(clf.classes_.astype(str)))
+    return clf, None, y_test, predictions
+
+
+def train_pooled(paths_list, out_dir, epochs=None, chunk_rows=None, features="voxels"):
+    """
+    Train one model over the training rows of several processed jobs and score it on every job's test rows.
+    features="regions" pools the region matrices (etl/parcellate.py), which share their columns across subjects with one atlas.
+    Voxel matrices are only pooled when the jobs share one brain mask (check_shared_columns()).
+    Saves the model and incremental_metrics.csv (one row per job and a pooled row) to out_dir. Returns the metrics.
+    """
+    check_shared_columns(paths_list, features)
+    sources = [job_source(PipelineContext(paths, features=features)) for paths in paths_list]
+    clf = fit_incremental(sources, epochs=epochs, chunk_rows=chunk_rows)
+
+    rows, all_true, all_pred = [], [], []
+    for source in sources:
+        y_true, y_pred = source["y"][source["test"]], predict_rows(clf, source, "test", chunk_rows)
+        rows.append({"job": source["name"], "n_train": len(source["train"]), "n_test": len(y_true), **compute_metrics(y_true, y_pred)})
+        all_true.append(y_true)
+        all_pred.append(y_pred)
+    pooled_true, pooled_pred = np.concatenate(all_true), np.concatenate(all_pred)
+    rows.append({"job": "pooled", "n_train": sum(r["n_train"] for r in rows), "n_test": len(pooled_true),
+                 **compute_metrics(pooled_true, pooled_pred)})
+
+    os.makedirs(out_dir, exist_ok=True)
+    joblib.dump(clf, os.path.join(out_dir, "decision_tree_model.joblib"))
+    metrics_df = pd.DataFrame(rows)
+    metrics_path = os.path.join(out_dir, "incremental_metrics.csv")
+    metrics_df.to_csv(metrics_path, index=False)
+    logging.info(f"Pooled incremental model over {len(sources)} jobs saved to {out_dir}, metrics to {metrics_path}")
+    return metrics_df
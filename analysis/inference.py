@@ -0,0 +1,295 @@
+'''
+Inference on new scans with the saved masker and model, without re-running the pipeline or retraining.
+
+The transform step saves the fitted NiftiMasker (brain mask + preprocessing parameters, masker.joblib) and the
+model step saves decision_tree_model.joblib. InferenceEngine loads both once and keeps them in memory:
+    - Accepts NIfTI files (.nii / .nii.gz) or directories of them
+    - Masks and preprocesses every scan like the training data (same mask and filters, the TR from the scan's header),
+      or chunk by chunk with bounded memory (streaming=True, see etl/streaming.py),
+      or only for the voxels the model reads (fast=True, see sparse.py)
+    - Averages the voxels within the training regions when the model was trained on region features (etl/parcellate.py),
+      scaled with the training mean and std of every region
+    - Predicts in batches of timepoints (batch_size rows at a time)
+    - Writes <name>_predictions.csv with y_true, y_pred columns (the labels of predictions.npz)
+If a scan has an events file next to it (<name>_events.tsv for <name>_bold.nii.gz), its timepoints are labeled
+like in transform.py and only task timepoints are scored (y_true filled). Otherwise every timepoint is scored and y_true is empty.
+
+serve() runs the engine as a long-lived local HTTP service, so repeated requests do not pay the import
+and model loading costs:
+    - GET  /health                      -> {"status": "ok", "model": ..., "voxels": ...}
+    - POST /predict {"paths": [...]}    -> {"results": [{"path", "output", "n_timepoints", "predictions"}]}
+The service only listens on localhost. Request paths are resolved against the configured input root (--input-root,
+relative paths too) and scans outside it are refused (403), predictions always go to the configured --out-dir.
+
+Run main.py predict SCAN_OR_DIR [...] (or main.py serve) to execute this script.
+'''
+import os
+import glob
+import json
+import time
+import logging
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import joblib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from nilearn.image import load_img
+from pipeline.paths import job_paths
+from pipeline.precision import get_dtype
+from etl.transform import MASKER_PARAMS
+from etl.labels import tr_from_img, label_timepoints, decode_labels
+from etl.parcellate import REGIONS_FILE, load_regions, load_region_stats, region_signals
+from analysis.sparse import voxel_spec, SparseVoxelExtractor
+
+DEFAULT_BATCH_SIZE = 512   # timepoints per predict() call
+SERVICE_HOST = "127.0.0.1"  # the service has no authentication, it is never exposed beyond this machine
+DEFAULT_PORT = 8765
+DEFAULT_OUT_DIR = os.path.join("data", "outputs", "inference")
+DEFAULT_INPUT_ROOT = "data"
+NIFTI_PATTERNS = ("*.nii", "*.nii.gz")
+
+
+def iter_scans(inputs):
+    """
+    NIfTI files from a list of files and directories (directories are searched for .nii / .nii.gz, sorted).
+    """
+    scans = []
+    for item in inputs:
+        if os.path.isdir(item):
+            found = [f for pattern in NIFTI_PATTERNS for f in glob.glob(os.path.join(item, pattern))]
+            scans.extend(sorted(found))
+        elif os.path.exists(item):
+            scans.append(item)
+        else:
+            raise FileNotFoundError(f"No such scan or directory: {item}")
+    return scans
+
+
+def scan_name(scan_path):
+    """
+    BIDS prefix of a scan: the file name without .nii[.gz] and the _bold suffix.
+    """
+    name = os.path.basename(scan_path)
+    for ext in (".nii.gz", ".nii"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return name[:-len("_bold")] if name.endswith("_bold") else name
+
+
+def events_path(scan_path):
+    """
+    The BIDS events file next to a scan (<name>_events.tsv for <name>_bold.nii[.gz]), None if there is none.
+    """
+    path = os.path.join(os.path.dirname(scan_path), f"{scan_name(scan_path)}_events.tsv")
+    return path if os.path.exists(path) else None
+
+
+def output_path(scan_path, out_dir):
+    return os.path.join(out_dir, f"{scan_name(scan_path)}_predictions.csv")
+
+
+class InferenceEngine:
+    """
+    Fitted masker + model kept in memory, scores new scans.
+    """
+
+    def __init__(self, masker_path, model_path, batch_size=DEFAULT_BATCH_SIZE, streaming=False, hrf_shift=0.0, fast=False, regions_path=None):
+        start = time.perf_counter()
+        self.masker = joblib.load(masker_path)
+        self.model = joblib.load(model_path)
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.streaming = streaming
+        self.hrf_shift = hrf_shift
+        self.n_voxels = int(np.asarray(self.masker.mask_img_.dataobj).astype(bool).sum())
+        self._lock = threading.Lock()  # the masker's t_r is set per scan
+
+        # Model trained on region features: the scan's voxels are averaged within the job's regions
+        self.regions = None
+        n_inputs = getattr(self.model, "n_features_in_", self.n_voxels)
+        if n_inputs != self.n_voxels:
+            if regions_path is None or not os.path.exists(regions_path):
+                raise ValueError(f"Model expects {n_inputs} inputs, the mask has {self.n_voxels} voxels and no regions file was found")
+            voxel_region, region_ids, _ = load_regions(regions_path)
+            # z-scored with the training mean / std of every region (not the scan's own), like X_regions.npy
+            self.regions = voxel_region, len(region_ids)
+            self.region_stats = load_region_stats(regions_path)
+            if self.region_stats is None:
+                logging.warning(f"{regions_path} has no training statistics (older parcellation), region signals are standardized per scan")
+
+        # Sparse-voxel fast path: only the voxels the tree reads are preprocessed (see sparse.py)
+        self.extractor = None
+        if fast:
+            spec = getattr(self.model, "voxel_spec_", None) or voxel_spec(self.model, self.masker)
+            if spec is None:
+                logging.warning("Model uses every voxel (PCA, a linear model or region features), fast inference is not possible, using the full preprocessing")
+            else:
+                self.extractor = SparseVoxelExtractor(spec)
+        logging.info(f"Inference engine loaded {masker_path} and {model_path} ({self.n_voxels} voxels) "
+                     f"in {time.perf_counter() - start:.2f}s")
+
+    @classmethod
+    def from_job(cls, paths=None, **kwargs):
+        """
+        Engine with the masker and model saved by the pipeline for one job (default job if paths is None).
+        """
+        paths = paths if paths is not None else job_paths()
+        return cls(paths.processed("masker.joblib"), paths.output("decision_tree_model.joblib"),
+                   regions_path=paths.processed(REGIONS_FILE), **kwargs)
+
+    def mask(self, scan_path):
+        """
+        Masked, preprocessed timepoints x voxels matrix of one scan (same preprocessing as the training data).
+        """
+        img = load_img(scan_path)
+        tr = tr_from_img(img, default=self.masker.t_r)
+        if self.extractor is not None:
+            return self.extractor.transform_sparse(img, t_r=tr), tr, None
+        if self.streaming:
+            from etl.streaming import stream_transform
+            masker_params = {**{k: getattr(self.masker, k) for k in MASKER_PARAMS}, "t_r": tr}
+            tmp = tempfile.NamedTemporaryFile(suffix=".npy", delete=False)
+            tmp.close()
+            return stream_transform(img, self.masker.mask_img_, masker_params, tmp.name), tr, tmp.name
+        with self._lock:
+            self.masker.t_r = tr
+            return self.masker.transform(img), tr, None
+
+    def predict_matrix(self, X, rows=None):
+        """
+        Predictions for rows of X (all rows if rows is None), batch_size rows per predict() call.
+        """
+        rows = np.arange(X.shape[0]) if rows is None else np.asarray(rows)
+        predictions = []
+        for start in range(0, len(rows), self.batch_size):
+            batch = X[rows[start:start + self.batch_size]]
+            batch = batch if sparse.issparse(batch) else np.asarray(batch, dtype=get_dtype())
+            predictions.append(self.model.predict(batch))
+        return np.concatenate(predictions) if predictions else np.array([], dtype=object)
+
+    def predict_scan(self, scan_path, out_dir=None):
+        """
+        Score one scan. Returns a DataFrame with y_true, y_pred columns (the labels of predictions.npz),
+        also written to out_dir/<name>_predictions.csv when out_dir is given.
+        """
+        start = time.perf_counter()
+        X, tr, tmp_path = self.mask(scan_path)
+        try:
+            if X.shape[1] != self.n_voxels:
+                raise ValueError(f"{scan_path}: {X.shape[1]} voxels after masking, the model expects {self.n_voxels}")
+            if self.regions is not None:
+                X = region_signals(X, *self.regions, stats=self.region_stats)
+
+            # Label the timepoints from the events file if there is one, and only score task timepoints (like X in transform.py)
+            events_file = events_path(scan_path)
+            if events_file is not None:
+                codes, categories = label_timepoints(pd.read_csv(events_file, sep="\t"), X.shape[0], tr, hrf_shift=self.hrf_shift)
+                labels = decode_labels(codes, categories)
+                rows = np.flatnonzero(labels != "rest")
+                y_true = labels[rows]
+            else:
+                rows = np.arange(X.shape[0])
+                y_true = np.full(len(rows), "", dtype=object)
+            y_pred = self.predict_matrix(X, rows)
+        finally:
+            if tmp_path is not None:
+                del X
+                os.unlink(tmp_path)
+
+        preds_df = pd.DataFrame({"y_true": y_true, "y_pred": y_pred})
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+            preds_df.to_csv(output_path(scan_path, out_dir), index=False)
+        logging.info(f"Scored {scan_path}: {len(preds_df)} timepoints in {time.perf_counter() - start:.2f}s")
+        return preds_df
+
+    def predict_many(self, inputs, out_dir):
+        """
+        Score every scan in a list of files and directories. Returns one summary dict per scan.
+        """
+        results = []
+        for scan_path in iter_scans(inputs):
+            preds_df = self.predict_scan(scan_path, out_dir)
+            results.append({
+                "path": scan_path,
+                "output": output_path(scan_path, out_dir),
+                "n_timepoints": len(preds_df),
+                "predictions": preds_df["y_pred"].value_counts().to_dict(),
+            })
+        return results
+
+
+def resolve_inputs(inputs, input_root):
+    """
+    Scans of a service request: paths are taken relative to input_root and every scan (after expanding directories
+    and following symlinks) must be inside it, else PermissionError.
+    """
+    root = os.path.realpath(input_root)
+    scans = iter_scans([os.path.normpath(os.path.join(root, item)) for item in inputs])
+    for scan_path in scans:
+        if os.path.commonpath([root, os.path.realpath(scan_path)]) != root:
+            raise PermissionError(f"{scan_path} is outside the input root {input_root}")
+    return scans
+
+
+def make_server(engine, port=DEFAULT_PORT, out_dir=DEFAULT_OUT_DIR, input_root=DEFAULT_INPUT_ROOT):
+    """
+    HTTP server for the engine on localhost (not started, see serve()).
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            data = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, {"status": "ok", "model": engine.model_path, "voxels": engine.n_voxels})
+            else:
+                self._send(404, {"error": f"unknown endpoint {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send(404, {"error": f"unknown endpoint {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if "out_dir" in request:
+                    logging.warning(f"Inference service: ignored the request's out_dir, writing to {out_dir}")
+                results = engine.predict_many(resolve_inputs(request.get("paths", []), input_root), out_dir)
+                self._send(200, {"results": results})
+            except PermissionError as e:
+                self._send(403, {"error": str(e)})
+            except (ValueError, FileNotFoundError) as e:
+                self._send(400, {"error": str(e)})
+            except Exception as e:
+                logging.error(f"Inference request failed: {e}")
+                self._send(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            logging.info(f"Inference service: {format % args}")
+
+    return ThreadingHTTPServer((SERVICE_HOST, port), Handler)
+
+
+def serve(engine, port=DEFAULT_PORT, out_dir=DEFAULT_OUT_DIR, input_root=DEFAULT_INPUT_ROOT):
+    """
+    Run the engine as a local HTTP service until interrupted (see the module docstring for the endpoints).
+    """
+    server = make_server(engine, port, out_dir, input_root)
+    logging.info(f"Inference service listening on http://{SERVICE_HOST}:{server.server_port}, "
+                 f"scans from {input_root}, predictions to {out_dir}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
@@ -1,6 +1,9 @@
 '''
 Make a DecisionTreeClassifer model using voxels and timepoints as X-value and labels as Y-value.
 Save model & test files to data/outputs
+The train/test split is saved as row indices into X (split.npz), X itself is read with memory mapping.
+Optionally a feature reduction step (see features.py) is fitted on the training split and saved with the tree.
+The saved model records the voxels it uses and their preprocessing (voxel_spec_, see sparse.py) for fast inference.
 
 Run main.py to execute this script.
 '''
@@ -10,61 +13,119 @@ import pandas as pd
 import numpy as np
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
 import joblib #To save decision tree model for future scripts
 import logging
+from pipeline.context import PipelineContext
+from pipeline.matrix import take_rows, save_split
+from analysis.features import make_reducer, with_reducer, feature_indices, final_estimator
+from analysis.sparse import voxel_spec
+from pipeline.profiling import section
+from pipeline.store import PREDICTIONS_FILE, save_predictions, record_stage
+from pipeline.precision import get_dtype
 
-def build_model():
+# Model parameters (also part of the stage cache fingerprint)
+MODEL_PARAMS = dict(
+    test_size=0.2,      # test = 20%, train = 80%
+    max_depth=5,
+    random_state=42,
+    reduce="none",      # feature reduction before the tree: none, anova, variance or pca
+    n_features=1000,    # voxels (anova, variance) or components (pca) to keep
+)
+
+def split_indices(n_rows):
+    """
+    Train and test row indices of the 80/20 split.
+    Splits row indices rather than X itself (same shuffle as splitting X directly).
+    """
+    return train_test_split(
+        np.arange(n_rows),
+        test_size=MODEL_PARAMS["test_size"],
+        random_state=MODEL_PARAMS["random_state"]
+    )
+
+def make_classifier(reduce="none", n_features=1000, n_samples=None, n_input_features=None):
+    """
+    Unfitted decision tree with MODEL_PARAMS, behind the feature reduction step if there is one.
+    Also used by the cross-validation folds (crossval.py) so every fold trains the same model.
+    """
+    clf = DecisionTreeClassifier(max_depth=MODEL_PARAMS["max_depth"], random_state=MODEL_PARAMS["random_state"])
+    reducer = make_reducer(reduce, n_features, n_samples=n_samples, n_input_features=n_input_features)
+    return with_reducer(clf, reducer)
+
+def build_model(ctx=None, reduce=None, n_features=None, clf=None):
     """
     Build and train a Decision Tree Classifier model.
+    The fitted model, test set and predictions are kept on the pipeline context.
+    reduce / n_features override MODEL_PARAMS to put a feature reduction step in front of the tree.
+    clf: unfitted estimator to train instead (e.g. the best candidate of the hyperparameter search, search.py).
     """
+    if ctx is None:
+        ctx = PipelineContext()
+    reduce = MODEL_PARAMS["reduce"] if reduce is None else reduce
+    n_features = MODEL_PARAMS["n_features"] if n_features is None else n_features
+
     #State directory for results to go in (data/outputs)
-    outputs_dir = os.path.join("data", "outputs")
+    outputs_dir = ctx.paths.outputs_dir
     os.makedirs(outputs_dir, exist_ok=True)
 
-    # Load features and labels
-    processed_path = "data/processed"
-    X_file = os.path.join(processed_path, "sub-01_task-Classificationprobewithoutfeedback_X.npy")
-    y_file = os.path.join(processed_path, "sub-01_task-Classificationprobewithoutfeedback_y.csv")
-
-    X = np.load(X_file)
-    y = pd.read_csv(y_file)["label"].values
+    # Features and labels from transform/load (read from disk only if not in memory)
+    X = ctx.get_X()
+    y = ctx.get_y()
 
     logging.info(f"Loaded filtered data: X shape {X.shape}, y shape {y.shape}")
 
     # Split into train and test sets (test = 20%, train = 80%)
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, 
-        y, 
-        test_size=0.2,
-        random_state = 42
-    )
+    train_idx, test_idx = split_indices(len(y))
+    y_train, y_test = y[train_idx], y[test_idx]
+
+    # Only the selected rows are read from X, straight into the working precision (--precision float32 is also the dtype
+    # the tree uses internally, so no extra copy in fit)
+    X_train = take_rows(X, train_idx, dtype=get_dtype())
+    X_test = take_rows(X, test_idx, dtype=get_dtype())
 
     # Logging info
     logging.info(f"Train set shape: {X_train.shape}, Test set shape: {X_test.shape}")
 
     # Train decision tree classifier with maxdepth of 5
-    clf = DecisionTreeClassifier(max_depth=5, random_state=42)
-    clf.fit(X_train, y_train)
+    # Optional feature reduction, fitted on the training split only and saved with the tree
+    if clf is None:
+        clf = make_classifier(reduce, n_features, n_samples=X_train.shape[0], n_input_features=X_train.shape[1])
+    with section("clf.fit", n_samples=X_train.shape[0], n_features=X_train.shape[1]):
+        clf.fit(X_train, y_train)
+    if isinstance(clf, Pipeline):
+        clf.feature_indices_ = feature_indices(clf)
+        logging.info(f"Feature reduction {type(clf[0]).__name__}: {X_train.shape[1]} voxels -> {clf[-1].n_features_in_} tree inputs")
 
-    # Save trained model using joblib
-    model_path = os.path.join(outputs_dir, "decision_tree_model.joblib")
-    joblib.dump(clf, model_path)
+    # Record the voxels the tree reads and their preprocessing, for the sparse inference path (sparse.py)
+    masker_path = ctx.paths.processed("masker.joblib")
+    if os.path.exists(masker_path):
+        clf.voxel_spec_ = voxel_spec(clf, joblib.load(masker_path))
+        if clf.voxel_spec_ is not None:
+            logging.info(f"Model uses {len(clf.voxel_spec_['voxels'])} of {X.shape[1]} voxels")
 
-    # logging info
-    logging.info(f"Trained model saved to {model_path}")
+    if ctx.persist:
+        # Save trained model using joblib
+        model_path = os.path.join(outputs_dir, "decision_tree_model.joblib")
+        joblib.dump(clf, model_path)
 
-    # Save test data:
+        # logging info
+        logging.info(f"Trained model saved to {model_path}")
 
-    np.save(os.path.join(outputs_dir, "X_test.npy"), X_test)
-    pd.DataFrame({"label": y_test}).to_csv(os.path.join(outputs_dir, "y_test.csv"), index=False)
+        # Save test data: split indices into X instead of a second copy of the test rows
+        # (the test labels are the labels at the test rows, see PipelineContext.get_test_set())
+        save_split(os.path.join(outputs_dir, "split.npz"), train_idx, test_idx)
 
     # Save predictions and model
-    predictions = clf.predict(X_test)
-    pd.DataFrame({"y_true": y_test, 
-                  "y_pred": predictions}).to_csv(
-                  os.path.join(outputs_dir, "test_predictions.csv"),
-                  index=False
-    )
+    with section("predict", n_samples=X_test.shape[0]):
+        predictions = clf.predict(X_test)
+    ctx.clf, ctx.X_test, ctx.y_test, ctx.predictions = clf, X_test, y_test, predictions
+    if ctx.persist:
+        save_predictions(os.path.join(outputs_dir, PREDICTIONS_FILE), y_test, predictions, rows=test_idx)
+        record_stage(ctx.paths, "model", [os.path.join(outputs_dir, name) for name in ("decision_tree_model.joblib", "split.npz", PREDICTIONS_FILE)],
+                     params={"features": ctx.features, "reduce": reduce, "n_features": n_features, "estimator": type(final_estimator(clf)).__name__,
+                             **final_estimator(clf).get_params()},
+                     n_train=len(train_idx), n_test=len(test_idx), classes=list(np.asarray(clf.classes_).astype(str)))
 
     # logging info
     logging.info(f"Predictions shape: {predictions.shape}, Test labels shape: {y_test.shape}")
@@ -0,0 +1,335 @@
+'''
+Real-time decoding: volumes are preprocessed and classified one TR at a time, as they come off the scanner.
+
+transform_data() and the inference engine need the whole run before they can detrend, filter or standardize
+a voxel, so the first prediction comes after the last volume. For closed-loop neurofeedback every volume has
+to be classified right after it arrives. RealtimeDecoder keeps the fitted mask and the model loaded and
+carries running state per voxel instead of whole time series:
+    - Smoothing and masking are per volume, the same as the offline preprocessing (the mask index is computed once)
+    - Detrending: running least-squares line per voxel (sums of t, t^2, x, t*x), each volume minus the line so far
+    - Band-pass filter: the Butterworth filter nilearn uses (order 5, second-order sections), applied causally with
+      sosfilt and its per-voxel state, instead of forward-backward over the whole run
+    - Standardization: running mean and variance per voxel (Welford), z-score of each volume with the stats so far
+    - Tree models only need the voxels their splits read (fast=True, see sparse.py): smoothing is done in the small
+      box around each of them and the running state only covers those voxels
+    - Models trained on region features (etl/parcellate.py) get the mean of every region's cleaned voxels,
+      z-scored with the training mean and std saved in regions.npz (running stats for older files without them)
+The first `warmup` volumes only feed the running state (detrend line, filter, stats), they are not classified.
+Online values are causal, so they differ from the offline ones (the filter is one-pass, the stats are from the
+past only), the online accuracy is reported next to the latency to see what that costs.
+Replaying the job's own run, most of its volumes are the ones the model was trained on: every volume is still fed
+(the running state needs them), but only the volumes of the model's test split are scored, reported as
+held_out_accuracy. A separate scan (SCAN.nii.gz, e.g. another run) is scored on all its volumes (online_accuracy).
+
+ScannerFeed simulates the scanner by replaying a NIfTI file: volume i is delivered at i * TR (speed=2 replays
+twice as fast, speed=0 as fast as possible). The latency of a volume is from its delivery time to its prediction,
+so a volume that waited for the previous one to finish counts that wait. The per-volume latencies (with the
+preprocessing and predict parts) are saved to outputs/realtime_latency.csv and compared with the budget,
+a fraction of the TR (default half of it: the prediction has to leave time for feedback display).
+
+Run main.py realtime [--job SUBJECT:TASK[:RUN]] [SCAN.nii.gz] [--speed 0] to execute this script.
+'''
+import os
+import time
+import logging
+import joblib
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import signal as sp_signal
+from nilearn.image.image import smooth_array
+from pipeline.paths import job_paths
+from pipeline.profiling import section
+from pipeline.precision import get_dtype
+from pipeline.matrix import load_split
+from pipeline.context import PipelineContext
+from etl.extract import extracted_image_path
+from etl.transform import MASKER_PARAMS
+from etl.labels import tr_from_img, label_timepoints, decode_labels
+from etl.parcellate import REGIONS_FILE, load_regions, load_region_stats, averaging_matrix
+from analysis.sparse import voxel_spec, SparseVoxelExtractor
+from analysis.inference import events_path
+
+REALTIME_PARAMS = dict(
+    warmup=10,            # volumes that only feed the running state before the first prediction
+    budget_fraction=0.5,  # latency budget as a fraction of the TR
+    filter_order=5,       # Butterworth order (nilearn.signal.butterworth default)
+)
+LATENCY_FILE = "realtime_latency.csv"
+
+
+class OnlineCleaner:
+    """
+    Causal per-voxel detrending, band-pass filtering and standardization, one volume (row) at a time.
+    Same steps and order as nilearn.signal.clean (detrend, filter, standardize), with running state.
+    """
+
+    def __init__(self, n_voxels, t_r, detrend=True, standardize=True, high_pass=None, low_pass=None,
+                 order=REALTIME_PARAMS["filter_order"]):
+        self.detrend = detrend
+        self.standardize = bool(standardize)
+        self.n = 0
+        # Running sums of the line fit (t sums are the same for every voxel), accumulators stay float64
+        self.sum_t = self.sum_tt = 0.0
+        self.sum_x = np.zeros(n_voxels)
+        self.sum_tx = np.zeros(n_voxels)
+        # Welford mean / sum of squared deviations for the z-score
+        self.mean = np.zeros(n_voxels)
+        self.m2 = np.zeros(n_voxels)
+
+        # Butterworth sections as in nilearn.signal.butterworth, with a filter state per voxel
+        self.sos = None
+        nyquist = 0.5 / t_r
+        low = low_pass if low_pass is not None and low_pass < nyquist else None
+        if high_pass is not None and low is not None:
+            self.sos = sp_signal.butter(order, [high_pass / nyquist, low / nyquist], btype="bandpass", output="sos")
+        elif high_pass is not None:
+            self.sos = sp_signal.butter(order, high_pass / nyquist, btype="highpass", output="sos")
+        elif low is not None:
+            self.sos = sp_signal.butter(order, low / nyquist, btype="lowpass", output="sos")
+        if self.sos is not None:
+            self.zi = np.zeros((self.sos.shape[0], 2, n_voxels))
+
+    def update(self, x):
+        """
+        Clean one volume's voxel values with the state so far, then add it to the state. Returns the cleaned row.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        t = float(self.n)
+        self.n += 1
+
+        if self.detrend:
+            self.sum_t += t
+            self.sum_tt += t * t
+            self.sum_x += x
+            self.sum_tx += t * x
+            n = self.n
+            denom = n * self.sum_tt - self.sum_t ** 2
+            slope = (n * self.sum_tx - self.sum_t * self.sum_x) / denom if denom > 0 else 0.0
+            intercept = (self.sum_x - slope * self.sum_t) / n
+            x = x - (intercept + slope * t)
+
+        if self.sos is not None:
+            # sosfilt along a length-1 time axis keeps the state of every voxel in zi
+            y, self.zi = sp_signal.sosfilt(self.sos, x[np.newaxis, :], axis=0, zi=self.zi)
+            x = y[0]
+
+        if self.standardize:
+            delta = x - self.mean
+            self.mean += delta / self.n
+            self.m2 += delta * (x - self.mean)
+            std = np.sqrt(self.m2 / self.n)
+            x = np.divide(x - self.mean, std, out=np.zeros_like(x), where=std > 0)
+        return x
+
+
+class ScannerFeed:
+    """
+    Replays a 4D NIfTI volume by volume like a scanner: volume i is delivered at start + i * TR / speed.
+    Iterating yields (index, volume, delivery time in perf_counter seconds).
+    """
+
+    def __init__(self, scan_path, t_r=None, speed=1.0):
+        # Kept open so volumes are read one after another from a single open file (.nii.gz is not re-decompressed)
+        self.img = nib.load(scan_path, keep_file_open=True)
+        self.t_r = t_r if t_r is not None else tr_from_img(self.img)
+        self.speed = speed
+        self.n_volumes = self.img.shape[3]
+        self.read_s = np.zeros(self.n_volumes)
+
+    def __iter__(self):
+        start = time.perf_counter()
+        for i in range(self.n_volumes):
+            read_start = time.perf_counter()
+            volume = np.asarray(self.img.dataobj[..., i])
+            self.read_s[i] = time.perf_counter() - read_start
+            delivery = start + i * self.t_r / self.speed if self.speed else time.perf_counter()
+            wait = delivery - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            yield i, volume, delivery
+
+
+class RealtimeDecoder:
+    """
+    Saved masker + model with running preprocessing state, classifies one volume at a time.
+    """
+
+    def __init__(self, masker_path, model_path, t_r=None, fast=False, warmup=REALTIME_PARAMS["warmup"], regions_path=None):
+        self.masker = joblib.load(masker_path)
+        self.model = joblib.load(model_path)
+        self.t_r = t_r if t_r is not None else self.masker.t_r
+        self.warmup = warmup
+        mask_img = self.masker.mask_img_
+        self.mask = np.asarray(mask_img.dataobj).astype(bool)
+        self.affine = mask_img.affine
+        self.n_voxels = int(self.mask.sum())
+        self.fwhm = self.masker.smoothing_fwhm
+
+        # Only the voxels a tree reads, smoothed in their own small box (sparse.py), or every masked voxel
+        self.extractor = None
+        if fast:
+            spec = getattr(self.model, "voxel_spec_", None) or voxel_spec(self.model, self.masker)
+            if spec is None:
+                logging.warning("Model uses every voxel (PCA, a linear model or region features), real-time decoding uses the full volume")
+            else:
+                self.extractor = SparseVoxelExtractor(spec)
+        self.columns = self.extractor.spec["voxels"] if self.extractor is not None else None
+        self.cleaner = OnlineCleaner(len(self.columns) if self.extractor is not None else self.n_voxels, self.t_r,
+                                     detrend=self.masker.detrend, standardize=self.masker.standardize,
+                                     high_pass=self.masker.high_pass, low_pass=self.masker.low_pass)
+
+        # Region features: mean of the cleaned voxels per region, standardized with the training stats like X_regions.npy
+        self.regions = None
+        self.region_scaling = self.region_stats = None
+        n_inputs = getattr(self.model, "n_features_in_", self.n_voxels)
+        if n_inputs != self.n_voxels:
+            if regions_path is None or not os.path.exists(regions_path):
+                raise ValueError(f"Model expects {n_inputs} inputs, the mask has {self.n_voxels} voxels and no regions file was found")
+            voxel_region, region_ids, _ = load_regions(regions_path)
+            self.regions = averaging_matrix(voxel_region, len(region_ids)).T.tocsr()
+            stats = load_region_stats(regions_path)
+            if stats is not None:
+                mean, std = stats
+                self.region_scaling = mean, np.divide(1.0, std, out=np.zeros_like(std), where=std > 0)
+            else:
+                self.region_stats = OnlineCleaner(len(region_ids), self.t_r, detrend=False, standardize=True)
+        self.row = np.zeros((1, n_inputs), dtype=get_dtype())  # model input, reused for every volume
+        logging.info(f"Real-time decoder: {len(self.columns) if self.extractor is not None else self.n_voxels} of "
+                     f"{self.n_voxels} voxels per volume, TR {self.t_r}s, {warmup} warm-up volumes")
+
+    @classmethod
+    def from_job(cls, paths=None, **kwargs):
+        paths = paths if paths is not None else job_paths()
+        return cls(paths.processed("masker.joblib"), paths.output("decision_tree_model.joblib"),
+                   regions_path=paths.processed(REGIONS_FILE), **kwargs)
+
+    def voxels(self, volume):
+        """
+        Smoothed, masked values of one 3D volume (only the used voxels with fast=True).
+        """
+        if volume.shape != self.mask.shape:
+            raise ValueError(f"Volume shape {volume.shape} does not match the training mask {self.mask.shape}")
+        if self.extractor is None:
+            if self.fwhm is not None:
+                volume = smooth_array(volume, self.affine, fwhm=self.fwhm, ensure_finite=True, copy=True)
+            return volume[self.mask]
+        values = np.empty(len(self.extractor.center))
+        for n, (lo, hi, center) in enumerate(zip(self.extractor.lo, self.extractor.hi, self.extractor.center)):
+            box = volume[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+            if self.fwhm is not None:
+                box = smooth_array(box, self.affine, fwhm=self.fwhm, ensure_finite=True, copy=True)
+            values[n] = box[center[0], center[1], center[2]]
+        return values
+
+    def step(self, volume):
+        """
+        Add one volume to the running state and classify it. Returns (prediction or None during warm-up, preprocess s, predict s).
+        """
+        start = time.perf_counter()
+        cleaned = self.cleaner.update(self.voxels(volume))
+        if self.region_scaling is not None:
+            mean, inv_std = self.region_scaling
+            cleaned = (self.regions @ cleaned - mean) * inv_std
+        elif self.regions is not None:
+            cleaned = self.region_stats.update(self.regions @ cleaned)
+        preprocessed = time.perf_counter()
+        if self.cleaner.n <= self.warmup:
+            return None, preprocessed - start, 0.0
+        if self.columns is None:
+            self.row[0] = cleaned
+        else:
+            self.row[0, self.columns] = cleaned
+        prediction = self.model.predict(self.row)[0]
+        return prediction, preprocessed - start, time.perf_counter() - preprocessed
+
+
+def run_realtime(decoder, scan_path, speed=1.0, out_path=None, budget_fraction=REALTIME_PARAMS["budget_fraction"],
+                 events_file=None, hrf_shift=0.0, held_out=None):
+    """
+    Replay a scan through the decoder volume by volume. Returns the per-volume latency DataFrame
+    (also written to out_path) and a summary dict. events_file: labels of the volumes (default: the one next to the scan).
+    held_out: indices of the volumes the model was not trained on, the only ones scored (held_out_accuracy) when given,
+    otherwise every volume is (online_accuracy).
+    """
+    feed = ScannerFeed(scan_path, t_r=decoder.t_r, speed=speed)
+    budget_ms = decoder.t_r * budget_fraction * 1000
+
+    # Labels of the volumes from the events file next to the scan, if any (the task design is known in advance)
+    labels = np.full(feed.n_volumes, "", dtype=object)
+    events_file = events_file or events_path(scan_path)
+    if events_file is not None:
+        codes, categories = label_timepoints(pd.read_csv(events_file, sep="\t"), feed.n_volumes, decoder.t_r, hrf_shift=hrf_shift)
+        labels = decode_labels(codes, categories)
+
+    rows = []
+    with section("realtime", n_volumes=feed.n_volumes, speed=speed):
+        for i, volume, delivery in feed:
+            prediction, preprocess_s, predict_s = decoder.step(volume)
+            latency_s = time.perf_counter() - delivery
+            rows.append({
+                "volume": i,
+                "read_ms": feed.read_s[i] * 1000,
+                "preprocess_ms": preprocess_s * 1000,
+                "predict_ms": predict_s * 1000,
+                "latency_ms": latency_s * 1000,
+                "budget_ms": budget_ms,
+                "over_budget": latency_s * 1000 > budget_ms,
+                "warmup": prediction is None,
+                "y_true": labels[i],
+                "y_pred": prediction if prediction is not None else "",
+            })
+    latency_df = pd.DataFrame(rows)
+    if held_out is not None:
+        latency_df["held_out"] = latency_df["volume"].isin(held_out)
+
+    scored = latency_df[~latency_df["warmup"]]
+    task = scored[(scored["y_true"] != "") & (scored["y_true"] != "rest")]
+    if held_out is not None:
+        task = task[task["held_out"]]  # the training volumes would inflate the accuracy
+    summary = {
+        "volumes": len(latency_df),
+        "scored": len(scored),
+        "tr_ms": decoder.t_r * 1000,
+        "budget_ms": budget_ms,
+        "latency_p50_ms": float(scored["latency_ms"].median()) if len(scored) else None,
+        "latency_p95_ms": float(scored["latency_ms"].quantile(0.95)) if len(scored) else None,
+        "latency_max_ms": float(scored["latency_ms"].max()) if len(scored) else None,
+        "over_budget": int(scored["over_budget"].sum()),
+        "held_out_accuracy" if held_out is not None else "online_accuracy":
+            float((task["y_true"] == task["y_pred"]).mean()) if len(task) else None,
+        "accuracy_volumes": len(task),
+    }
+    if out_path is not None:
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        latency_df.to_csv(out_path, index=False)
+        logging.info(f"Per-volume latencies saved to {out_path}")
+    message = (f"Real-time decoding of {scan_path}: {summary['scored']} volumes scored, latency p50 {summary['latency_p50_ms']:.1f} ms, "
+               f"p95 {summary['latency_p95_ms']:.1f} ms, max {summary['latency_max_ms']:.1f} ms (budget {budget_ms:.0f} ms of a "
+               f"{summary['tr_ms']:.0f} ms TR), {summary['over_budget']} over budget, "
+               f"{'held-out' if held_out is not None else 'online'} accuracy over {summary['accuracy_volumes']} volumes") if len(scored) else f"Real-time decoding of {scan_path}: no volumes scored"
+    if summary["over_budget"]:
+        logging.warning(message)
+    else:
+        logging.info(message)
+    return latency_df, summary
+
+
+def replay_job(paths=None, scan_path=None, speed=1.0, fast=False, warmup=REALTIME_PARAMS["warmup"],
+               budget_fraction=REALTIME_PARAMS["budget_fraction"], hrf_shift=0.0, out_path=None):
+    """
+    Replay a scan (default: the job's extracted run, labeled from its events file) through the job's masker and model.
+    The job's own run is only scored on the volumes of the model's test split (held_out_accuracy in the summary).
+    Writes the latencies to out_path (default: the job's outputs/realtime_latency.csv). Returns the summary dict.
+    """
+    paths = paths if paths is not None else job_paths()
+    scan = scan_path or extracted_image_path(paths)
+    held_out = None
+    if scan_path is None:
+        # Volume index of every test row of X (rest volumes have no row, they are never scored)
+        _, test_idx = load_split(paths.output("split.npz"))
+        held_out = PipelineContext(paths).get_rows()[0][test_idx]
+    decoder = RealtimeDecoder.from_job(paths, t_r=tr_from_img(nib.load(scan), default=MASKER_PARAMS["t_r"]), fast=fast, warmup=warmup)
+    _, summary = run_realtime(decoder, scan, speed=speed, out_path=out_path or paths.output(LATENCY_FILE), budget_fraction=budget_fraction,
+                              events_file=None if scan_path else paths.extracted_events, hrf_shift=hrf_shift, held_out=held_out)
+    return summary
@@ -0,0 +1,259 @@
+'''
+Budgeted hyperparameter search for the classifier with successive halving.
+
+model.py trains one tree with max_depth=5. A full grid search would fit every candidate on all rows and voxels
+in every fold. Successive halving starts all candidates on a small budget and keeps only the best 1/factor
+of them for the next round, which gets factor times more budget:
+    - resource="samples": the budget is the number of training rows of each fold
+    - resource="features": the budget is the number of voxels, the best ones by ANOVA F-score on the fold's training rows
+Only the last round fits the few remaining candidates on the full data.
+
+Shared work is done once and cached:
+    - The folds (blocked time folds from crossval.py, on the training split of model.py only, so the test set stays unseen)
+    - Per fold, the training and test rows of X in the working precision, with rows shuffled (samples) or voxels sorted by F-score
+      (features), so every budget is a contiguous slice of one memory map
+The fold files are written to data/outputs/search_folds for the search and removed when it finishes. A copy is kept in
+the stage cache (pipeline/cache.py, entry "search_folds" keyed on X and the search settings), so later searches on the
+same data reuse it and old fold copies are evicted with the other cache entries (least recently used first).
+
+Candidates of a round are fitted in parallel with joblib (n_jobs workers), every worker reads the same memory maps.
+time_budget (seconds) stops the search after the round that would not fit in the remaining time,
+the best candidate of the last finished round wins.
+
+The best candidate is refitted on the full training split with build_model() and saved to
+decision_tree_model.joblib, so evaluate_model() and the visualizations use it unchanged.
+All rounds are saved to search_results.csv.
+
+Run main.py --search to execute this script.
+'''
+import os
+import json
+import math
+import time
+import shutil
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.tree import DecisionTreeClassifier, ExtraTreeClassifier
+from sklearn.model_selection import ParameterGrid
+from sklearn.feature_selection import f_classif
+from sklearn.metrics import accuracy_score
+from pipeline.context import PipelineContext
+from pipeline.matrix import take_rows, save_matrix, open_matrix
+from pipeline.precision import get_dtype
+from analysis.model import MODEL_PARAMS, split_indices, build_model
+from analysis.crossval import blocked_folds
+from etl.parcellate import warn_fitted_regions
+
+ESTIMATORS = {
+    "tree": DecisionTreeClassifier,
+    "extra_tree": ExtraTreeClassifier,  # random split thresholds, much faster to fit on many voxels
+}
+
+# Candidates: every combination of these values
+SEARCH_SPACE = dict(
+    estimator=["tree", "extra_tree"],
+    max_depth=[3, 5, 8, None],
+    min_samples_leaf=[1, 5, 10],
+    criterion=["gini", "entropy"],
+)
+
+SEARCH_PARAMS = dict(
+    resource="samples",   # budget on training rows (samples) or voxels (features)
+    factor=3,             # keep 1/factor of the candidates per round, factor times more budget
+    n_folds=3,
+    gap=5,
+    time_budget=None,     # seconds, None = no limit
+)
+RESOURCES = ("samples", "features")
+MIN_RESOURCE = {"samples": 20, "features": 10}
+
+
+def make_estimator(params):
+    """
+    Unfitted estimator for one candidate (params from SEARCH_SPACE).
+    """
+    params = dict(params)
+    estimator = ESTIMATORS[params.pop("estimator", "tree")]
+    return estimator(random_state=MODEL_PARAMS["random_state"], **params)
+
+
+def _cache_key(X, settings):
+    """
+    Key of the fold cache: the X file (or shape for an in-memory X) and the settings that change the cached arrays.
+    """
+    source = {"shape": list(X.shape), "dtype": str(X.dtype)}
+    filename = getattr(X, "filename", None)
+    if filename:
+        st = os.stat(filename)
+        source.update(path=os.path.abspath(filename), size=st.st_size, mtime=st.st_mtime_ns)
+    blob = json.dumps({"source": source, **settings}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()[:12]
+
+
+def fold_files(fold_dir, n_folds):
+    """
+    The files of prepared folds: X_train / X_test of every fold, then the fold indices (folds.npz).
+    """
+    files = []
+    for i in range(n_folds):
+        files += [os.path.join(fold_dir, f"X_train_{i}.npy"), os.path.join(fold_dir, f"X_test_{i}.npy")]
+    return files + [os.path.join(fold_dir, "folds.npz")]
+
+
+def prepare_folds(X, y, rows, timepoints, runs, resource, fold_dir, n_folds=3, gap=5, cache=None):
+    """
+    Build the per-fold training/test arrays shared by every candidate in fold_dir, or restore them from `cache`.
+    rows: the rows of X the search may use (the training split). Returns a list of fold dicts.
+    """
+    settings = {"rows": hashlib.sha256(np.asarray(rows).tobytes()).hexdigest(), "resource": resource,
+                "n_folds": n_folds, "gap": gap, "random_state": MODEL_PARAMS["random_state"]}
+    key = _cache_key(X, settings)
+    files = fold_files(fold_dir, n_folds)
+    meta_path = files[-1]
+
+    # --force model recomputes the folds too (and stores the new ones)
+    if cache is None or cache.is_forced("model") or not cache.restore("search_folds", key, files):
+        os.makedirs(fold_dir, exist_ok=True)
+        rng = np.random.default_rng(MODEL_PARAMS["random_state"])
+        meta = {}
+        for i, (train_pos, test_pos) in enumerate(blocked_folds(timepoints[rows], runs[rows], n_folds=n_folds, gap=gap)):
+            train_idx, test_idx = rows[train_pos], rows[test_pos]
+            columns = np.arange(X.shape[1])
+            if resource == "samples":
+                train_idx = rng.permutation(train_idx)  # every sample budget is a random subset: the first n rows
+            X_train = take_rows(X, train_idx, dtype=get_dtype())
+            if resource == "features":
+                # voxels sorted by F-score on this fold's training rows: every feature budget is the first k columns
+                scores, _ = f_classif(X_train, y[train_idx])
+                columns = np.argsort(-np.nan_to_num(scores, nan=-np.inf), kind="stable")
+                X_train = X_train[:, columns]
+            save_matrix(os.path.join(fold_dir, f"X_train_{i}.npy"), X_train)
+            save_matrix(os.path.join(fold_dir, f"X_test_{i}.npy"), take_rows(X, test_idx, dtype=get_dtype())[:, columns])
+            meta[f"train_{i}"], meta[f"test_{i}"], meta[f"columns_{i}"] = train_idx, test_idx, columns
+        np.savez(meta_path, n_folds=len(meta) // 3, **meta)
+        logging.info(f"Search folds prepared in {fold_dir}")
+        if cache is not None:
+            cache.store("search_folds", key, files, params=settings)
+    else:
+        logging.info(f"Search folds reused from the cache ({key})")
+
+    with np.load(meta_path) as meta:
+        return [{
+            "X_train": os.path.join(fold_dir, f"X_train_{i}.npy"),
+            "X_test": os.path.join(fold_dir, f"X_test_{i}.npy"),
+            "y_train": y[meta[f"train_{i}"]],
+            "y_test": y[meta[f"test_{i}"]],
+        } for i in range(int(meta["n_folds"]))]
+
+
+def _score(fold, params, resource, amount):
+    """
+    Fit one candidate on one fold with `amount` rows or voxels, return (test accuracy, fit seconds).
+    Runs in a joblib worker, the fold arrays are opened as memory maps.
+    """
+    X_train, X_test = open_matrix(fold["X_train"]), open_matrix(fold["X_test"])
+    y_train = fold["y_train"]
+    if resource == "samples":
+        X_train, y_train = X_train[:amount], y_train[:amount]
+    else:
+        X_train, X_test = X_train[:, :amount], X_test[:, :amount]
+    clf = make_estimator(params)
+    start = time.perf_counter()
+    clf.fit(np.asarray(X_train), y_train)
+    fit_seconds = time.perf_counter() - start
+    return accuracy_score(fold["y_test"], clf.predict(np.asarray(X_test))), fit_seconds
+
+
+def successive_halving(folds, candidates, resource, max_resource, factor=3, n_jobs=1, time_budget=None):
+    """
+    Successive halving over candidates (list of param dicts). Returns (best params, results DataFrame).
+    """
+    min_resource = min(MIN_RESOURCE[resource], max_resource)
+    n_rounds = 1 + int(math.floor(math.log(len(candidates), factor))) if len(candidates) > 1 else 1
+    n_rounds = min(n_rounds, 1 + int(math.floor(math.log(max_resource / min_resource, factor))))
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+
+    alive = list(range(len(candidates)))
+    rows, best = [], None
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for rnd in range(n_rounds):
+            amount = int(max_resource * factor ** (rnd - n_rounds + 1)) if rnd < n_rounds - 1 else max_resource
+            amount = max(amount, min_resource)
+            round_start = time.monotonic()
+            scores = parallel(
+                delayed(_score)(fold, candidates[c], resource, amount) for c in alive for fold in folds
+            )
+            round_seconds = time.monotonic() - round_start
+
+            n_folds = len(folds)
+            means = {}
+            for i, c in enumerate(alive):
+                fold_scores = np.array([s for s, _ in scores[i * n_folds:(i + 1) * n_folds]])
+                fit_seconds = sum(t for _, t in scores[i * n_folds:(i + 1) * n_folds])
+                means[c] = fold_scores.mean()
+                rows.append({"round": rnd, "candidate": c, "params": json.dumps(candidates[c]), "resource": resource,
+                             "n_resource": amount, "mean_accuracy": means[c], "std_accuracy": fold_scores.std(),
+                             "fit_seconds": round(fit_seconds, 4)})
+
+            # Best first, ties keep the candidate order
+            ranked = sorted(alive, key=lambda c: -means[c])
+            best = ranked[0]
+            logging.info(f"Search round {rnd}: {len(alive)} candidates on {amount} {resource}, "
+                         f"best accuracy {means[best]:.3f} ({candidates[best]}), {round_seconds:.1f}s")
+
+            alive = ranked[:max(1, math.ceil(len(alive) / factor))]
+            if deadline is not None and rnd < n_rounds - 1 and time.monotonic() + round_seconds * factor > deadline:
+                # the next round has 1/factor of the candidates on factor times the budget: about as long, estimated with margin
+                logging.warning(f"Search time budget ({time_budget:.1f}s left at the start) reached after round {rnd}, keeping its best candidate")
+                break
+
+    return candidates[best], pd.DataFrame(rows)
+
+
+def search_model(ctx=None, space=None, resource=None, factor=None, n_folds=None, gap=None, time_budget=None, n_jobs=1):
+    """
+    Search the hyperparameters on the training split, then train and save the best model like build_model().
+    """
+    if ctx is None:
+        ctx = PipelineContext()
+    space = SEARCH_SPACE if space is None else space
+    resource = SEARCH_PARAMS["resource"] if resource is None else resource
+    factor = SEARCH_PARAMS["factor"] if factor is None else factor
+    n_folds = SEARCH_PARAMS["n_folds"] if n_folds is None else n_folds
+    gap = SEARCH_PARAMS["gap"] if gap is None else gap
+    time_budget = SEARCH_PARAMS["time_budget"] if time_budget is None else time_budget
+    if resource not in RESOURCES:
+        raise ValueError(f"Unknown search resource '{resource}', expected one of {RESOURCES}")
+    outputs_dir = ctx.paths.outputs_dir
+    os.makedirs(outputs_dir, exist_ok=True)
+
+    X, y = ctx.get_X(), ctx.get_y()
+    warn_fitted_regions(ctx, "Hyperparameter search")
+    timepoints, runs = ctx.get_rows()
+    train_idx, _ = split_indices(len(y))
+    candidates = list(ParameterGrid(space))
+    logging.info(f"Hyperparameter search: {len(candidates)} candidates, resource {resource}, factor {factor}, "
+                 f"{n_folds} folds, {n_jobs} workers, time budget {'none' if time_budget is None else f'{time_budget}s'}")
+
+    # Folds only use the training split (sorted, so blocked folds follow time)
+    start = time.monotonic()
+    fold_dir = os.path.join(outputs_dir, "search_folds")
+    try:
+        folds = prepare_folds(X, y, np.sort(train_idx), timepoints, runs, resource, fold_dir,
+                              n_folds=n_folds, gap=gap, cache=ctx.cache)
+        max_resource = min(len(fold["y_train"]) for fold in folds) if resource == "samples" else X.shape[1]
+        remaining = None if time_budget is None else max(time_budget - (time.monotonic() - start), 0)
+        best, results = successive_halving(folds, candidates, resource, max_resource, factor=factor,
+                                           n_jobs=n_jobs, time_budget=remaining)
+    finally:
+        shutil.rmtree(fold_dir, ignore_errors=True)  # the cache entry (if any) keeps its own links to the files
+
+    results_path = os.path.join(outputs_dir, "search_results.csv")
+    results.to_csv(results_path, index=False)
+    logging.info(f"Best candidate {best}, search results saved to {results_path}")
+
+    # Refit the best candidate on the full training split and save it where evaluate_model() loads the model
+    return build_model(ctx, clf=make_estimator(best))
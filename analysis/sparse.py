@@ -0,0 +1,146 @@
+'''
+Sparse-voxel fast path for tree inference.
+
+A depth-5 tree splits on at most 31 voxels, but inference.py preprocesses every masked voxel of a new scan.
+All preprocessing steps are local, so the voxels a tree reads can be computed on their own:
+    - Gaussian smoothing only mixes voxels within int(4 * sigma + 0.5) voxels per axis (scipy's truncate=4),
+      so smoothing a small box around a voxel gives exactly the same value at its center
+    - Detrending, filtering and standardization (signal.clean) work per voxel
+voxel_spec() records, on the saved model, which masked voxels the tree uses, where they are in the image and
+the smoothing box and filters each one needs. SparseVoxelExtractor reads only those boxes from a new 4D image,
+smooths and cleans them, and gives the model a sparse (timepoints x voxels) matrix with only the used columns filled,
+so per-scan inference cost scales with the model size instead of the brain size.
+Uncompressed .nii scans are read box by box (only the needed parts of the file), .nii.gz scans still have to be
+decompressed once, slab by slab.
+
+Models with PCA feature reduction and linear models (incremental.py) use every voxel and have no sparse path
+(voxel_spec() returns None).
+
+Run main.py predict --fast or main.py realtime --fast to execute this script.
+'''
+import logging
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from nilearn import signal
+from nilearn.image import load_img
+from nilearn.image.image import smooth_array
+from sklearn.pipeline import Pipeline
+from etl.streaming import iter_volume_slabs
+from analysis.features import final_estimator
+
+TRUNCATE = 4.0  # scipy.ndimage.gaussian_filter1d default, used by nilearn's smoothing
+
+
+def used_voxels(model):
+    """
+    Sorted masked-voxel indices the model's splits read, None if the model needs every voxel (PCA, linear models).
+    """
+    tree = final_estimator(model)
+    if not hasattr(tree, "tree_"):
+        return None
+    features = np.unique(tree.tree_.feature[tree.tree_.feature >= 0])
+    if isinstance(model, Pipeline):
+        reducer = model.named_steps["reduce"]
+        if not hasattr(reducer, "get_support"):
+            return None
+        features = reducer.get_support(indices=True)[features]  # reduced input columns -> voxel indices
+    return features.astype(np.int64)
+
+
+def smoothing_radius(affine, fwhm):
+    """
+    Half-size (voxels, per axis) of the neighbourhood that Gaussian smoothing with this fwhm mixes into a voxel.
+    """
+    if fwhm is None or fwhm == 0:
+        return np.zeros(3, dtype=int)
+    vox_size = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+    sigma = np.broadcast_to(np.asarray(fwhm, dtype=float), (3,)) / (np.sqrt(8 * np.log(2)) * vox_size)
+    return np.array([int(TRUNCATE * s + 0.5) if s > 0 else 0 for s in sigma])
+
+
+def voxel_spec(model, masker):
+    """
+    What the sparse path needs to compute the model's inputs: used voxels, their (i, j, k) position,
+    the smoothing radius and the signal cleaning parameters. None for models that use every voxel or region features.
+    """
+    mask_img = masker.mask_img_
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    if getattr(model, "n_features_in_", mask.sum()) != mask.sum():
+        return None  # trained on region features (etl/parcellate.py), its inputs are not voxels
+    voxels = used_voxels(model)
+    if voxels is None:
+        return None
+    return {
+        "voxels": voxels,
+        "ijk": np.argwhere(mask)[voxels],  # masked voxels are in C order of the mask, like NiftiMasker
+        "n_voxels": int(mask.sum()),
+        "shape": mask.shape,
+        "affine": mask_img.affine,
+        "smoothing_fwhm": masker.smoothing_fwhm,
+        "radius": smoothing_radius(mask_img.affine, masker.smoothing_fwhm),
+        "clean": dict(detrend=masker.detrend, standardize=masker.standardize,
+                      low_pass=masker.low_pass, high_pass=masker.high_pass, t_r=masker.t_r),
+    }
+
+
+class SparseVoxelExtractor:
+    """
+    Computes only the model's input voxels of new scans (same values as the full NiftiMasker preprocessing).
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        shape = np.asarray(spec["shape"])
+        radius = spec["radius"]
+        # Smoothing box of every used voxel, clipped to the image (at the edges scipy reflects inside the image, like the full volume)
+        self.lo = np.maximum(spec["ijk"] - radius, 0)
+        self.hi = np.minimum(spec["ijk"] + radius + 1, shape)
+        self.center = spec["ijk"] - self.lo
+
+    def _boxes_direct(self, img):
+        # Uncompressed file: nibabel reads just the bytes of each box
+        return [np.asarray(img.dataobj[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2], :]) for lo, hi in zip(self.lo, self.hi)]
+
+    def _boxes_slabs(self, img):
+        # Compressed file: one sequential pass over slabs of volumes, keeping only the boxes
+        n_volumes = img.shape[3]
+        boxes = None
+        for start, stop, slab in iter_volume_slabs(img):
+            if boxes is None:
+                boxes = [np.empty(tuple(hi - lo) + (n_volumes,), dtype=slab.dtype) for lo, hi in zip(self.lo, self.hi)]
+            for box, lo, hi in zip(boxes, self.lo, self.hi):
+                box[..., start:stop] = slab[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        return boxes
+
+    def transform(self, img, t_r=None):
+        """
+        Preprocessed time series of the used voxels, shape (timepoints, n_used).
+        t_r: repetition time of this scan (the training TR if None).
+        """
+        img = load_img(img)
+        if img.shape[:3] != tuple(self.spec["shape"]):
+            raise ValueError(f"Scan shape {img.shape[:3]} does not match the training mask {tuple(self.spec['shape'])}")
+        uncompressed = isinstance(img, nib.Nifti1Image) and nib.is_proxy(img.dataobj) and not str(img.get_filename()).endswith(".gz")
+        boxes = self._boxes_direct(img) if uncompressed else self._boxes_slabs(img)
+
+        series = np.empty((img.shape[3], len(boxes)), dtype=np.float64)
+        for n, (box, center) in enumerate(zip(boxes, self.center)):
+            if self.spec["smoothing_fwhm"] is not None:
+                box = smooth_array(box, img.affine, fwhm=self.spec["smoothing_fwhm"], ensure_finite=True, copy=False)
+            series[:, n] = box[center[0], center[1], center[2], :]
+
+        clean = {**self.spec["clean"], "t_r": t_r if t_r is not None else self.spec["clean"]["t_r"]}
+        return signal.clean(series, standardize_confounds=True, **clean)
+
+    def transform_sparse(self, img, t_r=None):
+        """
+        (timepoints x all masked voxels) CSR matrix with only the used voxels filled, ready for model.predict().
+        """
+        series = self.transform(img, t_r)
+        n_timepoints, n_used = series.shape
+        rows = np.repeat(np.arange(n_timepoints), n_used)
+        cols = np.tile(self.spec["voxels"], n_timepoints)
+        X = sparse.csr_matrix((series.ravel(), (rows, cols)), shape=(n_timepoints, self.spec["n_voxels"]))
+        logging.info(f"Sparse voxel path: {n_used} of {self.spec['n_voxels']} voxels computed for {n_timepoints} timepoints")
+        return X
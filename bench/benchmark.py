@@ -0,0 +1,259 @@
+'''
+Offline benchmark suite: stage timings across data scales, saved for regression comparison.
+
+For every scale (bench/synthetic.py SCALES, or a custom grid) the suite writes a synthetic run into
+data/benchmarks/<scale>/ and runs the stages there, without the stage cache and without the network:
+    extract_data, transform_data, build_model, evaluate_model, create_visualizations (1 worker, every figure rendered)
+Each stage runs `repeats` times in a profiling section (pipeline/profiling.py), so the results hold wall/CPU time,
+peak memory and I/O for the stage and its key steps (fit_transform, clf.fit, ...). The median over the repeats is
+the stage's time, together with its throughput in voxel-timepoints per second: the scaling curve of the stage.
+
+Results go to one JSON file (data/benchmarks/results/<label>.json) with the machine and library versions.
+--compare BASELINE.json compares the run with an earlier one and exits with status 1 when a stage got
+slower than the threshold (default 20%) at any scale, so it can gate changes in CI. --plot writes
+the scaling curves (time vs. voxel-timepoints, log-log) next to the results.
+
+Run python -m bench.benchmark [--scales tiny small medium] [--repeats 3] [--compare old.json] to execute this script.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import platform
+import subprocess
+import numpy as np
+from pipeline.context import PipelineContext
+from pipeline.profiling import Profiler, set_profiler
+from bench.synthetic import SCALES, SYNTHETIC_PARAMS, generate
+
+BENCH_DIR = os.path.join("data", "benchmarks")
+BENCH_STAGES = ("extract", "transform", "model", "evaluate", "visualize")
+DEFAULT_SCALES = ("tiny", "small", "medium")
+DEFAULT_REPEATS = 3
+DEFAULT_THRESHOLD = 0.2  # a stage more than 20% slower than the baseline is a regression
+MIN_SECONDS = 0.05       # stages faster than this are too noisy to compare
+
+
+def stage_functions(ctx):
+    """
+    The benchmarked stage functions, in pipeline order, each running on the job of ctx.
+    """
+    # Imported here so the generator and the comparison work without the whole pipeline stack
+    from etl import extract, transform, load
+    from analysis import model, evaluate
+    from vis import visualizations
+
+    def run_model():
+        load.load_data(ctx)
+        return model.build_model(ctx)
+
+    return {
+        "extract": lambda: extract.extract_data(ctx),
+        "transform": lambda: transform.transform_data(ctx=ctx),
+        "model": run_model,
+        "evaluate": lambda: evaluate.evaluate_model(ctx),
+        "visualize": lambda: visualizations.create_visualizations(ctx, workers=1, force=True),
+    }
+
+
+def environment():
+    """
+    Machine and library versions the benchmark ran on (timings are only comparable on the same setup).
+    """
+    import sklearn
+    import nilearn
+    import nibabel
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "sklearn": sklearn.__version__,
+        "nilearn": nilearn.__version__,
+        "nibabel": nibabel.__version__,
+        "commit": commit,
+    }
+
+
+def bench_scale(name, shape, n_timepoints, repeats=DEFAULT_REPEATS, bench_dir=BENCH_DIR, stages=BENCH_STAGES, **synthetic):
+    """
+    Generate one scale and time every stage `repeats` times. Returns the scale's result dict.
+    """
+    data_dir = os.path.join(bench_dir, name)
+    shutil.rmtree(data_dir, ignore_errors=True)  # a clean directory, no outputs left from another scale or run
+    paths = generate(shape=shape, n_timepoints=n_timepoints, data_dir=data_dir, raw_dir=os.path.join(data_dir, "raw"), **synthetic)[0]
+    paths.make_dirs()
+    n_voxels = int(np.prod(shape))
+
+    profiler = Profiler(scale=name)
+    previous = set_profiler(profiler)
+    try:
+        for repeat in range(repeats):
+            ctx = PipelineContext(paths)  # nothing carried over in memory between repeats
+            funcs = stage_functions(ctx)
+            for stage in stages:
+                with profiler.section(stage, repeat=repeat):
+                    funcs[stage]()
+    finally:
+        set_profiler(previous)
+
+    # Median over the repeats of every stage, and of every step inside it
+    results = {}
+    for record in profiler.records:
+        key = record["name"] if record["parent"] is None else f"{record['parent']}/{record['name']}"
+        results.setdefault(key, []).append(record)
+    summary = {}
+    for key, records in results.items():
+        wall = np.median([r["wall_s"] for r in records])
+        summary[key] = {
+            "wall_s": round(float(wall), 4),
+            "wall_min_s": min(r["wall_s"] for r in records),
+            "cpu_s": round(float(np.median([r["cpu_s"] for r in records])), 4),
+            "peak_rss_mb": max(r["peak_rss_mb"] for r in records),
+            "read_bytes": int(np.median([r["read_bytes"] for r in records])),
+            "write_bytes": int(np.median([r["write_bytes"] for r in records])),
+            "voxel_timepoints_per_s": round(n_voxels * n_timepoints / wall, 1) if wall > 0 else None,
+            "repeats": len(records),
+        }
+    logging.info(f"Benchmark {name}: " + ", ".join(f"{s} {summary[s]['wall_s']:.2f}s" for s in stages))
+    return {"shape": list(shape), "n_voxels": n_voxels, "n_timepoints": n_timepoints, "stages": summary}
+
+
+def run_benchmarks(scales=DEFAULT_SCALES, repeats=DEFAULT_REPEATS, bench_dir=BENCH_DIR, custom=None, **synthetic):
+    """
+    Benchmark every scale. custom: extra {name: {"shape": ..., "n_timepoints": ...}} scales. Returns the results dict.
+    """
+    all_scales = {**SCALES, **(custom or {})}
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    results = {name: bench_scale(name, all_scales[name]["shape"], all_scales[name]["n_timepoints"],
+                                 repeats=repeats, bench_dir=bench_dir, **synthetic)
+               for name in scales}
+    return {"started": started, "repeats": repeats, "synthetic": {**SYNTHETIC_PARAMS, **synthetic},
+            "environment": environment(), "scales": results}
+
+
+def save_results(results, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Benchmark results saved to {path}")
+    return path
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, min_seconds=MIN_SECONDS):
+    """
+    Stage-by-stage comparison of two results dicts (scales and stages in both).
+    Returns a list of rows (scale, stage, baseline_s, current_s, ratio, regression).
+    """
+    rows = []
+    for scale, result in current["scales"].items():
+        base_scale = baseline["scales"].get(scale)
+        if base_scale is None:
+            continue
+        for stage, stats in result["stages"].items():
+            base = base_scale["stages"].get(stage)
+            if base is None or "/" in stage:  # steps inside a stage are reported, not compared
+                continue
+            ratio = stats["wall_s"] / base["wall_s"] if base["wall_s"] > 0 else float("inf")
+            regression = ratio > 1 + threshold and stats["wall_s"] - base["wall_s"] > min_seconds
+            rows.append((scale, stage, base["wall_s"], stats["wall_s"], ratio, regression))
+    return rows
+
+
+def format_table(results, stages=BENCH_STAGES):
+    """
+    Scaling table: one row per stage, the median seconds at every scale.
+    """
+    scales = list(results["scales"])
+    header = f"{'stage':<12}" + "".join(f"{s + ' (' + str(results['scales'][s]['n_voxels'] * results['scales'][s]['n_timepoints']) + ')':>24}" for s in scales)
+    lines = [header]
+    for stage in stages:
+        cells = []
+        for scale in scales:
+            stats = results["scales"][scale]["stages"].get(stage)
+            cells.append(f"{stats['wall_s']:>22.3f}s" if stats else f"{'-':>23}")
+        lines.append(f"{stage:<12}" + "".join(cells))
+    return "\n".join(lines)
+
+
+def plot_scaling(results, out_path, stages=BENCH_STAGES):
+    """
+    Log-log plot of stage time vs. voxel-timepoints, one line per stage.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    sizes = {s: r["n_voxels"] * r["n_timepoints"] for s, r in results["scales"].items()}
+    order = sorted(sizes, key=sizes.get)
+    plt.figure(figsize=(8, 6))
+    for stage in stages:
+        points = [(sizes[s], results["scales"][s]["stages"][stage]["wall_s"]) for s in order if stage in results["scales"][s]["stages"]]
+        if points:
+            plt.plot(*zip(*points), marker="o", label=stage)
+    plt.xscale("log")
+    plt.yscale("log")
+    plt.xlabel("Voxel-timepoints (grid voxels x timepoints)")
+    plt.ylabel("Median wall time (s)")
+    plt.title("Stage scaling on synthetic data")
+    plt.legend()
+    plt.tight_layout()
+    plt.savefig(out_path)
+    plt.close()
+    logging.info(f"Scaling plot saved to {out_path}")
+    return out_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data across scales")
+    parser.add_argument("--scales", nargs="+", default=list(DEFAULT_SCALES), help=f"Scales to run, from {list(SCALES)} or custom NAME=XxYxZxT (e.g. wide=48x48x30x120)")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="Runs per stage, the median is reported")
+    parser.add_argument("--tr", type=float, default=SYNTHETIC_PARAMS["tr"])
+    parser.add_argument("--trial-types", type=int, default=SYNTHETIC_PARAMS["n_trial_types"])
+    parser.add_argument("--bench-dir", default=BENCH_DIR, help="Where the synthetic jobs and the results are written")
+    parser.add_argument("--label", help="Results file name (default: timestamp)")
+    parser.add_argument("--compare", metavar="BASELINE_JSON", help="Compare with earlier results, exit 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Slowdown ratio counted as a regression (0.2 = 20%%)")
+    parser.add_argument("--plot", action="store_true", help="Also save the scaling curves as a PNG")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+
+    names, custom = [], {}
+    for spec in args.scales:
+        if "=" in spec:
+            name, dims = spec.split("=", 1)
+            x, y, z, t = (int(d) for d in dims.lower().split("x"))
+            custom[name] = {"shape": (x, y, z), "n_timepoints": t}
+            names.append(name)
+        elif spec in SCALES:
+            names.append(spec)
+        else:
+            parser.error(f"Unknown scale '{spec}', expected one of {list(SCALES)} or NAME=XxYxZxT")
+
+    results = run_benchmarks(names, repeats=args.repeats, bench_dir=args.bench_dir, custom=custom,
+                             tr=args.tr, n_trial_types=args.trial_types)
+    out_path = os.path.join(args.bench_dir, "results", f"{args.label or time.strftime('%Y%m%d-%H%M%S')}.json")
+    save_results(results, out_path)
+    print(format_table(results))
+    if args.plot:
+        plot_scaling(results, out_path[:-len(".json")] + ".png")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare(baseline, results, threshold=args.threshold)
+        print(f"\n{'scale':<10}{'stage':<12}{'baseline':>10}{'current':>10}{'ratio':>8}")
+        for scale, stage, base_s, cur_s, ratio, regression in rows:
+            print(f"{scale:<10}{stage:<12}{base_s:>9.3f}s{cur_s:>9.3f}s{ratio:>8.2f}" + ("  REGRESSION" if regression else ""))
+        if any(row[-1] for row in rows):
+            sys.exit(1)
@@ -0,0 +1,146 @@
+'''
+Synthetic ds000011-like fMRI data, so the pipeline and the benchmarks run without the S3 download.
+
+generate() writes, for every run of a job, a 4D NIfTI (<prefix>_bold.nii.gz) and a BIDS events.tsv
+(<prefix>_events.tsv) into the raw directory and marks them complete like a verified download
+(etl/download.py mark_complete), so extract_data() uses them as they are and never goes to the network.
+
+The images look enough like BOLD data for every stage to do real work:
+    - An ellipsoid "brain" at ~100 with Gaussian noise around it, so compute_epi_mask finds it
+    - A slow drift per voxel (removed by detrending)
+    - Blocks of trials cycling through n_trial_types conditions with jittered gaps, each condition adds
+      a boxcar to its own slab of the brain, so the decision tree has something to learn
+Everything is configurable: grid size, number of timepoints, TR, trial types and runs. SCALES are the
+presets the benchmark suite sweeps (bench/benchmark.py), "full" is about the size of a ds000011 run.
+
+Run python -m bench.synthetic --scale small (or --shape X Y Z --timepoints T ...) to execute this script.
+'''
+import os
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from pipeline.paths import job_paths, DEFAULT_SUBJECT, DEFAULT_TASK
+from etl.download import mark_complete
+
+# Benchmark presets: voxel grid, timepoints (full is about one ds000011 run, 64 x 64 x 30 voxels)
+SCALES = {
+    "tiny": {"shape": (16, 16, 12), "n_timepoints": 80},
+    "small": {"shape": (24, 24, 18), "n_timepoints": 120},
+    "medium": {"shape": (40, 40, 24), "n_timepoints": 160},
+    "full": {"shape": (64, 64, 30), "n_timepoints": 240},
+}
+
+SYNTHETIC_PARAMS = {
+    "tr": 2.0,
+    "n_trial_types": 3,
+    "n_runs": 1,
+    "voxel_size": 3.0,     # mm
+    "trial_duration": 6.0, # seconds
+    "signal": 3.0,         # boxcar amplitude, the noise standard deviation is 1
+    "seed": 42,
+}
+
+
+def trial_type_names(n_trial_types):
+    return [f"condition_{k + 1}" for k in range(n_trial_types)]
+
+
+def make_events(n_timepoints, tr=SYNTHETIC_PARAMS["tr"], n_trial_types=SYNTHETIC_PARAMS["n_trial_types"],
+                trial_duration=SYNTHETIC_PARAMS["trial_duration"], rng=None):
+    """
+    BIDS events (onset, duration, trial_type) cycling through the trial types, with jittered rest gaps.
+    """
+    rng = rng if rng is not None else np.random.default_rng(SYNTHETIC_PARAMS["seed"])
+    names = trial_type_names(n_trial_types)
+    events = []
+    onset = 2 * tr
+    while onset + trial_duration < n_timepoints * tr:
+        events.append((round(onset, 3), trial_duration, names[len(events) % n_trial_types]))
+        onset += trial_duration + rng.uniform(2, 3) * tr
+    return pd.DataFrame(events, columns=["onset", "duration", "trial_type"])
+
+
+def make_image(events, shape, n_timepoints, tr=SYNTHETIC_PARAMS["tr"], n_trial_types=SYNTHETIC_PARAMS["n_trial_types"],
+               voxel_size=SYNTHETIC_PARAMS["voxel_size"], signal=SYNTHETIC_PARAMS["signal"], rng=None):
+    """
+    4D float32 image: noisy ellipsoid brain with a drift, and a boxcar per trial in the slab of its condition.
+    Built volume by volume, the peak memory is the image itself.
+    """
+    rng = rng if rng is not None else np.random.default_rng(SYNTHETIC_PARAMS["seed"])
+    shape = tuple(int(s) for s in shape)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    brain = sum(((g - s / 2) / (s / 2.5)) ** 2 for g, s in zip(grid, shape)) < 1
+
+    # Every condition activates its own slab of the brain along the first axis
+    names = trial_type_names(n_trial_types)
+    slabs = np.array_split(np.arange(shape[0]), n_trial_types)
+    regions = {name: brain & np.isin(np.arange(shape[0]), slab)[:, None, None] for name, slab in zip(names, slabs)}
+
+    # Condition active at each timepoint (same onset/duration rounding as etl/labels.py)
+    active = np.full(n_timepoints, None, dtype=object)
+    for onset, duration, trial_type in events.itertuples(index=False):
+        active[int(onset // tr):int((onset + duration) // tr)] = trial_type
+
+    data = np.empty(shape + (n_timepoints,), dtype=np.float32)
+    drift = rng.normal(0, 0.5, shape).astype(np.float32)
+    for t in range(n_timepoints):
+        volume = rng.standard_normal(shape, dtype=np.float32)
+        volume[brain] += 100 + drift[brain] * t / n_timepoints
+        if active[t] is not None:
+            volume[regions[active[t]]] += signal
+        data[..., t] = volume
+
+    img = nib.Nifti1Image(data, np.diag([voxel_size] * 3 + [1.0]))
+    img.header.set_xyzt_units("mm", "sec")
+    img.header.set_zooms((voxel_size,) * 3 + (tr,))
+    return img
+
+
+def generate(subject=DEFAULT_SUBJECT, task=DEFAULT_TASK, shape=SCALES["small"]["shape"], n_timepoints=SCALES["small"]["n_timepoints"],
+             tr=SYNTHETIC_PARAMS["tr"], n_trial_types=SYNTHETIC_PARAMS["n_trial_types"], n_runs=SYNTHETIC_PARAMS["n_runs"],
+             data_dir=None, raw_dir=None, seed=SYNTHETIC_PARAMS["seed"]):
+    """
+    Write synthetic raw files for n_runs runs of a job (no run number if n_runs is 1) and mark them complete.
+    data_dir / raw_dir as in job_paths() (default: the usual data/ layout). Returns the JobPaths of every run.
+    """
+    runs = [None] if n_runs == 1 else list(range(1, n_runs + 1))
+    paths_list = []
+    for n, run in enumerate(runs):
+        rng = np.random.default_rng([seed, n])
+        paths = job_paths(subject, task, run, data_dir=data_dir, raw_dir=raw_dir)
+        os.makedirs(paths.raw_dir, exist_ok=True)
+        events = make_events(n_timepoints, tr, n_trial_types, rng=rng)
+        make_image(events, shape, n_timepoints, tr, n_trial_types, rng=rng).to_filename(paths.raw_nii)
+        events.to_csv(paths.raw_events, sep="\t", index=False)
+        for raw_file in (paths.raw_nii, paths.raw_events):
+            mark_complete(raw_file)
+        logging.info(f"Synthetic run written: {paths.raw_nii} ({shape} x {n_timepoints} timepoints, {len(events)} trials)")
+        paths_list.append(paths)
+    return paths_list
+
+
+if __name__ == "__main__":
+    from pipeline.paths import parse_job
+
+    parser = argparse.ArgumentParser(description="Write synthetic fMRI runs (NIfTI + events.tsv) in place of the ds000011 download")
+    parser.add_argument("--job", metavar="SUBJECT:TASK", help="Subject and task to write (default: the default job), runs come from --runs")
+    parser.add_argument("--scale", choices=SCALES, default="small", help="Preset grid size and timepoints")
+    parser.add_argument("--shape", type=int, nargs=3, metavar=("X", "Y", "Z"), help="Voxel grid (overrides --scale)")
+    parser.add_argument("--timepoints", type=int, help="Number of volumes (overrides --scale)")
+    parser.add_argument("--tr", type=float, default=SYNTHETIC_PARAMS["tr"], help="Repetition time in seconds")
+    parser.add_argument("--trial-types", type=int, default=SYNTHETIC_PARAMS["n_trial_types"], help="Number of conditions")
+    parser.add_argument("--runs", type=int, default=SYNTHETIC_PARAMS["n_runs"], help="Number of runs (run-01, run-02, ... if more than 1)")
+    parser.add_argument("--data-dir", help="Per-job data directory (default: the job's usual directory)")
+    parser.add_argument("--raw-dir", help="Where to write the raw files (default: data/raw)")
+    parser.add_argument("--seed", type=int, default=SYNTHETIC_PARAMS["seed"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+
+    subject, task = parse_job(args.job)[:2] if args.job else (DEFAULT_SUBJECT, DEFAULT_TASK)
+    scale = SCALES[args.scale]
+    for paths in generate(subject, task, shape=tuple(args.shape or scale["shape"]), n_timepoints=args.timepoints or scale["n_timepoints"],
+                          tr=args.tr, n_trial_types=args.trial_types, n_runs=args.runs,
+                          data_dir=args.data_dir, raw_dir=args.raw_dir, seed=args.seed):
+        print(f"{paths.raw_nii}\n{paths.raw_events}")
@@ -0,0 +1,57 @@
+'''
+Single-pass grouped aggregation of the voxel x time matrix per trial type (condition).
+
+transform.py used to loop over the trial types twice and take a boolean fancy-index copy
+voxel_vs_time[trial_mask_type, :] for every one of them, copying the whole matrix once per label.
+condition_stats() reads X once, in blocks of voxels, and gets every condition at the same time
+with a sparse (conditions x timepoints) indicator matrix:
+    - counts: number of timepoints per condition
+    - means: per-voxel mean per condition (conditions x voxels) -> condition maps
+    - variances: per-voxel variance per condition (two-pass within each block, so no precision loss)
+The scalar summaries (mean BOLD per trial type) are derived from these without touching X again.
+
+Run main.py (transform step) to execute this script.
+'''
+import numpy as np
+from scipy import sparse
+from pipeline.matrix import iter_cols
+
+
+def condition_stats(X, codes, n_groups, chunk_cols=None):
+    """
+    Per-condition counts, means and variances of X (timepoints x voxels).
+    codes: condition index per timepoint (negative = not in any condition, e.g. rest).
+    Returns (counts, means, variances), means/variances have shape (n_groups, n_voxels).
+    """
+    codes = np.asarray(codes)
+    rows = np.flatnonzero(codes >= 0)
+    groups = codes[rows]
+    counts = np.bincount(groups, minlength=n_groups)
+
+    # Indicator (conditions x condition timepoints) scaled by 1/count, so indicator @ block gives the group means directly
+    scale = 1.0 / np.maximum(counts, 1)
+    indicator = sparse.csr_matrix(
+        (scale[groups], (groups, np.arange(len(rows)))), shape=(n_groups, len(rows))
+    )
+
+    means = np.zeros((n_groups, X.shape[1]), dtype=np.float64)
+    variances = np.zeros((n_groups, X.shape[1]), dtype=np.float64)
+    for start, stop, block in iter_cols(X, chunk_cols):
+        block = np.asarray(block[rows], dtype=np.float64)  # only the condition timepoints of this block
+        block_means = indicator @ block
+        means[:, start:stop] = block_means
+        centered = block - block_means[groups]
+        np.multiply(centered, centered, out=centered)
+        variances[:, start:stop] = indicator @ centered
+    return counts, means, variances
+
+
+def condition_summary(counts, means, variances):
+    """
+    Scalar summaries per condition over all voxels: (mean, std) of every voxel value at the condition's timepoints.
+    Same as voxel_vs_time[trial_mask_type, :].mean() / .std(), from the per-voxel statistics.
+    """
+    grand_mean = means.mean(axis=1)
+    # total variance = mean within-voxel variance + variance of the voxel means
+    grand_var = variances.mean(axis=1) + means.var(axis=1)
+    return grand_mean, np.sqrt(grand_var)
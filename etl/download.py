@@ -0,0 +1,223 @@
+'''
+Download manager for the OpenNeuro (S3) flat files.
+
+Replaces the one-file-at-a-time download in extract.py:
+    - Many files are fetched concurrently with a bounded thread pool
+    - Partial downloads are kept as <file>.part and resumed with HTTP Range requests
+    - Files are streamed with a 1 MB buffer instead of 8 KB chunks
+    - Size (Content-Length) and checksum (sha256, or the S3 ETag md5 for single-part uploads) are verified
+      before a file is marked complete with a <file>.sha256 sidecar
+A file without its sidecar is never treated as complete, so a truncated file from an interrupted run is resumed, not reused.
+The one exception is a rerun without network: a file from before the sidecars existed is then adopted as it is
+(hashed once, and checked against the expected sha256 when one is given), so offline reruns keep working.
+Connection errors and server errors (HTTP 5xx) are retried with exponential backoff, client errors (e.g. 404) are not.
+
+The base URL can be pointed at a local HTTP server for testing, with the OPENNEURO_URL environment variable
+or base_url in job_downloads(). Servers without Range support (e.g. python -m http.server) also work, downloads then restart from zero.
+
+Run main.py to execute this script.
+'''
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from pipeline.paths import OPENNEURO_URL, CHECKSUM_SUFFIX
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB read/write buffer
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 3
+BACKOFF = 1.0  # seconds before the first retry, doubled after every failed attempt
+TIMEOUT = (10, 60)  # (connect, read) seconds
+
+
+class DownloadError(Exception):
+    """
+    A download failed verification or could not be completed.
+    """
+
+
+def _sidecar(dest_path):
+    return dest_path + CHECKSUM_SUFFIX
+
+
+def _digests(path, *algorithms):
+    """
+    Hex digest of the file for every hashlib algorithm ("sha256", "md5", ...), all computed in one read.
+    """
+    hashes = [hashlib.new(name) for name in algorithms]
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            for h in hashes:
+                h.update(block)
+    return [h.hexdigest() for h in hashes]
+
+
+def _retryable(error):
+    # Dropped connections, timeouts and server errors (5xx) are worth another attempt, client errors (404, ...) are not
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+def is_complete(dest_path, sha256=None):
+    """
+    True if dest_path was downloaded and verified (its sidecar exists and matches the file size).
+    """
+    sidecar = _sidecar(dest_path)
+    if not (os.path.exists(dest_path) and os.path.exists(sidecar)):
+        return False
+    with open(sidecar) as f:
+        parts = f.read().split()
+    if len(parts) < 2 or int(parts[1]) != os.path.getsize(dest_path):
+        return False
+    return sha256 is None or parts[0] == sha256
+
+
+def mark_complete(dest_path, digest=None):
+    """
+    Write the sidecar that marks dest_path as complete ("<sha256> <size>").
+    Also used to register files created locally (e.g. synthetic data) without downloading them.
+    """
+    digest = digest or _digests(dest_path, "sha256")[0]
+    with open(_sidecar(dest_path), "w") as f:
+        f.write(f"{digest} {os.path.getsize(dest_path)}\n")
+    return digest
+
+
+def _remote_info(session, url):
+    """
+    Size and ETag of a remote file (HEAD request), None when the server does not say.
+    """
+    r = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    if r.status_code in (405, 501):
+        return None, ""  # HEAD not supported, size is checked against the GET response instead
+    r.raise_for_status()
+    size = r.headers.get("Content-Length")
+    etag = r.headers.get("ETag", "").strip('"')
+    return (int(size) if size is not None else None), etag
+
+
+def _adopt(dest_path, sha256, url, error):
+    """
+    Mark a file without a sidecar complete when the server cannot be reached to verify it: hashed once here,
+    it is then reused by the next (offline) runs. Raises DownloadError if it does not match the expected sha256.
+    """
+    digest = _digests(dest_path, "sha256")[0]
+    if sha256 is not None and digest != sha256:
+        raise DownloadError(f"Cannot reach {url} ({error}) and {dest_path} does not match sha256 {sha256}")
+    logging.warning(f"Cannot reach {url} ({error}), using the existing {dest_path} as it is (size and checksum not checked against the server)")
+    mark_complete(dest_path, digest)
+    return dest_path
+
+
+def fetch(url, dest_path, sha256=None, session=None, retries=DEFAULT_RETRIES):
+    """
+    Download url to dest_path, resuming from dest_path.part if a previous attempt was interrupted.
+    Verifies the size and checksum before moving the file into place. Returns dest_path.
+    """
+    if is_complete(dest_path, sha256):
+        logging.info(f"File {dest_path} already downloaded and verified, skipping download.")
+        return dest_path
+
+    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+    session = session or requests.Session()
+    part_path = dest_path + ".part"
+
+    remote = None  # (size, ETag) of the remote file, asked once
+    for attempt in range(1, retries + 1):
+        try:
+            if remote is None:
+                remote = expected_size, etag = _remote_info(session, url)
+                # A file from before the download manager existed (no sidecar): resume from it rather than starting over
+                if os.path.exists(dest_path) and not os.path.exists(part_path):
+                    os.replace(dest_path, part_path)
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if expected_size is not None and offset > expected_size:
+                os.unlink(part_path)  # larger than the remote file, cannot be a prefix of it
+                offset = 0
+            if expected_size is None or offset < expected_size:
+                headers = {"Range": f"bytes={offset}-"} if offset else {}
+                logging.info(f"Downloading {url} (from byte {offset}, attempt {attempt})...")
+                with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+                    if offset and r.status_code == 416:
+                        break  # nothing left to fetch, the partial file is already complete
+                    r.raise_for_status()
+                    if offset and r.status_code != 206:
+                        offset = 0  # server ignored the Range header, start over
+                    if expected_size is None and r.headers.get("Content-Length") is not None:
+                        expected_size = offset + int(r.headers["Content-Length"])
+                    with open(part_path, "ab" if offset else "wb") as f:
+                        # raw bytes as stored (no Content-Encoding decoding), so sizes and checksums match the remote file
+                        for chunk in r.raw.stream(CHUNK_SIZE, decode_content=False):
+                            f.write(chunk)
+            break
+        except requests.RequestException as e:
+            if not _retryable(e):
+                raise DownloadError(f"{url}: {e}") from e  # one error type for callers, e.g. a 404 for a missing file
+            if attempt == retries:
+                if remote is None and os.path.exists(dest_path) and not os.path.exists(_sidecar(dest_path)):
+                    return _adopt(dest_path, sha256, url, e)
+                what = "download or verify" if remote is None else "finish downloading"
+                raise DownloadError(f"Cannot {what} {dest_path} from {url} after {retries} attempts: {e}") from e
+            delay = BACKOFF * 2 ** (attempt - 1)
+            logging.warning(f"Download of {url} failed ({e}), retrying in {delay:.0f} s")
+            time.sleep(delay)
+
+    # Verify before marking complete
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        raise DownloadError(f"{url}: expected {expected_size} bytes, got {size} (partial file kept for resume)")
+    # S3 ETag of a single-part upload is the md5 of the file, checked when no sha256 is given
+    check_etag = sha256 is None and etag and "-" not in etag and len(etag) == 32
+    digest, *md5 = _digests(part_path, "sha256", *(["md5"] if check_etag else []))
+    if sha256 is not None and digest != sha256:
+        os.unlink(part_path)
+        raise DownloadError(f"{url}: sha256 mismatch, expected {sha256}, got {digest}")
+    if check_etag and md5[0] != etag:
+        os.unlink(part_path)
+        raise DownloadError(f"{url}: md5 does not match ETag {etag}")
+
+    os.replace(part_path, dest_path)
+    mark_complete(dest_path, digest)
+    logging.info(f"File downloaded and verified: {dest_path} ({size} bytes)")
+    return dest_path
+
+
+def fetch_many(items, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES):
+    """
+    Download many files concurrently. items: list of (url, dest_path) or (url, dest_path, sha256).
+    Returns {dest_path: None on success or the exception}, failures do not stop other downloads.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {}
+        for item in items:
+            url, dest_path = item[0], item[1]
+            sha256 = item[2] if len(item) > 2 else None
+            # one session per download: requests sessions are not thread-safe
+            futures[pool.submit(fetch, url, dest_path, sha256, None, retries)] = dest_path
+        for future in as_completed(futures):
+            dest_path = futures[future]
+            try:
+                future.result()
+                results[dest_path] = None
+            except Exception as e:
+                logging.error(f"Download failed for {dest_path}: {e}")
+                results[dest_path] = e
+    return results
+
+
+def job_downloads(paths_list, base_url=None):
+    """
+    (url, dest_path) pairs for the NIfTI and events.tsv files of many jobs.
+    base_url replaces the OpenNeuro S3 URL (e.g. a local test server).
+    """
+    items = []
+    for paths in paths_list:
+        for url, dest in ((paths.nii_url, paths.raw_nii), (paths.events_url, paths.raw_events)):
+            if base_url:
+                url = base_url.rstrip("/") + url[len(OPENNEURO_URL):]
+            items.append((url, dest))
+    return items
@@ -0,0 +1,80 @@
+'''
+Optional export of the full preprocessed 4D NIfTI.
+
+transform.py used to rebuild the whole 4D image (masker.inverse_transform) and gzip it on every run, only for the
+mean brain map in visualizations.py. Now transform writes cheap 3D summaries computed from the 2D matrix instead
+(mean_bold_map.nii.gz and std_bold_map.nii.gz, see summary_maps()), and the 4D image is only written on request:
+    - main.py --export-4d FORMAT during the transform step, or
+    - main.py export --format FORMAT afterwards, export_job() (recomputes the matrix with the saved masker if the full matrix
+      was not kept, e.g. outside streaming mode)
+Formats:
+    - nii: uncompressed <prefix>_preprocessed.nii (fastest to write and to memory-map)
+    - fast: <prefix>_preprocessed.nii.gz with gzip level 1 (several times faster than the default level)
+    - nii.gz: <prefix>_preprocessed.nii.gz with nibabel's default gzip level (smallest file)
+The image is written volume by volume (etl/streaming.py), so it is never held in memory.
+
+Run main.py --export-4d FORMAT or main.py export [--job SUBJECT:TASK[:RUN]] --format FORMAT to execute this script.
+'''
+import os
+import time
+import logging
+import numpy as np
+import nibabel as nib
+from pipeline.matrix import column_mean, column_std, open_matrix
+from etl.streaming import stream_inverse_transform
+
+EXPORT_FORMATS = ("nii", "fast", "nii.gz")
+FAST_COMPRESSLEVEL = 1
+
+
+def export_path(paths, fmt):
+    """
+    Where the 4D export of a job goes for a format.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown 4D export format '{fmt}', expected one of {EXPORT_FORMATS}")
+    return paths.processed("preprocessed.nii" if fmt == "nii" else "preprocessed.nii.gz")
+
+
+def summary_maps(voxel_vs_time, masker, paths):
+    """
+    3D mean and standard deviation over time of every voxel, from the 2D matrix (no 4D reconstruction).
+    Same as image.mean_img() of the preprocessed 4D image. Returns (mean map path, std map path).
+    """
+    mean = column_mean(voxel_vs_time)
+    std = column_std(voxel_vs_time, mean)
+    mean_path, std_path = paths.processed("mean_bold_map.nii.gz"), paths.processed("std_bold_map.nii.gz")
+    masker.inverse_transform(mean.astype(np.float32)).to_filename(mean_path)
+    masker.inverse_transform(std.astype(np.float32)).to_filename(std_path)
+    logging.info(f"Mean and std maps saved: {mean_path}, {std_path}")
+    return mean_path, std_path
+
+
+def export_4d(voxel_vs_time, mask_img, paths, fmt="fast"):
+    """
+    Write the preprocessed 4D image (timepoints x voxels matrix back into the brain mask). Returns the path.
+    """
+    out_path = export_path(paths, fmt)
+    start = time.perf_counter()
+    compresslevel = FAST_COMPRESSLEVEL if fmt == "fast" else None
+    stream_inverse_transform(voxel_vs_time, mask_img, out_path, compresslevel=compresslevel)
+    logging.info(f"Exported preprocessed 4D NIfTI ({fmt}): {out_path} "
+                 f"({os.path.getsize(out_path) / 1e6:.1f} MB, {time.perf_counter() - start:.1f}s)")
+    return out_path
+
+
+def export_job(paths, fmt="fast"):
+    """
+    On-demand 4D export for a job that already ran the transform step. Uses the full matrix from streaming mode
+    (voxel_vs_time.npy) when it exists, otherwise re-applies the saved masker to the extracted image.
+    """
+    import joblib
+    from etl.extract import extracted_image_path
+    masker = joblib.load(paths.processed("masker.joblib"))
+    matrix_path = paths.processed("voxel_vs_time.npy")
+    if os.path.exists(matrix_path):
+        voxel_vs_time = open_matrix(matrix_path)
+    else:
+        # same preprocessing as transform (the masker keeps the mask, filters and the TR of this image)
+        voxel_vs_time = masker.transform(nib.load(extracted_image_path(paths)))
+    return export_4d(voxel_vs_time, masker.mask_img_, paths, fmt)
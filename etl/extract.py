@@ -1,28 +1,33 @@
 '''
 Extract data from flat files downloaded from OpenfMRI.
-This script opens one file from sub-01 (participant 1 of the experiment)
-There are 4 tasks in the experiment (specified in README.md), and this script extracts data for the first task.
+By default this script opens one file from sub-01 (participant 1 of the experiment)
+There are 4 tasks in the experiment (specified in README.md), any subject/task/run can be extracted by passing its JobPaths.
 
 This script extracts the fMRI BOLD signal data and the corresponding events.tsv file (Task and durations).
 NOTE: The two datasets are directly stored in data/raw when you run main.py
 
 Imports: 
-    - Externally download the files from OpenfMRI using requests.
+    - Externally download the files from OpenfMRI using requests (resumable, verified downloads in download.py).
     - Used os to create a directory to store the extracted data.
     - Used pandas to read the events.tsv file.
     - Used nilearn to load the fMRI BOLD signal image data (NIfTI file).
 Outputs:
-    - Saves the extracted data in a directory called 'extracted' inside the 'data' folder.
+    - Links the raw files into a directory called 'extracted' inside the 'data' folder
+      (hard link, symlink or copy - the NIfTI is not decompressed and re-compressed)
+    - Optionally (uncompressed=True) an uncompressed .nii copy that later stages memory-map instead of gunzipping
     
 Run main.py to execute this script.
 '''
 
 # Load necessary libraries
 import os
+import gzip
+import shutil
 import logging
 import pandas as pd
 from nilearn.image import load_img
-import requests
+from pipeline.context import PipelineContext
+from etl.download import fetch, fetch_many, job_downloads, DownloadError
 
 #------------------------------------Define function to download file--------------------------------------
 
@@ -31,64 +36,100 @@ def download_file(url, dest_path):
     Download a file from a URL to store the extracted data: 
     - fMRI BOLD signal data (NIfTI file)
     - events.tsv file (Task and durations)
+    Resumes partial downloads and verifies size/checksum (see download.py), a file only counts as
+    already downloaded once it has been verified.
     """
-    # Check if the file already exists
-    if os.path.exists(dest_path):
-        logging.info(f"File {dest_path} already exists, skipping download.")
-        return dest_path
-    
-    # if the file does not exist, download it
-    logging.info(f"Downloading {url}...")
+    return fetch(url, dest_path)
 
-    os.makedirs(os.path.dirname(dest_path), exist_ok=True) # Create directory if it does not exist
+def download_raw(paths):
+    """
+    Download the NIfTI and events.tsv files of a job to the shared raw directory (both at once).
+    """
+    results = fetch_many(job_downloads([paths]), workers=2)
+    failed = {dest: err for dest, err in results.items() if err is not None}
+    if failed:
+        raise DownloadError(f"Download failed: {failed}")
+    return paths.raw_nii, paths.raw_events
 
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status() #Raise error for bad responses
-        with open(dest_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192): #Ensures the response is streamed in chunks to prevemt crashing, chunk size is 8192 bytes
-                f.write(chunk)
-    logging.info(f"File downloaded to {dest_path}")
-    return dest_path
+#------------------------------------Link instead of rewriting--------------------------------------
+
+COPY_BUFFER = 16 * 1024 * 1024  # 16 MB buffer for decompressing/copying large files
+
+def link_file(src, dest):
+    """
+    Make dest point to the same data as src without rewriting it: hard link, else symlink, else copy.
+    """
+    if os.path.lexists(dest):
+        if os.path.exists(dest) and os.path.samefile(src, dest):
+            return dest
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), dest)
+        except OSError:
+            shutil.copyfile(src, dest)
+    return dest
+
+
+def decompress_file(src, dest):
+    """
+    Write an uncompressed copy of a .gz file (streamed with a large buffer, no NIfTI parsing).
+    Written to a temporary name first so an interrupted run never leaves a truncated file behind.
+    """
+    tmp = dest + ".part"
+    with gzip.open(src, "rb") as f_in, open(tmp, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, COPY_BUFFER)
+    os.replace(tmp, dest)
+    return dest
 
-#------------------------------------Function to extract data--------------------------------------
 
-def extract_data():
+def extracted_image_path(paths):
     """
-    Extract fMRI BOLD signal data and corresponding events.tsv file for sub-01, task: Classification Probe without Feedback.
+    Image later stages should read: the uncompressed .nii (memory-mappable) if it exists, else the .nii.gz.
     """
-    # Create a directory to store raw data in the data folder 
-    raw_dir = os.path.join("data", "raw")
-    os.makedirs(raw_dir, exist_ok=True)
-    # Create a directory to store extracted data in the data folder
-    extracted_dir = os.path.join("data", "extracted")
-    os.makedirs(extracted_dir, exist_ok=True)
+    if os.path.exists(paths.extracted_nii_uncompressed):
+        return paths.extracted_nii_uncompressed
+    return paths.extracted_nii
 
-    #S3 URL for the flat files
-    nii_url = (
-        f"https://s3.amazonaws.com/openneuro/ds000011/ds000011_R2.0.1/uncompressed/sub-01/func/sub-01_task-Classificationprobewithoutfeedback_bold.nii.gz"
-    )
+#------------------------------------Function to extract data--------------------------------------
 
-    events_url = (
-        f"https://s3.amazonaws.com/openneuro/ds000011/ds000011_R2.0.1/uncompressed/sub-01/func/sub-01_task-Classificationprobewithoutfeedback_events.tsv"
-    )
+def extract_data(ctx=None, uncompressed=False):
+    """
+    Extract fMRI BOLD signal data and corresponding events.tsv file for one job.
+    Defaults to sub-01, task: Classification Probe without Feedback.
+    The image and events are also kept on the pipeline context.
+    uncompressed=True also keeps an uncompressed .nii copy for later stages to memory-map.
+    """
+    if ctx is None:
+        ctx = PipelineContext()
+    paths = ctx.paths
 
-    #Download the files and store them in the raw directory
-    nii_file = os.path.join(raw_dir, "sub-01_task-Classificationprobewithoutfeedback_bold.nii.gz")
-    events_file = os.path.join(raw_dir, "sub-01_task-Classificationprobewithoutfeedback_events.tsv")
+    # Create the raw and extracted directories (raw is shared between jobs)
+    os.makedirs(paths.raw_dir, exist_ok=True)
+    os.makedirs(paths.extracted_dir, exist_ok=True)
 
-    download_file(nii_url, nii_file)
-    download_file(events_url, events_file)
+    #Download the files from S3 and store them in the raw directory
+    nii_file, events_file = download_raw(paths)
 
     #------------------------------------Load the fMRI BOLD signals file--------------------------------------
 
     ## fMRI BOLD data, in nii.gz file
-    # Load fMRI BOLD signal image data (NIfTI file) into memory
-    fMRI_img = load_img(nii_file)
-    nii_path = os.path.join("data/extracted", "sub-01_task-Classificationprobewithoutfeedback_bold.nii.gz")
-    # Save the file to the data folder
-    fMRI_img.to_filename(nii_path)
+    # Link the downloaded file into the data folder (the image is identical, so no need to decompress and re-compress it)
+    nii_path = link_file(nii_file, paths.extracted_nii)
+
+    # Optional uncompressed copy, nibabel memory-maps .nii files so later stages skip gunzip entirely
+    if uncompressed:
+        decompress_file(nii_file, paths.extracted_nii_uncompressed)
+        logging.info(f"Uncompressed copy saved to {paths.extracted_nii_uncompressed}")
+    elif os.path.lexists(paths.extracted_nii_uncompressed):
+        os.unlink(paths.extracted_nii_uncompressed)  # stale copy from an earlier run
 
-    logging.info(f"fMRI image loaded and saved to {nii_path}")
+    # Load fMRI BOLD signal image (lazily, data is only read when a stage needs it)
+    fMRI_img = load_img(extracted_image_path(paths))
+
+    logging.info(f"fMRI image linked to {nii_path}")
 
     #------------------------------------Load the trial tasks and duration file--------------------------------------
 
@@ -97,10 +138,11 @@ def extract_data():
     # Load corresponding events.tsv file (flat file)
     events = pd.read_csv(events_file, sep='\t')
 
-    # Save the file to the data folder
-    events_path = os.path.join(extracted_dir, "sub-01_task-Classificationprobewithoutfeedback_events.tsv")
-    events.to_csv(events_path, sep='\t', index=False)
+    # Link the file to the data folder
+    events_path = link_file(events_file, paths.extracted_events)
+
+    logging.info(f"Events file loaded and linked to {events_path}")
 
-    logging.info(f"Events file loaded and saved to {events_path}")
+    ctx.fMRI_img, ctx.events = fMRI_img, events
 
-    return fMRI_img, events, nii_path, events_path
\ No newline at end of file
+    return fMRI_img, events, nii_path, events_path
@@ -0,0 +1,120 @@
+'''
+Vectorized event-to-timepoint labeling.
+
+transform.py used to loop over events.iterrows() and build a boolean mask over all timepoints for every event.
+Here all events are placed at once with sorted onsets and interval search (np.searchsorted):
+    - A timepoint t belongs to an event if onset <= t < onset + duration (same rule as before)
+    - Overlapping events: the event with the latest onset wins, ties go to the later row in events.tsv
+      (the same result the old loop gave on onset-sorted events, but independent of row order)
+    - Several runs are labeled at once, each with its own events and number of volumes
+    - The TR is read from the NIfTI header, onsets can be shifted for the hemodynamic lag (hrf_shift, seconds)
+
+Labels are returned as integer codes into a sorted table of trial types (-1 = rest).
+
+Run main.py (transform step) to execute this script.
+'''
+import logging
+import numpy as np
+
+REST_CODE = -1
+
+
+def tr_from_img(img, default=None):
+    """
+    Repetition time (seconds) from the NIfTI header, `default` if the header does not have one.
+    """
+    zooms = img.header.get_zooms()
+    tr = float(zooms[3]) if len(zooms) > 3 else 0.0
+    if tr > 0:
+        # xyzt_units may say the time unit is milliseconds
+        try:
+            time_unit = img.header.get_xyzt_units()[1]
+        except AttributeError:
+            time_unit = "sec"
+        if time_unit == "msec":
+            tr /= 1000.0
+        elif time_unit == "usec":
+            tr /= 1e6
+        return tr
+    if default is None:
+        raise ValueError("NIfTI header has no repetition time and no default TR was given")
+    logging.warning(f"NIfTI header has no repetition time, using TR={default}")
+    return float(default)
+
+
+def _event_winners(onsets, durations, n_timepoints, tr):
+    """
+    For every timepoint, the index (into the events) of the event covering it, -1 if none.
+    """
+    n_events = len(onsets)
+    winner = np.full(n_timepoints, -1, dtype=np.int64)
+    if n_events == 0 or n_timepoints == 0:
+        return winner
+
+    # Rank events by onset (stable, so ties keep file order), a higher rank wins overlaps
+    order = np.argsort(onsets, kind="stable")
+    times = np.arange(n_timepoints) * tr
+    start = np.searchsorted(times, onsets[order], side="left")
+    stop = np.searchsorted(times, onsets[order] + durations[order], side="left")
+    lengths = np.maximum(stop - start, 0)
+
+    # Expand every event into the timepoint indices it covers, without a Python loop
+    total = int(lengths.sum())
+    if total == 0:
+        return winner
+    ranks = np.repeat(np.arange(n_events), lengths)
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    idx = np.repeat(start, lengths) + offsets
+
+    best_rank = np.full(n_timepoints, -1, dtype=np.int64)
+    np.maximum.at(best_rank, idx, ranks)
+    covered = best_rank >= 0
+    winner[covered] = order[best_rank[covered]]
+    return winner
+
+
+def label_timepoints(events, n_timepoints, tr, hrf_shift=0.0, categories=None):
+    """
+    Label every timepoint of one run from its events table (onset, duration, trial_type).
+    Returns (codes, categories): codes[t] indexes categories, REST_CODE (-1) for rest.
+    """
+    codes, categories, _ = label_runs([(events, n_timepoints)], tr, hrf_shift=hrf_shift, categories=categories)
+    return codes, categories
+
+
+def label_runs(runs, tr, hrf_shift=0.0, categories=None):
+    """
+    Label several runs at once. runs: list of (events, n_timepoints), tr: one TR or one per run.
+    Returns (codes, categories, run_index) for all timepoints of all runs, concatenated in run order.
+    """
+    trs = np.broadcast_to(np.asarray(tr, dtype=float), (len(runs),))
+    if categories is None:
+        all_types = [events["trial_type"].astype(str).to_numpy() for events, _ in runs]
+        categories = np.unique(np.concatenate(all_types)) if all_types else np.array([], dtype=str)
+    categories = np.asarray(categories)
+
+    codes, run_index = [], []
+    for i, ((events, n_timepoints), run_tr) in enumerate(zip(runs, trs)):
+        onsets = events["onset"].to_numpy(dtype=float) + hrf_shift
+        durations = events["duration"].to_numpy(dtype=float)
+        event_codes = np.searchsorted(categories, events["trial_type"].astype(str).to_numpy())
+
+        winner = _event_winners(onsets, durations, n_timepoints, run_tr)
+        run_codes = np.full(n_timepoints, REST_CODE, dtype=np.int32)
+        covered = winner >= 0
+        run_codes[covered] = event_codes[winner[covered]]
+        codes.append(run_codes)
+        run_index.append(np.full(n_timepoints, i, dtype=np.int32))
+
+    return np.concatenate(codes), categories, np.concatenate(run_index)
+
+
+def decode_labels(codes, categories, rest_label="rest"):
+    """
+    Turn label codes back into an object array of trial type names (rest_label for REST_CODE).
+    """
+    names = np.asarray(categories, dtype=object)
+    labels = np.full(len(codes), rest_label, dtype=object)
+    task = codes != REST_CODE
+    labels[task] = names[codes[task]]
+    return labels
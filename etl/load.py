@@ -1,28 +1,25 @@
 '''
 Loads transformed fMRI image data and original events.tsv tabular data.
 Creates a new pandas series that defines all the labels for each trial in the duration of task-1.
+X and y come from the pipeline context when transform_data() just ran, otherwise from data/processed.
 
 Run main.py to execute this script.
 '''
-import pandas as pd
-import numpy as np
-import os
 import logging
+from pipeline.context import PipelineContext
 
-def load_data():
+def load_data(ctx=None):
     """
     Load the filtered voxel vs. time array and labels CSV made in transform.py.
     """
-    processed_path = "data/processed"
+    if ctx is None:
+        ctx = PipelineContext()
 
-    X_file = os.path.join(processed_path, "sub-01_task-Classificationprobewithoutfeedback_X.npy")
-    y_file = os.path.join(processed_path, "sub-01_task-Classificationprobewithoutfeedback_y.csv")
-    
-    # Load filtered data
-    X = np.load(X_file)
+    # Load filtered data (no disk read if transform_data() ran in this pipeline)
+    X = ctx.get_X()
     logging.info(f"Loaded X file with shape: {X.shape}")
 
-    y = pd.read_csv(y_file)["label"].values
+    y = ctx.get_y()
     logging.info(f"Loaded y file with {len(y)} labels")
 
     return X, y
\ No newline at end of file
@@ -0,0 +1,264 @@
+'''
+Region features: the voxel matrix averaged within atlas regions or data-driven clusters.
+
+transform.py gives one column of X per voxel of the EPI mask, so model, evaluation, cross-validation and
+inference all pay for every voxel. The parcellate stage (main.py --features regions) turns X into a
+timepoints x regions matrix (X_regions.npy, next to X.npy) that the later stages use instead:
+    - atlas: a local label image (--atlas PATH, any NIfTI with one integer label per region, 0 = background),
+      resampled to the EPI grid with nearest-neighbour interpolation, no download needed.
+      Every label of the atlas is a column even if no masked voxel falls in it (all zeros then), so jobs with
+      different brain masks get the same columns and can be pooled across subjects
+    - ward / kmeans: data-driven clusters of the voxel time series of this run (like nilearn's Parcellations),
+      fitted on the training rows of the model's split only, so the test timepoints do not shape the regions.
+      ward only merges neighbouring voxels (grid connectivity of the mask). Unsupervised, the labels are not used,
+      but the regions differ from run to run, so pooling across jobs needs an atlas
+Each region's signal is the mean of its voxels' preprocessed signals (a sparse averaging matrix applied over row
+chunks of the memory-mapped X), standardized again per region like the voxels are (standardize=True), with the mean
+and std of the training rows. Those are saved with the regions, so new scans get the same scaling.
+Limitation: the regions and their scaling are fitted once, on the model's 80% training split, not per fold. The test
+rows of --cv folds and of the search's inner folds were part of that fit, so with ward / kmeans regions those scores
+are optimistic (the held-out rows shaped the features they are scored on): crossval and search log a warning then.
+An atlas only brings in the per-region mean / std.
+
+Outputs (processed/):
+    - X_regions.npy: timepoints x regions, in the working precision
+    - regions.npz: region of every masked voxel (-1 = none), the atlas label or cluster id of every column, the method,
+      and the training mean / std of every column (standardize=True)
+    - regions.nii.gz: label image of the regions on the EPI grid (column index + 1, 0 = none)
+inference.py and realtime.py apply the same averaging to new scans when the saved model was trained on regions.
+
+Run main.py --features regions [--atlas PATH | --n-regions N] to execute this script.
+'''
+import logging
+import joblib
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from pipeline.paths import MATRIX_FILES
+from pipeline.context import PipelineContext
+from pipeline.matrix import iter_rows, take_rows, save_matrix
+from pipeline.profiling import section
+from pipeline.store import record_stage
+from pipeline.precision import as_working, get_dtype
+
+METHODS = ("atlas", "ward", "kmeans")
+REGIONS_MATRIX = MATRIX_FILES["regions"]
+REGIONS_FILE = "regions.npz"
+REGIONS_MAP = "regions.nii.gz"
+
+# Parcellation parameters (also part of the stage cache fingerprint)
+PARCELLATION_PARAMS = dict(
+    method="ward",      # used when no atlas is given
+    n_regions=200,      # clusters (ward / kmeans), clamped to the number of voxels
+    standardize=True,   # z-score every region's signal, like the voxels
+    random_state=42,
+)
+
+
+def atlas_labels(atlas, mask_img):
+    """
+    Atlas label of every masked voxel (C order of the mask, like the columns of X) and all labels of the atlas.
+    """
+    from nilearn.image import load_img, resample_to_img
+    atlas_img = load_img(atlas)
+    if atlas_img.ndim != 3:
+        raise ValueError(f"Atlas {atlas} must be a 3D label image, got {atlas_img.ndim} dimensions")
+    region_ids = np.unique(np.asarray(atlas_img.dataobj).astype(np.int64))
+    region_ids = region_ids[region_ids != 0]
+    resampled = resample_to_img(atlas_img, mask_img, interpolation="nearest", force_resample=True, copy_header=True)
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    return np.asarray(resampled.dataobj).astype(np.int64)[mask], region_ids
+
+
+def cluster_labels(X, mask_img, n_regions, method="ward", random_state=PARCELLATION_PARAMS["random_state"]):
+    """
+    Cluster id of every masked voxel from its time series: ward (spatially connected) or kmeans.
+    """
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    X = as_working(X)
+    n_regions = min(n_regions, X.shape[1])
+    if method == "ward":
+        from sklearn.cluster import FeatureAgglomeration
+        from sklearn.feature_extraction.image import grid_to_graph
+        connectivity = grid_to_graph(*mask.shape, mask=mask)
+        labels = FeatureAgglomeration(n_clusters=n_regions, connectivity=connectivity, linkage="ward").fit(X).labels_
+    elif method == "kmeans":
+        from sklearn.cluster import MiniBatchKMeans
+        labels = MiniBatchKMeans(n_clusters=n_regions, random_state=random_state, n_init=3).fit(X.T).labels_
+    else:
+        raise ValueError(f"Unknown parcellation method '{method}', expected one of {METHODS}")
+    return labels.astype(np.int64), np.arange(n_regions)
+
+
+def voxel_regions(labels, region_ids):
+    """
+    Column of every voxel in the region matrix (-1 for voxels outside every region).
+    """
+    if len(region_ids) == 0:
+        raise ValueError("No regions: the atlas has no label other than 0")
+    index = np.searchsorted(region_ids, labels)
+    index = np.minimum(index, len(region_ids) - 1)
+    return np.where(region_ids[index] == labels, index, -1)
+
+
+def averaging_matrix(voxel_region, n_regions):
+    """
+    Sparse voxels x regions matrix: X @ W is the mean of every region's voxels (empty regions stay 0).
+    """
+    voxels = np.flatnonzero(voxel_region >= 0)
+    columns = voxel_region[voxels]
+    counts = np.bincount(columns, minlength=n_regions)
+    weights = 1.0 / counts[columns]
+    return sparse.csr_matrix((weights, (voxels, columns)), shape=(len(voxel_region), n_regions))
+
+
+def region_means(X, voxel_region, n_regions):
+    """
+    Timepoints x regions matrix (float64) of region means, computed over row chunks of X (X can be memory-mapped).
+    """
+    W = averaging_matrix(voxel_region, n_regions)
+    R = np.empty((X.shape[0], n_regions), dtype=np.float64)
+    for start, stop, block in iter_rows(X):
+        R[start:stop] = (W.T @ np.asarray(block, dtype=np.float64).T).T
+    return R
+
+
+def region_stats(R, rows=None):
+    """
+    (mean, std) of every region over `rows` of the region means (all rows if None).
+    """
+    R = R if rows is None else R[rows]
+    return R.mean(axis=0), R.std(axis=0)
+
+
+def apply_region_stats(R, stats):
+    """
+    Region means z-scored with (mean, std), columns without variance become 0.
+    """
+    mean, std = stats
+    return np.divide(R - mean, std, out=np.zeros_like(R), where=std > 0)
+
+
+def region_signals(X, voxel_region, n_regions, standardize=PARCELLATION_PARAMS["standardize"], stats=None):
+    """
+    Region means of X in the working precision, z-scored per region with `stats` (mean, std), by default the
+    mean and std of these rows.
+    """
+    R = region_means(X, voxel_region, n_regions)
+    if standardize:
+        R = apply_region_stats(R, stats if stats is not None else region_stats(R))
+    return as_working(R)
+
+
+def save_regions(path, voxel_region, region_ids, method, stats=None):
+    arrays = {} if stats is None else {"mean": stats[0], "std": stats[1]}
+    np.savez(path, voxel_region=voxel_region.astype(np.int32), region_ids=np.asarray(region_ids), method=np.array(method), **arrays)
+    return path
+
+
+def load_regions(path):
+    """
+    (voxel_region, region_ids, method) of a regions.npz.
+    """
+    with np.load(path) as f:
+        return f["voxel_region"], f["region_ids"], str(f["method"])
+
+
+def load_region_stats(path):
+    """
+    Training (mean, std) of every region column of a regions.npz, None if the columns are not standardized.
+    """
+    with np.load(path) as f:
+        return (f["mean"], f["std"]) if "mean" in f.files else None
+
+
+def check_shared_columns(paths_list, features="voxels"):
+    """
+    Raise ValueError unless the processed jobs have the same columns of X: the voxels of one brain mask, or the
+    labels of one atlas (features="regions"). Every job computes its own EPI mask (and its own ward / kmeans regions),
+    so the same number of columns does not mean the same voxels.
+    """
+    first = paths_list[0]
+    if features == "regions":
+        regions = [load_regions(paths.processed(REGIONS_FILE)) for paths in paths_list]
+        for paths, (_, region_ids, method) in zip(paths_list, regions):
+            if method != "atlas":
+                raise ValueError(f"{paths.prefix} has {method} regions, which differ from run to run: "
+                                 "region features are only pooled across jobs parcellated with one atlas (--atlas PATH)")
+            if not np.array_equal(region_ids, regions[0][1]):
+                raise ValueError(f"{paths.prefix} and {first.prefix} were parcellated with different atlases, their columns differ")
+        return
+    reference = joblib.load(first.processed("masker.joblib")).mask_img_
+    reference_mask = np.asarray(reference.dataobj).astype(bool)
+    for paths in paths_list[1:]:
+        mask_img = joblib.load(paths.processed("masker.joblib")).mask_img_
+        if (mask_img.shape != reference.shape or not np.allclose(mask_img.affine, reference.affine)
+                or not np.array_equal(np.asarray(mask_img.dataobj).astype(bool), reference_mask)):
+            raise ValueError(f"{paths.prefix} and {first.prefix} have different brain masks, their voxel columns are different voxels: "
+                             "pool them with --features regions and one atlas (--atlas PATH)")
+
+
+def warn_fitted_regions(ctx, purpose):
+    """
+    Log a warning when ctx's features are ward / kmeans regions: they were fitted on the model's training split, which
+    holds the held-out rows of `purpose`'s folds. Returns True if it warned.
+    """
+    if ctx.features != "regions":
+        return False
+    _, _, method = load_regions(ctx.paths.processed(REGIONS_FILE))
+    if method == "atlas":
+        return False
+    logging.warning(f"{purpose} on {method} regions: the regions were fitted once on the model's training split, "
+                    "including the rows held out by the folds, so the fold scores are optimistic (use --atlas PATH for fold-independent regions)")
+    return True
+
+
+def parcellate(ctx=None, atlas=None, method=None, n_regions=None, standardize=None):
+    """
+    Average the job's voxel matrix within regions: atlas labels if an atlas is given, else clusters (ward / kmeans).
+    Keeps the region matrix on the context (and saves it when ctx.persist is set). Returns it.
+    """
+    if ctx is None:
+        ctx = PipelineContext()
+    paths = ctx.paths
+    method = "atlas" if atlas else (method or PARCELLATION_PARAMS["method"])
+    n_regions = PARCELLATION_PARAMS["n_regions"] if n_regions is None else n_regions
+    standardize = PARCELLATION_PARAMS["standardize"] if standardize is None else standardize
+    if method == "atlas" and not atlas:
+        raise ValueError("The atlas method needs an atlas file (--atlas PATH)")
+
+    from analysis.model import split_indices
+    X = ctx.get_X("voxels")
+    mask_img = joblib.load(paths.processed("masker.joblib")).mask_img_
+    # Regions and their scaling only come from the rows the model trains on
+    train_idx = np.sort(split_indices(X.shape[0])[0])
+    with section("region_labels", method=method):
+        if method == "atlas":
+            labels, region_ids = atlas_labels(atlas, mask_img)
+        else:
+            labels, region_ids = cluster_labels(take_rows(X, train_idx, dtype=get_dtype()), mask_img, n_regions, method)
+        voxel_region = voxel_regions(labels, region_ids)
+    n_empty = len(region_ids) - len(np.unique(voxel_region[voxel_region >= 0]))
+    if n_empty:
+        logging.warning(f"{n_empty} of {len(region_ids)} regions have no voxel in the brain mask, their columns are all zeros")
+
+    with section("region_signals", n_regions=len(region_ids)):
+        R = region_means(X, voxel_region, len(region_ids))
+        stats = region_stats(R, train_idx) if standardize else None
+        X_regions = as_working(apply_region_stats(R, stats) if standardize else R)
+        del R
+    ctx.X_regions = X_regions
+    logging.info(f"Parcellation ({method}): {X.shape[1]} voxels -> {X_regions.shape[1]} regions, "
+                 f"{X.nbytes / 1024**2:.1f} MB -> {X_regions.nbytes / 1024**2:.2f} MB")
+
+    if ctx.persist:
+        save_matrix(paths.processed(REGIONS_MATRIX), X_regions)
+        save_regions(paths.processed(REGIONS_FILE), voxel_region, region_ids, method, stats=stats)
+        mask = np.asarray(mask_img.dataobj).astype(bool)
+        region_map = np.zeros(mask.shape, dtype=np.int32)
+        region_map[mask] = voxel_region + 1
+        nib.Nifti1Image(region_map, mask_img.affine).to_filename(paths.processed(REGIONS_MAP))
+        record_stage(paths, "parcellate", [paths.processed(name) for name in (REGIONS_MATRIX, REGIONS_FILE, REGIONS_MAP)],
+                     params={"method": method, "atlas": atlas, "n_regions": len(region_ids), "standardize": standardize},
+                     n_voxels=int(X.shape[1]), empty_regions=int(n_empty))
+    return X_regions
@@ -0,0 +1,128 @@
+'''
+Streaming, chunked version of the NiftiMasker preprocessing in transform.py.
+
+masker.fit_transform() needs the whole 4D image, the 2D float64 matrix and (for the preprocessed NIfTI)
+a reconstructed 4D image in memory at the same time, which runs out of memory on long or high-resolution runs.
+This module produces the same result with bounded memory:
+    1. Mean EPI image from slabs of volumes -> brain mask (compute_epi_mask accepts the 3D mean image)
+    2. Slabs of volumes -> Gaussian smoothing (per volume, so slabs give the same result) -> masked rows of X
+       written into a memory-mapped .npy file
+    3. Blocks of voxels (columns of X) -> detrending, filtering and standardization with nilearn.signal.clean
+       (per voxel, so blocks give the same result), written back in place
+    4. Optionally, the preprocessed 4D image is written volume by volume (same as masker.inverse_transform)
+
+Memory use is set by chunk_volumes and chunk_voxels instead of the image size.
+
+Run main.py (transform step, streaming=True) to execute this script.
+'''
+import os
+import gzip
+import logging
+import numpy as np
+import nibabel as nib
+from nilearn import image, masking, signal
+from pipeline.matrix import create_matrix, iter_cols
+
+DEFAULT_CHUNK_VOLUMES = 16     # volumes per slab for the mean image and smoothing
+DEFAULT_CHUNK_VOXELS = 8192    # voxels (columns) per block for signal cleaning
+
+
+def iter_volume_slabs(img, chunk_volumes=DEFAULT_CHUNK_VOLUMES):
+    """
+    Yield (start, stop, data) slabs of a 4D image, data has shape (x, y, z, stop - start).
+    Only one slab is held in memory (the image data is read through nibabel's array proxy).
+    The data keeps the image's dtype, like NiftiMasker does, so smoothing gives the same values.
+    """
+    n_volumes = img.shape[3]
+    for start in range(0, n_volumes, chunk_volumes):
+        stop = min(start + chunk_volumes, n_volumes)
+        yield start, stop, np.asarray(img.dataobj[..., start:stop])
+
+
+def streamed_mean_img(img, chunk_volumes=DEFAULT_CHUNK_VOLUMES):
+    """
+    Mean over time of a 4D image, computed slab by slab (same as nilearn.image.mean_img).
+    """
+    total = np.zeros(img.shape[:3], dtype=np.float64)
+    for _, _, slab in iter_volume_slabs(img, chunk_volumes):
+        total += slab.sum(axis=3, dtype=np.float64)
+    return nib.Nifti1Image(total / img.shape[3], img.affine, img.header)
+
+
+def streamed_epi_mask(img, chunk_volumes=DEFAULT_CHUNK_VOLUMES):
+    """
+    Brain mask from the streamed mean image (compute_epi_mask on a 4D image uses its mean as well).
+    """
+    return masking.compute_epi_mask(streamed_mean_img(img, chunk_volumes))
+
+
+def stream_transform(fMRI_img, mask_img, masker_params, out_path,
+                     chunk_volumes=DEFAULT_CHUNK_VOLUMES, chunk_voxels=DEFAULT_CHUNK_VOXELS,
+                     dtype=np.float64):
+    """
+    Equivalent of NiftiMasker(mask_img=mask_img, **masker_params).fit_transform(fMRI_img),
+    written to out_path (.npy, timepoints x voxels) and returned as a memory map.
+    """
+    fMRI_img = image.load_img(fMRI_img)
+    mask = np.asarray(image.load_img(mask_img).dataobj).astype(bool)
+    n_volumes, n_voxels = fMRI_img.shape[3], int(mask.sum())
+    X = create_matrix(out_path, (n_volumes, n_voxels), dtype=dtype)
+
+    # Spatial step: smoothing is done per volume, so slabs of volumes give the same result
+    fwhm = masker_params.get("smoothing_fwhm")
+    for start, stop, slab in iter_volume_slabs(fMRI_img, chunk_volumes):
+        if fwhm is not None:
+            slab_img = nib.Nifti1Image(slab, fMRI_img.affine)
+            slab = np.asarray(image.smooth_img(slab_img, fwhm).dataobj)
+        X[start:stop] = slab[mask].T
+    X.flush()
+    logging.info(f"Streamed smoothing and masking: {n_volumes} volumes in slabs of {chunk_volumes}")
+
+    # Temporal step: detrending, filtering and standardization are done per voxel, so blocks of voxels give the same result
+    for start, stop, block in iter_cols(X, chunk_voxels):
+        X[:, start:stop] = signal.clean(
+            np.asarray(block, dtype=np.float64),
+            detrend=masker_params.get("detrend", False),
+            standardize=masker_params.get("standardize", False),
+            standardize_confounds=True,
+            t_r=masker_params.get("t_r"),
+            low_pass=masker_params.get("low_pass"),
+            high_pass=masker_params.get("high_pass"),
+        )
+    X.flush()
+    logging.info(f"Streamed signal cleaning: {n_voxels} voxels in blocks of {chunk_voxels}")
+    return X
+
+
+def stream_inverse_transform(X, mask_img, out_path, chunk_volumes=DEFAULT_CHUNK_VOLUMES, compresslevel=None):
+    """
+    Equivalent of masker.inverse_transform(X).to_filename(out_path), written volume by volume
+    so the 4D image is never held in memory. Supports .nii and .nii.gz
+    (compresslevel: gzip level, nibabel's default if None, 1 is much faster).
+    """
+    mask_img = image.load_img(mask_img)
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    n_volumes = X.shape[0]
+
+    # Header of the full 4D image, data follows at vox_offset in Fortran order (one volume after another)
+    header = nib.Nifti1Image(np.zeros(mask.shape + (1,), dtype=X.dtype), mask_img.affine).header
+    header.set_data_shape(mask.shape + (n_volumes,))
+    header.set_data_dtype(X.dtype)
+    header.set_data_offset(352)
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    if out_path.endswith(".gz"):
+        f = gzip.open(out_path, "wb", compresslevel=compresslevel or nib.openers.Opener.default_compresslevel)
+    else:
+        f = open(out_path, "wb")
+    with f:
+        f.write(header.binaryblock)
+        f.write(b"\x00" * (352 - len(header.binaryblock)))  # empty extension block
+        volume = np.zeros(mask.shape, dtype=X.dtype)
+        for start in range(0, n_volumes, chunk_volumes):
+            rows = np.asarray(X[start:min(start + chunk_volumes, n_volumes)])
+            for row in rows:
+                volume[mask] = row
+                f.write(volume.tobytes(order="F"))
+    logging.info(f"Streamed preprocessed NIfTI written to {out_path}")
+    return out_path
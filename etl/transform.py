@@ -8,13 +8,21 @@ Imports:
     - Used nilearn to load the fMRI BOLD signal image data (NIfTI file).
 Outputs: 
     - Saves preprocessed fMRI BOLD signal data (as a 2D Numpy array)
-    - Saves preprocessd fMRI BOLD signal data in original format (4D spatial data)
+    - Saves mean and std maps of the preprocessed signal (3D, computed from the 2D matrix)
+    - Optionally saves preprocessd fMRI BOLD signal data in original format (4D spatial data, export_4d, see export.py)
     - Saves X (voxel vs time) and y (labels) for analysis and evaluation
+    - Saves the timepoint and run of every row of X (X_rows.npz) for cross-validation
+    - Saves the fitted NiftiMasker (masker.joblib) for inference on new scans (see analysis/inference.py)
     - Compute mean BOLD signal per voxel for reference
     - Compute correlations between mean BOLD and trial types
     - Aggregate the mean BOLD signal per trial type (important to answer business problem)
+    - Per-voxel condition maps (mean and variance per trial type) in one pass over the data (see aggregate.py)
     - Filters out timepoints where the participant was not doing a task (rest) to prevent overfitting
 
+Streaming mode (streaming=True, see streaming.py):
+    - Same preprocessing in slabs of volumes and blocks of voxels with bounded memory
+    - The full voxel x time matrix is written to <prefix>_voxel_vs_time.npy and used memory-mapped
+
 Run main.py to execute this script
 '''
 import os
@@ -23,110 +31,175 @@ import numpy as np
 from nilearn.maskers import NiftiMasker
 from nilearn import masking
 from nilearn.image import load_img
+import nibabel as nib
 import logging
-
-def transform_data(save_csv=True):  # Aligns with main.py so everything is logged in pipeline.log file
+import joblib
+from pipeline.context import PipelineContext
+from pipeline.matrix import copy_rows
+from etl.extract import extracted_image_path
+from etl.labels import tr_from_img, label_timepoints, decode_labels
+from etl.aggregate import condition_stats, condition_summary
+from etl.streaming import streamed_epi_mask, stream_transform
+from etl.export import summary_maps, export_4d as export_4d_image
+from pipeline.profiling import section
+from pipeline.store import LABELS_FILE, save_labels, record_stage
+from pipeline.precision import get_dtype, as_working
+
+# NiftiMasker preprocessing parameters (also part of the stage cache fingerprint)
+MASKER_PARAMS = dict(
+    standardize=True,       # z-score normalization per voxel
+    detrend=True,           # Remove slow linear trends
+    smoothing_fwhm=6.0,     # Gaussian smoothing (6mm FWHM)
+    high_pass=0.01,         # Filter out very slow changes (<0.01 Hz)
+    low_pass=0.1,           # Filter out very fast changes (>0.1 Hz)
+    t_r=2.0,                # Repetition time of fMRI acquisition (replaced by the TR in the NIfTI header when it has one)
+)
+
+def transform_data(save_csv=True, ctx=None, streaming=False, hrf_shift=0.0, export_4d=None):  # Aligns with main.py so everything is logged in pipeline.log file
     """
     Transforms the extracted fMRI data using NiftiMasker and aligns with events.tsv labels.
     Computes correlations and aggregates mean BOLD per trial type.
-    Saves X and y files for analysis and evaluation.
+    Keeps X and y on the pipeline context (and saves them when ctx.persist is set) for analysis and evaluation.
+    streaming=True runs the same preprocessing chunk by chunk with bounded memory (X is then always saved).
+    hrf_shift shifts event onsets by that many seconds to account for the hemodynamic lag.
+    export_4d: also write the preprocessed 4D NIfTI, in format "nii", "fast" or "nii.gz" (see export.py), None to skip it.
     """
+    if ctx is None:
+        ctx = PipelineContext()
+    paths = ctx.paths
     try:
-        logging.info("Starting data transformation")
+        logging.info(f"Starting data transformation for {paths.prefix}")
 
         # Ensure processed data folder exists
-        processed_path = os.path.join('data', 'processed')
-        os.makedirs(processed_path, exist_ok=True)
+        os.makedirs(paths.processed_dir, exist_ok=True)
 
-        # Paths to extracted fMRI data and events TSV
-        extracted_path = os.path.join('data', 'extracted')
-        events_path = os.path.join(extracted_path, "sub-01_task-Classificationprobewithoutfeedback_events.tsv")
-        events = pd.read_csv(events_path, sep='\t')
+        # Extracted fMRI data and events TSV (from extract_data, or from disk if extract was cached)
+        events = ctx.events if ctx.events is not None else pd.read_csv(paths.extracted_events, sep='\t')
 
-        fMRI_file = os.path.join(extracted_path, "sub-01_task-Classificationprobewithoutfeedback_bold.nii.gz")
-        fMRI_img = load_img(fMRI_file)  # Load the extracted fMRI image
+        if streaming:
+            # Re-open the file so slabs are read one after another from a single open file
+            fMRI_img = nib.load(extracted_image_path(paths), keep_file_open=True)
+        else:
+            fMRI_img = ctx.fMRI_img if ctx.fMRI_img is not None else load_img(extracted_image_path(paths))  # Load the extracted fMRI image (.nii is memory-mapped)
 
         # Create a brain mask to determine which voxels belong to the brain
-        mask_img = masking.compute_epi_mask(fMRI_img)
+        with section("epi_mask"):
+            if streaming:
+                mask_img = streamed_epi_mask(fMRI_img)
+            else:
+                mask_img = masking.compute_epi_mask(fMRI_img)
+
+        # Repetition time from the NIfTI header (MASKER_PARAMS t_r if the header has none)
+        tr = tr_from_img(fMRI_img, default=MASKER_PARAMS["t_r"])
+        masker_params = {**MASKER_PARAMS, "t_r": tr}
 
         # Perform preprocessing on the fMRI data using NiftiMasker
         masker = NiftiMasker(
             mask_img=mask_img,      # Use the brain mask
-            standardize=True,       # z-score normalization per voxel
-            detrend=True,           # Remove slow linear trends
-            smoothing_fwhm=6.0,     # Gaussian smoothing (6mm FWHM)
-            high_pass=0.01,         # Filter out very slow changes (<0.01 Hz)
-            low_pass=0.1,           # Filter out very fast changes (>0.1 Hz)
-            t_r=2.0,                # Repetition time of fMRI acquisition
+            dtype=get_dtype().name, # Working precision of the pipeline (float64 unless --precision float32, see pipeline/precision.py)
+            **masker_params,
         )
 
         # Transform the 4D fMRI image into a 2D array: timepoints x voxels
-        voxel_vs_time = masker.fit_transform(fMRI_img)
+        if streaming:
+            masker.fit()
+            with section("stream_transform"):
+                voxel_vs_time = stream_transform(fMRI_img, mask_img, masker_params, paths.processed("voxel_vs_time.npy"), dtype=get_dtype())
+        else:
+            with section("fit_transform"):
+                voxel_vs_time = as_working(masker.fit_transform(fMRI_img))
         logging.info(f"Voxel x Time shape: {voxel_vs_time.shape}")
 
-        # Save the preprocessed 4D image
-        preprocessed_img = masker.inverse_transform(voxel_vs_time)
-        preprocessed_file = os.path.join(processed_path, "sub-01_task-Classificationprobewithoutfeedback_preprocessed.nii.gz")
-        preprocessed_img.to_filename(preprocessed_file)
-        logging.info(f"Saved preprocessed NIfTI: {preprocessed_file}")
+        # 3D mean/std maps straight from the 2D matrix, the full 4D image is only written on request
+        with section("summary_maps"):
+            summary_maps(voxel_vs_time, masker, paths)
+        if export_4d:
+            with section("export_4d", format=export_4d):
+                export_4d_image(voxel_vs_time, mask_img, paths, export_4d)
+
+        # Save the fitted masker (brain mask + preprocessing parameters) so new scans can be scored without re-running the pipeline
+        joblib.dump(masker, paths.processed("masker.joblib"))
 
         # Compute mean BOLD signal per voxel for reference
         mean_signal = voxel_vs_time.mean(axis=1)
         tidy_df = pd.DataFrame({'mean_bold': mean_signal})
-        tidy_csv = os.path.join(processed_path, "sub-01_task-Classificationprobewithoutfeedback_mean_bold.csv")
+        tidy_csv = paths.processed("mean_bold.csv")
         tidy_df.to_csv(tidy_csv, index=False)
         logging.info(f"Tidy CSV saved: {tidy_csv}")
 
-        # Align timepoints to trials using events.tsv
+        # Align timepoints to trials using events.tsv (vectorized interval search, see labels.py)
         n_timepoints = voxel_vs_time.shape[0]
-        tr = 2.0
-        timepoints_sec = np.arange(n_timepoints) * tr
-        timepoint_labels = np.full(n_timepoints, "rest", dtype=object)
-
-        for _, row in events.iterrows():
-            onset = row["onset"]
-            duration = row["duration"]
-            label = row["trial_type"]
-            in_event = (timepoints_sec >= onset) & (timepoints_sec < onset + duration)
-            timepoint_labels[in_event] = label
+        label_codes, categories = label_timepoints(events, n_timepoints, tr, hrf_shift=hrf_shift)
+        timepoint_labels = decode_labels(label_codes, categories)
 
         # Filter out "rest" timepoints to ensure X and y match exactly
         trial_mask = timepoint_labels != "rest"
-        X_filtered = voxel_vs_time[trial_mask, :]
         y_filtered = timepoint_labels[trial_mask]
-
-        # Save filtered X and y for modeling
-        np.save(os.path.join(processed_path, "sub-01_task-Classificationprobewithoutfeedback_X.npy"), X_filtered)
-        pd.DataFrame({"label": y_filtered}).to_csv(os.path.join(processed_path, "sub-01_task-Classificationprobewithoutfeedback_y.csv"), index=False)
-
-        # Compute correlations between mean BOLD and trial types
+        if streaming:
+            # Copy the task rows chunk by chunk into X.npy, X stays memory-mapped
+            X_filtered = copy_rows(voxel_vs_time, np.flatnonzero(trial_mask), paths.processed("X.npy"))
+        else:
+            X_filtered = voxel_vs_time[trial_mask, :]
+
+        # Timepoint (and run) of every row of X, used for grouped / blocked cross-validation (crossval.py)
+        row_timepoints = np.flatnonzero(trial_mask)
+        row_runs = np.full(len(row_timepoints), paths.run if paths.run is not None else 1)
+
+        # Hand filtered X and y to the next stages, and save them for modeling
+        ctx.X, ctx.y = X_filtered, y_filtered
+        ctx.rows = (row_timepoints, row_runs)
+        if ctx.persist or streaming:
+            if not streaming:
+                np.save(paths.processed("X.npy"), X_filtered)
+            save_labels(paths.processed(LABELS_FILE), label_codes[trial_mask], categories)  # integer codes + category table
+            np.savez(paths.processed("X_rows.npz"), timepoint=row_timepoints, run=row_runs)
+
+        # Per-condition statistics for every voxel in a single pass over the matrix (no per-label copies)
+        with section("condition_stats"):
+            counts, condition_means, condition_vars = condition_stats(voxel_vs_time, label_codes, len(categories))
+        present = counts > 0  # trial types that occur in this run
+        trial_types = categories[present]
+
+        # Compute correlations between mean BOLD and trial types (uses the 1D mean signal only)
         correlations = {}
-        for trial_type in np.unique(timepoint_labels):
-            if trial_type == "rest":
-                continue
-            trial_mask_type = timepoint_labels == trial_type
-            correlations[trial_type] = np.corrcoef(mean_signal[trial_mask_type], np.ones(trial_mask_type.sum()))[0, 1]
+        for code in np.flatnonzero(present):
+            trial_mask_type = label_codes == code
+            correlations[categories[code]] = np.corrcoef(mean_signal[trial_mask_type], np.ones(trial_mask_type.sum()))[0, 1]
 
         correlation_df = pd.DataFrame.from_dict(correlations, orient='index', columns=['correlation'])
-        correlation_csv_path = os.path.join(processed_path, 'sub-01_task-Classificationprobewithoutfeedback_bold_task_correlation.csv')
+        correlation_csv_path = paths.processed("bold_task_correlation.csv")
         if save_csv:
             correlation_df.to_csv(correlation_csv_path)
         logging.info(f"Correlation CSV saved: {correlation_csv_path}")
 
-        # Aggregate mean BOLD per trial_type
-        mean_per_trial = []
-        for trial_type in np.unique(timepoint_labels):
-            if trial_type == "rest":
-                continue
-            trial_mask_type = timepoint_labels == trial_type
-            mean_val = voxel_vs_time[trial_mask_type, :].mean()
-            mean_per_trial.append({'trial_type': trial_type, 'mean_bold': mean_val})
-
-        trial_tidy_df = pd.DataFrame(mean_per_trial)
-        trial_tidy_csv = os.path.join(processed_path, 'sub-01_task-Classificationprobewithoutfeedback_mean_bold_per_trial.csv')
+        # Aggregate mean BOLD per trial_type (from the condition statistics, no pass over the matrix)
+        mean_bold, std_bold = condition_summary(counts[present], condition_means[present], condition_vars[present])
+        trial_tidy_df = pd.DataFrame({
+            'trial_type': trial_types,
+            'mean_bold': mean_bold,
+            'std_bold': std_bold,
+            'n_timepoints': counts[present],
+        })
+        trial_tidy_csv = paths.processed("mean_bold_per_trial.csv")
         trial_tidy_df.to_csv(trial_tidy_csv, index=False)
         logging.info(f"Mean BOLD per trial_type tidy CSV saved: {trial_tidy_csv}")
 
+        # Per-voxel condition maps: arrays (conditions x voxels) and a 4D NIfTI with one volume per trial type
+        np.savez(paths.processed("condition_stats.npz"), trial_types=trial_types.astype(str), counts=counts[present],
+                 means=condition_means[present], variances=condition_vars[present])
+        with section("condition_maps"):
+            masker.inverse_transform(condition_means[present]).to_filename(paths.processed("condition_maps.nii.gz"))
+        logging.info(f"Condition maps saved: {paths.processed('condition_maps.nii.gz')} ({', '.join(trial_types)})")
+
+        # Record the preprocessing (masker parameters, TR, labeling) and the arrays written, in outputs/manifest.json
+        if ctx.persist:
+            record_stage(paths, "transform", [paths.processed(name) for name in (
+                "X.npy", LABELS_FILE, "X_rows.npz", "masker.joblib", "condition_stats.npz", "mean_bold_map.nii.gz",
+                "std_bold_map.nii.gz", "voxel_vs_time.npy", "preprocessed.nii.gz", "preprocessed.nii")],
+                params={**masker_params, "precision": get_dtype().name, "hrf_shift": hrf_shift, "streaming": streaming, "export_4d": export_4d},
+                source=extracted_image_path(paths), n_timepoints=n_timepoints, n_voxels=int(voxel_vs_time.shape[1]),
+                trial_types=list(categories.astype(str)))
+
         return X_filtered, y_filtered
 
     except Exception as e:
@@ -4,89 +4,746 @@ This script serves as the main entry point for the ETL and analysis pipeline.
 It imports functions from the respective modules and executes them in sequence.
 
 Each step us logged to a log file named 'pipeline.log' in the main directory.
+
+Stage cache:
+    - Every stage is fingerprinted from its input files, parameters and code (pipeline/cache.py)
+    - A stage with an unchanged fingerprint reuses its stored outputs from data/cache instead of recomputing
+    - --force recomputes every stage (or --force transform model for some), --no-cache disables the cache
+
+In-memory handoff:
+    - Stages pass X, y, the fitted model and predictions through a PipelineContext (pipeline/context.py)
+    - --no-persist skips writing the intermediate files (X.npy, labels.npz, split.npz, model), this also disables the cache
+
+Streaming preprocessing:
+    - --streaming runs the NiftiMasker preprocessing in slabs of volumes and blocks of voxels (etl/streaming.py)
+    - The preprocessed 4D NIfTI is only written with --export-4d nii|fast|nii.gz (or later with main.py export)
+    - --uncompressed keeps an uncompressed copy of the NIfTI that later stages memory-map instead of gunzipping
+
+Cross-validation:
+    - --cv blocked scores the model over contiguous time blocks (with a gap) (analysis/crossval.py)
+    - Every job is a single run, so --cv only offers blocked folds: leave-one-run-out runs over stacked jobs with
+      python main.py crossval --job SUBJECT:TASK:RUN --job ...
+    - Folds are fitted in parallel (--cv-workers) and share one memory-mapped X
+
+Hyperparameter search:
+    - --search replaces the fixed max_depth=5 tree with the best of a successive halving search (analysis/search.py)
+    - --search-budget SECONDS limits its run time, --search-resource samples|features sets what each round is budgeted on
+
+Precision:
+    - --precision float64 (default) or float32 sets the dtype of the voxel matrix, X.npy and the figure summaries (pipeline/precision.py),
+      float32 halves their memory and disk but its outputs can differ slightly from float64 ones
+    - python main.py check-precision compares a float32 run with a float64 reference run and reports any drift
+
+Region features:
+    - --features regions adds the parcellate stage after transform: X averaged within the regions of a local atlas
+      (--atlas PATH) or of ward / kmeans clusters (--parcellation, --n-regions), saved as X_regions.npy (etl/parcellate.py)
+    - load, model, evaluate, crossval and visualize then read the timepoints x regions matrix instead of X.npy
+
+Incremental engine:
+    - --engine sgd trains an SGD linear model with partial_fit over chunks of the memory-mapped X (--epochs, --chunk-rows)
+    - python main.py pool --job ... --job ... pools several processed jobs into one model with bounded memory
+
+Profiling:
+    - Every stage and key step (fit_transform, clf.fit, each figure, ...) records wall/CPU time, peak memory and bytes read/written
+    - The records of a run are saved to outputs/metrics.json (pipeline/profiling.py), --profile-stage STAGE adds a cProfile dump
+
+Stage selection:
+    - --only evaluate visualize runs just those stages, --from model / --to transform run a range of STAGES
+    - Stages that are not selected are not run, their outputs are read from disk. A selected stage whose inputs are
+      missing (e.g. no X.npy yet) also runs the upstream stage that writes them, see plan_stages()
+    - Stage modules (and nilearn, sklearn, matplotlib, ... with them) are only imported when their stage actually runs,
+      a stage restored from the cache imports nothing
+
+Batch mode:
+    - Pass jobs as SUBJECT:TASK[:RUN] (--job, repeatable) or in a jobs file (--jobs-file)
+    - Jobs run extract -> transform -> load -> model -> evaluate -> visualize in a process pool (--workers)
+    - Every job writes to its own directory under data/jobs/<prefix>/, a failed job does not stop the others
+    - A summary of all jobs is saved to data/jobs/batch_summary.csv
+    - The raw files of all jobs not downloaded yet are downloaded first, concurrently (--download-workers, see etl/download.py)
+
+    python main.py                                   # sub-01, Classification probe without feedback
+    python main.py --job sub-01:Tonecounting --job sub-02:Singletaskweatherprediction:1 --workers 2
+    python main.py --jobs-file jobs.txt --workers 4
+
+Tools (python main.py COMMAND --help), on processed jobs instead of running the stages:
+    - crossval: leave-one-run-out cross-validation over the stacked X of several runs (analysis/crossval.py)
+    - pool: one SGD model trained over several jobs (analysis/incremental.py)
+    - predict / serve: score new scans with a job's saved masker and model, once or as a local HTTP service (analysis/inference.py)
+    - realtime: replay a scan volume by volume and classify each one as it arrives (analysis/realtime.py)
+    - check-precision: float32 vs float64 drift report (pipeline/precision.py)
+    - export: write the preprocessed 4D NIfTI of a job that already ran the transform step (etl/export.py)
+    - compare-reducers: accuracy and training time of the tree with every feature reduction (analysis/features.py)
+    Results are logged to pipeline.log and written next to the jobs' outputs.
 """
 
 import os
+import sys
+import ast
+import time
 import logging
-import etl.extract as etl_part1
-import etl.transform as etl_part2
-import etl.load as etl_part3
-import analysis.model as analysis_part1
-import analysis.evaluate as analysis_part2
-import vis.visualizations as visualize
-
-def main():
+import argparse
+import importlib
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pipeline.paths import job_paths, job_prefix, parse_job, read_jobs_file, stage_files, required_inputs, producer_stage, STAGES, FEATURES
+from pipeline.context import PipelineContext
+from pipeline.store import stage_record, restore_stage_record
+from pipeline.cache import StageCache, run_cached, DEFAULT_MAX_BYTES, DEFAULT_MAX_ENTRIES
+from pipeline.profiling import Profiler, set_profiler, section, file_bytes, profile_call
+from pipeline.precision import PRECISIONS, DEFAULT_PRECISION, set_precision
 
-    #logging inside main()
+base_dir = os.path.dirname(os.path.abspath(__file__)) #main.py directory
+log_file = os.path.join(base_dir, "pipeline.log") #log file path
 
-    base_dir = os.path.dirname(os.path.abspath(__file__)) #main.py directory
-    log_file = os.path.join(base_dir, "pipeline.log") #log file path
 
+def configure_logging():
     # Configure logging
     logging.basicConfig(
         filename=log_file,
         level=logging.INFO,
-        format='%(asctime)s:%(levelname)s:%(message)s',
+        format='%(asctime)s:%(process)d:%(levelname)s:%(message)s',
         force = True  # Force logging configuration to be applied, useful for re-running the script without restarting the interpreter
     )
 
 
+#------------------------------------Stages--------------------------------------
+
+# Cross-validation schemes and search resources (analysis/crossval.py SCHEMES, analysis/search.py RESOURCES),
+# repeated here so the command line works without importing sklearn
+CV_SCHEMES = ("runs", "blocked")
+JOB_CV_SCHEMES = ("blocked",)  # --cv: every job is a single run, leave-one-run-out needs stacked runs (crossval command)
+ENGINES = ("tree", "sgd")  # analysis/incremental.py ENGINES
+PARCELLATIONS = ("ward", "kmeans")  # etl/parcellate.py METHODS without an atlas
+SEARCH_RESOURCES = ("samples", "features")
+
+
+def stage_module(name):
+    """
+    Import a stage module when its stage runs (its heavy libraries are only loaded then).
+    """
+    return importlib.import_module(name)
+
+
+def module_file(name):
+    # Source file of a module without importing it, for the stage fingerprint
+    return importlib.util.find_spec(name).origin
+
+
+def project_module_file(name):
+    # Source file of a module of this project (etl, analysis, pipeline, ...), None for libraries and packages
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    origin = spec.origin if spec else None
+    if origin and origin.endswith(".py") and os.path.dirname(os.path.dirname(origin)) == base_dir:
+        return origin
+    return None
+
+
+def module_files(names):
+    """
+    Source files of the modules in `names` and of every project module they import, directly or through another one
+    (e.g. etl.transform -> etl.labels, pipeline.store, ...), so a change to a helper module invalidates the stage too.
+    Found by parsing the sources, nothing is imported.
+    """
+    files, todo = [], [module_file(name) for name in names]
+    while todo:
+        path = todo.pop()
+        if path in files:
+            continue
+        files.append(path)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                candidates = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                candidates = [node.module] + [f"{node.module}.{alias.name}" for alias in node.names]
+            else:
+                continue
+            todo.extend(f for f in map(project_module_file, candidates) if f and f not in files)
+    return sorted(files)
+
+
+def select_stages(start=None, stop=None, only=None, cv=None, features=None):
+    """
+    Stages asked for on the command line (--from / --to / --only), in pipeline order.
+    crossval is only part of a range with --cv, --only crossval runs it with the default scheme.
+    parcellate is only part of a range with --features regions.
+    """
+    for stage in (start, stop, *(only or ())):
+        if stage is not None and stage not in STAGES:
+            raise ValueError(f"Unknown stage '{stage}', expected one of {STAGES}")
+    if only:
+        return [stage for stage in STAGES if stage in only]
+    first = STAGES.index(start) if start else 0
+    last = STAGES.index(stop) if stop else len(STAGES) - 1
+    if first > last:
+        raise ValueError(f"--from {start} comes after --to {stop}")
+    return [stage for stage in STAGES[first:last + 1]
+            if (stage != "crossval" or cv) and (stage != "parcellate" or features == "regions")]
+
+
+def plan_stages(selected, paths, features="voxels"):
+    """
+    The selected stages plus every upstream stage whose outputs they need and that are not on disk, in pipeline order.
+    """
+    planned = set(selected)
+    for stage in reversed(STAGES):  # upstream stages come earlier, so one backwards pass resolves chains
+        if stage not in planned:
+            continue
+        for path in required_inputs(stage, paths, features):
+            producer = producer_stage(path, paths)
+            if producer is not None and producer not in planned and not os.path.exists(path):
+                logging.info(f"Running {producer} for {stage}: {path} is missing")
+                planned.add(producer)
+    return [stage for stage in STAGES if stage in planned]
+
+
+def run_stage(cache, stage, paths, module, func, params=None, invalidate=True, profile_stage=None, features="voxels", extra_inputs=()):
+    """
+    Run one stage through the stage cache: skipped (returns None) when its fingerprint is unchanged.
+    module: name of the stage's module (or a list of names), its code and the code of the project modules it imports
+    are part of the fingerprint (module_files), found without importing it, func imports the module itself when it runs.
+    features: the feature matrix the stage reads (stage_files), extra_inputs: more files of the fingerprint (e.g. the atlas).
+    The stage is a profiling section (time, CPU, memory, artifact bytes), profile_stage == stage also runs it under cProfile.
+    """
+    inputs, outputs = stage_files(stage, paths, features)
+    inputs = inputs + [p for p in extra_inputs if p]
+    modules = module if isinstance(module, (list, tuple)) else [module]
+    ran = []
+
+    def call():
+        ran.append(True)
+        if profile_stage == stage:
+            return profile_call(func, paths.output(f"profile_{stage}"))
+        return func()
+
+    def restore_record(entry):
+        # The run manifest is not a cached output (later stages record in it too), the stage's own entry is put back
+        if entry:
+            restore_stage_record(paths, stage, entry, outputs)
+
+    with section(stage, bytes_in=file_bytes(inputs)) as record:
+        result = run_cached(cache, stage, call, inputs, outputs, params=params, code=module_files(modules), invalidate=invalidate,
+                            root=paths.data_dir, save_record=lambda: stage_record(paths, stage), restore_record=restore_record)
+        record["cached"] = not ran
+        record["bytes_out"] = file_bytes(outputs)
+    return result
+
+
+def run_pipeline(paths=None, cache=None, options=None):
+    """
+    Run the selected stages (options["stages"], default: all) for one job. Returns True if they completed, False otherwise.
+    Pass cache=None to always recompute every stage.
+    options: run options from parse_args (persist, streaming, ...)
+    """
+    if paths is None:
+        paths = job_paths()
+    paths.make_dirs()
+    options = options or {}
+    persist = options.get("persist", True)
+    streaming = options.get("streaming", False)
+    uncompressed = options.get("uncompressed", False)
+    hrf_shift = options.get("hrf_shift", 0.0)
+    export_4d = options.get("export_4d")
+    cv = options.get("cv")
+    search = options.get("search", False)
+    # Only the options given on the command line, the modules fill in their defaults (their code is fingerprinted too)
+    search_params = {k: options.get(k) for k in ("resource", "time_budget")}
+    cv_params = {k: options.get(k) for k in ("n_folds", "gap")}
+    model_params = {k: options.get(k) for k in ("reduce", "n_features")}
+    engine = options.get("engine") or "tree"
+    incremental_params = {k: options.get(k) for k in ("epochs", "chunk_rows")}
+    features = options.get("features") or "voxels"
+    parcellation_params = {k: options.get(k) for k in ("atlas", "method", "n_regions")}
+    profile_stage = options.get("profile_stage")
+    precision = options.get("precision") or DEFAULT_PRECISION
+    set_precision(precision)  # dtype of voxel_vs_time, X.npy and the figure summaries
+    if not persist:
+        cache = None  # the cache needs the persisted files
+    ctx = PipelineContext(paths, persist=persist, features=features, cache=cache)
+
+    # Every stage and key step records its time, CPU, memory and I/O, saved to outputs/metrics.json
+    profiler = Profiler(job=paths.prefix, subject=paths.subject, task=paths.task, run=paths.run,
+                        options={k: v for k, v in options.items() if k != "force"})
+    previous_profiler = set_profiler(profiler)
+    ok = False
+
     #try/except statements and add to log file
-    try: 
-        logging.info("Pipeline started for subject: sub-01, task: Classification Probe without Feedback ")
+    try:
+        # Selected stages plus the upstream stages whose outputs are not on disk (without persisted files: all of them)
+        stages = plan_stages(options.get("stages") or select_stages(cv=cv, features=features), paths, features)
+        logging.info(f"Pipeline started for subject: {paths.subject}, task: {paths.task}, run: {paths.run} (stages: {', '.join(stages)})")
 
     # Extract data
-        try:
-            fMRI_img, events, nii_path, events_path = etl_part1.extract_data() #run this and add to log file with these parameters
-            logging.info("Data extracted successfully") #message
-        except Exception as e: 
-            logging.error(f"Extract step failed: {e}")
-            raise
+        if "extract" in stages:
+            try:
+                if not all(os.path.exists(p) for p in paths.raw_checksums):
+                    # The extract fingerprint is the checksums of the raw files, which come with their download. Once
+                    # they exist, the files are only downloaded (again) by extract itself on a cache miss: a hit needs no network
+                    with section("download"):
+                        stage_module("etl.extract").download_raw(paths)
+                run_stage(cache, "extract", paths, "etl.extract", lambda: stage_module("etl.extract").extract_data(ctx, uncompressed=uncompressed),
+                          params={"uncompressed": uncompressed}, profile_stage=profile_stage) #run this and add to log file with these parameters
+                logging.info("Data extracted successfully") #message
+            except Exception as e:
+                logging.error(f"Extract step failed: {e}")
+                raise
 
     # Transform data
-        try: 
-            X_filtered, y_filtered = etl_part2.transform_data()
-            logging.info("Data transformed successfully")
-        except Exception as e: 
-            logging.error(f"Transform step failed: {e}")
-            raise
+        if "transform" in stages:
+            try:
+                run_stage(cache, "transform", paths, "etl.transform",
+                          lambda: stage_module("etl.transform").transform_data(ctx=ctx, streaming=streaming, hrf_shift=hrf_shift, export_4d=export_4d),
+                          params={"save_csv": True, "streaming": streaming, "hrf_shift": hrf_shift, "export_4d": export_4d, "precision": precision},
+                          profile_stage=profile_stage)
+                logging.info("Data transformed successfully")
+            except Exception as e:
+                logging.error(f"Transform step failed: {e}")
+                raise
+
+    # Region features (--features regions)
+        if "parcellate" in stages:
+            try:
+                run_stage(cache, "parcellate", paths, "etl.parcellate",
+                          lambda: stage_module("etl.parcellate").parcellate(ctx, **parcellation_params),
+                          params={**parcellation_params, "precision": precision}, profile_stage=profile_stage,
+                          extra_inputs=[parcellation_params["atlas"]])
+                logging.info("Data parcellated successfully")
+            except Exception as e:
+                logging.error(f"Parcellation step failed: {e}")
+                raise
 
     # Load data
-        try:
-            X, y = etl_part3.load_data()
-            logging.info("Data loaded successfully")
-        except Exception as e:
-            logging.error(f'Load step failed: {e}')
-            raise
+        if "load" in stages:
+            try:
+                with section("load"):
+                    X, y = stage_module("etl.load").load_data(ctx)
+                logging.info("Data loaded successfully")
+            except Exception as e:
+                logging.error(f'Load step failed: {e}')
+                raise
 
     # Analyze data
-        try:
-            clf, X_test, y_test, predictions = analysis_part1.build_model()
-            logging.info("Data model trained successfully")
-        except Exception as e:
-            logging.error(f"Model training failed: {e}")
-            raise
+        if "model" in stages:
+            try:
+                if engine == "sgd":
+                    # Out-of-core linear model trained on row chunks of X, saved like the tree (analysis/incremental.py)
+                    run_stage(cache, "model", paths, ["analysis.model", "analysis.incremental"],
+                              lambda: stage_module("analysis.incremental").incremental_model(ctx, **incremental_params),
+                              params={"engine": engine, **incremental_params}, profile_stage=profile_stage, features=features)
+                elif search:
+                    # Hyperparameter search (successive halving), the best model is saved like build_model() does
+                    run_stage(cache, "model", paths, ["analysis.model", "analysis.search"],
+                              lambda: stage_module("analysis.search").search_model(ctx, n_jobs=options.get("search_workers", 1), **search_params),
+                              params={**model_params, **search_params, "search": True}, profile_stage=profile_stage, features=features)
+                else:
+                    run_stage(cache, "model", paths, "analysis.model",
+                              lambda: stage_module("analysis.model").build_model(ctx, reduce=model_params["reduce"], n_features=model_params["n_features"]),
+                              params=model_params, profile_stage=profile_stage, features=features)
+                logging.info("Data model trained successfully")
+            except Exception as e:
+                logging.error(f"Model training failed: {e}")
+                raise
 
     # Evaluate model
-        try:
-            analysis_part2.evaluate_model()
-            logging.info("Data model evaluated successfully")
-        except Exception as e:
-            logging.error(f"Evaluation failed: {e}")
-            raise
+        if "evaluate" in stages:
+            try:
+                run_stage(cache, "evaluate", paths, "analysis.evaluate", lambda: stage_module("analysis.evaluate").evaluate_model(ctx),
+                          profile_stage=profile_stage, features=features)
+                logging.info("Data model evaluated successfully")
+            except Exception as e:
+                logging.error(f"Evaluation failed: {e}")
+                raise
+
+    # Cross-validate model (optional, --cv or --only crossval)
+        if "crossval" in stages:
+            try:
+                run_stage(cache, "crossval", paths, "analysis.crossval",
+                          lambda: stage_module("analysis.crossval").crossvalidate_model(ctx, scheme=cv, n_folds=cv_params["n_folds"], gap=cv_params["gap"],
+                                                                                        n_jobs=options.get("cv_workers", 1),
+                                                                                        reduce=model_params["reduce"], n_features=model_params["n_features"]),
+                          params={**cv_params, "scheme": cv, **model_params}, profile_stage=profile_stage, features=features)
+                logging.info("Data model cross-validated successfully")
+            except Exception as e:
+                logging.error(f"Cross-validation failed: {e}")
+                raise
 
     # Visualize results
-        try: 
-            visualize.create_visualizations()
-            logging.info("Visualization created successfully")
-        except Exception as e:
-            logging.error(f"Visualization failed: {e}")
-            raise
+        if "visualize" in stages:
+            try:
+                # Figures are replaced atomically and skipped when their own inputs are unchanged, so the old ones are kept
+                force_figures = cache is not None and cache.is_forced("visualize")
+                run_stage(cache, "visualize", paths, "vis.visualizations",
+                          lambda: stage_module("vis.visualizations").create_visualizations(ctx, workers=options.get("figure_workers"), force=force_figures),
+                          invalidate=False, profile_stage=profile_stage, features=features)
+                logging.info("Visualization created successfully")
+            except Exception as e:
+                logging.error(f"Visualization failed: {e}")
+                raise
 
-        logging.info("Pipeline completed successfully")
+        logging.info(f"Pipeline completed successfully for {paths.prefix}")
+        ok = True
+        return True
 
     except Exception as e:
         logging.critical(f"Pipeline terminated due to errors: {e}")
+        return False
+
+    finally:
+        set_profiler(previous_profiler)
+        try:
+            profiler.save(paths.output("metrics.json"), status="succeeded" if ok else "failed")
+        except OSError as e:
+            logging.warning(f"Could not save run metrics: {e}")
+
+#------------------------------------Batch mode--------------------------------------
+
+def make_cache(options):
+    """
+    Build the StageCache from the run options of parse_args (None if caching is disabled).
+    """
+    if options is None or options.get("no_cache") or not options.get("persist", True):
+        return None
+    return StageCache(
+        max_bytes=options.get("max_bytes", DEFAULT_MAX_BYTES),
+        max_entries=options.get("max_entries", DEFAULT_MAX_ENTRIES),
+        force=options.get("force", False),
+    )
+
+
+def _run_job(job, options=None):
+    """
+    Worker entry point: runs one (subject, task, run) job in its own process.
+    Never raises, so one failed job cannot take down the pool.
+    """
+    subject, task, run = job
+    configure_logging()
+    cache = make_cache(options)
+    paths = job_paths(subject, task, run, data_dir=os.path.join("data", "jobs", job_prefix(subject, task, run)))
+    start = time.time()
+    try:
+        ok = run_pipeline(paths, cache, options)
+        error = "" if ok else "see pipeline.log"
+    except BaseException as e:  # e.g. MemoryError or a library calling sys.exit
+        logging.critical(f"Job {paths.prefix} crashed: {e!r}")
+        ok, error = False, repr(e)
+    return {
+        "subject": subject,
+        "task": task,
+        "run": "" if run is None else run,
+        "status": "succeeded" if ok else "failed",
+        "seconds": round(time.time() - start, 2),
+        "output_dir": paths.data_dir,
+        "error": error,
+    }
+
+
+def run_batch(jobs, workers=1, options=None):
+    """
+    Run a list of (subject, task, run) jobs in a process pool with `workers` processes.
+    Returns one summary dict per job, in the order the jobs were given.
+    """
+    # Non-interactive matplotlib backend for the worker processes
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    logging.info(f"Batch started: {len(jobs)} jobs, {workers} workers")
+
+    # Fetch the raw files of every job up front with a bounded pool of concurrent downloads,
+    # a failed download only fails its own job (extract retries it and reports the error)
+    # (not needed when extract is not selected, a job whose extracted files are missing still downloads them itself)
+    # (only jobs never downloaded: the others are fingerprinted from their checksum sidecars and download on a cache miss)
+    if "extract" in ((options or {}).get("stages") or STAGES):
+        from etl.download import fetch_many, job_downloads
+        download_workers = (options or {}).get("download_workers", 4)
+        missing = [paths for paths in (job_paths(*job) for job in jobs) if not all(os.path.exists(p) for p in paths.raw_checksums)]
+        fetch_many(job_downloads(missing), workers=download_workers)
+
+    # The jobs already use the CPUs, render each job's figures in its own process
+    if workers > 1 and not (options or {}).get("figure_workers"):
+        options = {**(options or {}), "figure_workers": 1}
+
+    results = {}
+    if workers <= 1:
+        for job in jobs:
+            results[job] = _run_job(job, options)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_run_job, job, options): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    results[job] = future.result()
+                except Exception as e:  # worker process died (e.g. killed for memory)
+                    results[job] = {
+                        "subject": job[0], "task": job[1], "run": "" if job[2] is None else job[2],
+                        "status": "failed", "seconds": None, "output_dir": "", "error": repr(e),
+                    }
+                logging.info(f"Job {job} {results[job]['status']}")
+
+    summary = [results[job] for job in jobs]
+
+    # Save a summary of the batch next to the job directories
+    import pandas as pd
+    summary_path = os.path.join("data", "jobs", "batch_summary.csv")
+    os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+    pd.DataFrame(summary).to_csv(summary_path, index=False)
+
+    n_failed = sum(r["status"] != "succeeded" for r in summary)
+    logging.info(f"Batch finished: {len(jobs) - n_failed} succeeded, {n_failed} failed, summary saved to {summary_path}")
+    return summary
+
+
+#------------------------------------Tools--------------------------------------
+
+# Commands that work on processed jobs (or a job's saved masker and model) instead of running the stages
+TOOLS = ("crossval", "pool", "predict", "serve", "realtime", "check-precision", "export", "compare-reducers")
+
+
+def given(**kwargs):
+    # Only the options given on the command line, the modules fill in their defaults
+    return {k: v for k, v in kwargs.items() if v is not None}
+
+
+def tool_paths(spec=None):
+    # JobPaths of a tool's --job SUBJECT:TASK[:RUN] (default: the default job)
+    return job_paths(*parse_job(spec)) if spec else job_paths()
+
+
+def run_tool(args):
+    """
+    Run the tool named by args.command. Returns the exit code, errors are logged to pipeline.log.
+    """
+    if args.command == "crossval" and len(args.job) < 2:
+        print("crossval stacks several processed jobs, give at least two --job (--cv blocked cross-validates one job)", file=sys.stderr)
+        return 2
+    if args.command == "predict" and not args.inputs:
+        print("predict needs NIfTI files or directories to score", file=sys.stderr)
+        return 2
+    try:
+        if args.command == "crossval":
+            stage_module("analysis.crossval").crossvalidate_jobs(
+                [tool_paths(spec) for spec in args.job], args.out_dir, n_jobs=args.workers, features=args.features,
+                **given(scheme=args.scheme, n_folds=args.folds, gap=args.gap))
+        elif args.command == "pool":
+            stage_module("analysis.incremental").train_pooled(
+                [tool_paths(spec) for spec in args.job] or [tool_paths()], args.out_dir, epochs=args.epochs, chunk_rows=args.chunk_rows, features=args.features)
+        elif args.command in ("predict", "serve"):
+            inference = stage_module("analysis.inference")
+            engine = inference.InferenceEngine.from_job(
+                tool_paths(args.job), streaming=args.streaming, hrf_shift=args.hrf_shift, fast=args.fast,
+                **given(batch_size=args.batch_size))
+            if args.command == "serve":
+                inference.serve(engine, **given(port=args.port, out_dir=args.out_dir, input_root=args.input_root))
+            else:
+                engine.predict_many(args.inputs, args.out_dir or inference.DEFAULT_OUT_DIR)
+        elif args.command == "realtime":
+            stage_module("analysis.realtime").replay_job(
+                tool_paths(args.job), args.scan, fast=args.fast, hrf_shift=args.hrf_shift, out_path=args.out,
+                **given(speed=args.speed, warmup=args.warmup, budget_fraction=args.budget))
+        elif args.command == "check-precision":
+            report = stage_module("pipeline.precision").check_precision(
+                tool_paths(args.job), **given(precision=args.precision, reference=args.reference, tolerance=args.tolerance))
+            return 1 if report["drift"] else 0
+        elif args.command == "export":
+            stage_module("etl.export").export_job(tool_paths(args.job), args.format)
+        elif args.command == "compare-reducers":
+            stage_module("analysis.features").compare_job_reducers(
+                tool_paths(args.job), features=args.features, out_csv=args.out, **given(sizes=args.n_features))
+    except Exception as e:
+        logging.error(f"{args.command} failed: {e!r}")
+        return 1
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="fMRI ETL and analysis pipeline")
+    parser.add_argument("--job", action="append", default=[], metavar="SUBJECT:TASK[:RUN]",
+                        help="Job to run in batch mode (repeatable)")
+    parser.add_argument("--jobs-file", help="File with one SUBJECT:TASK[:RUN] job per line")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes in batch mode (default: number of CPUs)")
+    parser.add_argument("--download-workers", type=int, default=4,
+                        help="Number of concurrent downloads in batch mode")
+    parser.add_argument("--from", dest="start", choices=STAGES, help="First stage to run (earlier outputs are read from disk)")
+    parser.add_argument("--to", dest="stop", choices=STAGES, help="Last stage to run")
+    parser.add_argument("--only", nargs="+", choices=STAGES, metavar="STAGE", help="Run only these stages (plus any whose outputs are missing)")
+    parser.add_argument("--force", nargs="*", metavar="STAGE",
+                        help="Recompute stages even if cached (no names: all stages)")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the stage cache")
+    parser.add_argument("--no-persist", action="store_true",
+                        help="Keep intermediate arrays and models in memory only (implies --no-cache)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Chunked preprocessing with bounded memory for long or high-resolution runs")
+    parser.add_argument("--hrf-shift", type=float, default=0.0,
+                        help="Shift event onsets by this many seconds for the hemodynamic lag when labeling timepoints")
+    parser.add_argument("--reduce", choices=("none", "anova", "variance", "pca"),
+                        help="Feature reduction before the decision tree (fitted on the training split)")
+    parser.add_argument("--n-features", type=int, help="Voxels (anova, variance) or components (pca) to keep")
+    parser.add_argument("--cv", choices=JOB_CV_SCHEMES,
+                        help="Also cross-validate the model over blocked time folds (leave-one-run-out needs several stacked runs, see the crossval command)")
+    parser.add_argument("--cv-folds", type=int, help="Number of blocked folds")
+    parser.add_argument("--cv-gap", type=int, help="Timepoints left out of training around each test block")
+    parser.add_argument("--cv-workers", type=int, default=os.cpu_count() or 1, help="Folds fitted in parallel")
+    parser.add_argument("--features", choices=FEATURES, default="voxels",
+                        help="Columns of the matrix the model reads: voxels (X.npy) or region means (parcellate stage, X_regions.npy)")
+    parser.add_argument("--atlas", help="Local 3D label image whose regions are averaged (implies --features regions)")
+    parser.add_argument("--parcellation", choices=PARCELLATIONS, help="Data-driven regions without an atlas (default: ward)")
+    parser.add_argument("--n-regions", type=int, help="Number of data-driven regions")
+    parser.add_argument("--engine", choices=ENGINES, default="tree",
+                        help="Model engine: decision tree (in memory) or an SGD linear model trained on chunks of X read from disk")
+    parser.add_argument("--epochs", type=int, help="Passes over the training rows (--engine sgd)")
+    parser.add_argument("--chunk-rows", type=int, help="Rows of X per training chunk (--engine sgd, default: about 64 MB)")
+    parser.add_argument("--search", action="store_true",
+                        help="Search the classifier's hyperparameters with successive halving instead of max_depth=5")
+    parser.add_argument("--search-resource", choices=SEARCH_RESOURCES,
+                        help="Budget of the search rounds: training rows (samples) or top ANOVA voxels (features)")
+    parser.add_argument("--search-budget", type=float, metavar="SECONDS", help="Time budget of the search")
+    parser.add_argument("--search-workers", type=int, default=os.cpu_count() or 1, help="Candidates fitted in parallel")
+    parser.add_argument("--figure-workers", type=int, help="Processes rendering figures (default: number of CPUs, 1 per job in batch mode)")
+    parser.add_argument("--export-4d", choices=("nii", "fast", "nii.gz"),
+                        help="Also write the preprocessed 4D NIfTI: uncompressed, gzip level 1 (fast) or default gzip")
+    parser.add_argument("--precision", choices=PRECISIONS, default=DEFAULT_PRECISION,
+                        help="Floating point dtype of the voxel matrix and stored arrays (default float64; float32 halves their size, "
+                             "main.py check-precision checks it against float64)")
+    parser.add_argument("--profile-stage", choices=STAGES,
+                        help="Run this stage under cProfile (outputs/profile_<stage>.prof and .txt)")
+    parser.add_argument("--uncompressed", action="store_true",
+                        help="Keep an uncompressed .nii copy of the image for later stages to memory-map")
+    parser.add_argument("--cache-max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024**3,
+                        help="Maximum size of data/cache before old entries are evicted")
+    parser.add_argument("--cache-max-entries", type=int, default=DEFAULT_MAX_ENTRIES,
+                        help="Maximum number of cache entries before old entries are evicted")
+
+    # Tools (python main.py COMMAND --help), their --job options are read from processed jobs
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND", help="Run a tool instead of the pipeline: " + ", ".join(TOOLS))
+    job_help = "Processed job (default: the default job)"
+    tool = commands.add_parser("crossval", help="Cross-validate over the stacked X of several processed jobs (leave-one-run-out)")
+    tool.add_argument("--job", action="append", default=[], metavar="SUBJECT:TASK[:RUN]", help="Processed job to stack (repeatable)")
+    tool.add_argument("--scheme", choices=CV_SCHEMES, help="runs (leave-one-run-out, default) or blocked")
+    tool.add_argument("--folds", type=int, help="Number of blocks (blocked scheme)")
+    tool.add_argument("--gap", type=int, help="Timepoints between test and training rows")
+    tool.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Folds fitted in parallel")
+    tool.add_argument("--features", choices=FEATURES, default="voxels", help="Voxel matrices or region matrices (parcellate stage)")
+    tool.add_argument("--out-dir", default=os.path.join("data", "jobs", "crossval"), help="Where to write X.npy and the cross-validation results")
+
+    tool = commands.add_parser("pool", help="Train one SGD model incrementally over the X of several processed jobs")
+    tool.add_argument("--job", action="append", default=[], metavar="SUBJECT:TASK[:RUN]", help="Processed job to include (repeatable)")
+    tool.add_argument("--epochs", type=int, help="Passes over the training rows")
+    tool.add_argument("--chunk-rows", type=int, help="Rows of X per partial_fit call (default: about 64 MB)")
+    tool.add_argument("--features", choices=FEATURES, default="voxels", help="Voxel matrices or region matrices (parcellate stage)")
+    tool.add_argument("--out-dir", default=os.path.join("data", "jobs", "incremental"), help="Where to write the pooled model and metrics")
+
+    for name, help_text in (("predict", "Score new scans with a job's saved masker and model"),
+                            ("serve", "Keep a job's masker and model loaded as a local HTTP service")):
+        tool = commands.add_parser(name, help=help_text)
+        if name == "predict":
+            tool.add_argument("inputs", nargs="*", help="NIfTI files or directories of NIfTI files")
+        else:
+            tool.add_argument("--port", type=int, help="Port of the service (localhost only, default 8765)")
+            tool.add_argument("--input-root", help="Directory the service may read scans from (default: data)")
+        tool.add_argument("--job", metavar="SUBJECT:TASK[:RUN]", help=job_help)
+        tool.add_argument("--out-dir", help="Where to write <name>_predictions.csv (default: data/outputs/inference)")
+        tool.add_argument("--batch-size", type=int, help="Timepoints per predict() call")
+        tool.add_argument("--streaming", action="store_true", help="Preprocess scans chunk by chunk with bounded memory")
+        tool.add_argument("--hrf-shift", type=float, default=0.0, help="Onset shift (seconds) when labeling timepoints from events files")
+        tool.add_argument("--fast", action="store_true", help="Only preprocess the voxels the model uses (sparse-voxel path)")
+
+    tool = commands.add_parser("realtime", help="Replay a scan volume by volume and classify every volume as it arrives")
+    tool.add_argument("scan", nargs="?", help="NIfTI file to replay, scored on all its volumes (default: the job's extracted run, scored on its test split only)")
+    tool.add_argument("--job", metavar="SUBJECT:TASK[:RUN]", help=job_help)
+    tool.add_argument("--speed", type=float, help="Replay speed, 1 = one volume per TR (default), 0 = as fast as possible")
+    tool.add_argument("--warmup", type=int, help="Volumes used only to start the running state")
+    tool.add_argument("--budget", type=float, help="Latency budget as a fraction of the TR")
+    tool.add_argument("--fast", action="store_true", help="Only preprocess the voxels the tree uses (sparse-voxel path)")
+    tool.add_argument("--hrf-shift", type=float, default=0.0, help="Onset shift (seconds) when labeling volumes from the events file")
+    tool.add_argument("--out", help="Latency CSV (default: the job's outputs/realtime_latency.csv)")
+
+    tool = commands.add_parser("check-precision", help="Run a job in float32 and float64 and report any drift (outputs/precision_check.json)")
+    tool.add_argument("--job", metavar="SUBJECT:TASK[:RUN]", help="Job to check, its raw files must be downloaded")
+    tool.add_argument("--precision", choices=PRECISIONS, help="Precision to check (default float32)")
+    tool.add_argument("--reference", choices=PRECISIONS, help="Reference precision (default float64)")
+    tool.add_argument("--tolerance", type=float, help="Largest metric difference that is not drift")
+
+    tool = commands.add_parser("export", help="Write the preprocessed 4D NIfTI of a processed job")
+    tool.add_argument("--job", metavar="SUBJECT:TASK[:RUN]", help=job_help)
+    tool.add_argument("--format", choices=("nii", "fast", "nii.gz"), default="fast",
+                      help="Uncompressed, gzip level 1 (fast, default) or default gzip")
+
+    tool = commands.add_parser("compare-reducers", help="Compare the feature reductions on a processed job (outputs/feature_reduction.csv)")
+    tool.add_argument("--job", metavar="SUBJECT:TASK[:RUN]", help=job_help)
+    tool.add_argument("--n-features", type=int, nargs="+", help="Voxels or components kept by every reducer (default: 31 100 1000)")
+    tool.add_argument("--features", choices=FEATURES, default="voxels", help="Voxel matrix or region matrix (parcellate stage)")
+    tool.add_argument("--out", help="Comparison CSV (default: the job's outputs/feature_reduction.csv)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging()
+    if args.command:
+        return run_tool(args)
+    if args.only and (args.start or args.stop):
+        print("--only cannot be combined with --from / --to", file=sys.stderr)
+        return 2
+    if args.search and (args.reduce not in (None, "none") or args.n_features is not None):
+        # The search scores candidates on all voxels (or its own ANOVA budget with --search-resource features)
+        print("--search cannot be combined with --reduce / --n-features, use --search-resource features "
+              "to search over the number of voxels", file=sys.stderr)
+        return 2
+    features = "regions" if args.atlas else args.features
+    try:
+        stages = select_stages(args.start, args.stop, args.only, cv=args.cv, features=features)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    options = {
+        "no_cache": args.no_cache,
+        "force": True if args.force == [] else set(args.force or ()),
+        "max_bytes": int(args.cache_max_gb * 1024**3),
+        "max_entries": args.cache_max_entries,
+        "persist": not args.no_persist,
+        "streaming": args.streaming,
+        "uncompressed": args.uncompressed,
+        "download_workers": args.download_workers,
+        "hrf_shift": args.hrf_shift,
+        "reduce": args.reduce,
+        "n_features": args.n_features,
+        "cv": args.cv,
+        "n_folds": args.cv_folds,
+        "gap": args.cv_gap,
+        "cv_workers": args.cv_workers,
+        "search": args.search,
+        "resource": args.search_resource,
+        "time_budget": args.search_budget,
+        "search_workers": args.search_workers,
+        "figure_workers": args.figure_workers,
+        "export_4d": args.export_4d,
+        "profile_stage": args.profile_stage,
+        "stages": stages,
+        "precision": args.precision,
+        "engine": args.engine,
+        "epochs": args.epochs,
+        "chunk_rows": args.chunk_rows,
+        "features": features,
+        "atlas": args.atlas,
+        "method": args.parcellation,
+        "n_regions": args.n_regions,
+    }
+
+    jobs = [parse_job(spec) for spec in args.job]
+    if args.jobs_file:
+        jobs += read_jobs_file(args.jobs_file)
+    jobs = list(dict.fromkeys(jobs))  # drop duplicate jobs, keep order
+
+    # No jobs given: run the original single pipeline (sub-01, Classification probe without feedback)
+    if not jobs:
+        return 0 if run_pipeline(cache=make_cache(options), options=options) else 1
+
+    summary = run_batch(jobs, workers=max(1, min(args.workers, len(jobs))), options=options)
+    return 0 if all(r["status"] == "succeeded" for r in summary) else 1
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,296 @@
+'''
+Content-hashed cache for pipeline stages.
+
+Each stage gets a fingerprint built from:
+    - the content (sha256) of every input file
+    - the stage parameters (e.g. NiftiMasker settings, max_depth)
+    - the source code of the module that implements the stage and of the project modules it imports
+If a stage runs again with the same fingerprint, its stored outputs are put back in place instead of recomputing them.
+
+Entries live in data/cache/<stage>/<fingerprint>/ with a manifest.json.
+State that several stages share is not an output (e.g. the run manifest, pipeline/store.py): run_cached() stores
+what the stage contributed to it with the entry (save_record) and puts that back on a cache hit (restore_record).
+Files are hard-linked into the cache when possible (so caching costs no extra disk space), otherwise copied.
+The cache is limited by total size and number of entries, least recently used entries are evicted first.
+
+Run main.py to execute the pipeline (use --force to recompute stages, --no-cache to disable the cache).
+'''
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+DEFAULT_CACHE_DIR = os.path.join("data", "cache")
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # code files are keyed relative to it
+DEFAULT_MAX_BYTES = 20 * 1024**3  # 20 GB
+DEFAULT_MAX_ENTRIES = 200
+_HASH_BLOCK = 4 * 1024 * 1024  # read files in 4 MB blocks when hashing
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard-link src to dst (replacing dst), fall back to a copy across file systems.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class StageCache:
+    """
+    Fingerprint stages and store/restore their output files.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                 max_entries=DEFAULT_MAX_ENTRIES, force=False, enabled=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # force: True to recompute every stage, or a collection of stage names to recompute
+        self.force = force
+        self.enabled = enabled
+        self._digests_path = os.path.join(cache_dir, "digests.json")
+        self._digests = None
+
+    #------------------------------------Fingerprints--------------------------------------
+
+    def _load_digests(self):
+        if self._digests is None:
+            try:
+                with open(self._digests_path) as f:
+                    self._digests = json.load(f)
+            except (OSError, ValueError):
+                self._digests = {}
+        return self._digests
+
+    def _save_digests(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._digests, f)
+        os.replace(tmp, self._digests_path)
+
+    def file_digest(self, path):
+        """
+        sha256 of a file. Digests are remembered per (path, size, mtime, inode) so unchanged
+        multi-hundred MB NIfTI files are only hashed once.
+        """
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        digests = self._load_digests()
+        key = os.path.abspath(path)
+        entry = digests.get(key)
+        if entry and entry["stamp"] == stamp:
+            return entry["sha256"]
+        digest = _hash_file(path)
+        digests[key] = {"stamp": stamp, "sha256": digest}
+        self._save_digests()
+        return digest
+
+    def fingerprint(self, stage, inputs=(), params=None, code=(), root=None):
+        """
+        Fingerprint of a stage: its name, the content of its input files, its parameters
+        and the source files in `code`. Missing input files are part of the fingerprint too.
+        Inputs are keyed by their path relative to `root` (the job directory), code files by their path relative to
+        the project directory, so two files with the same name in different directories do not collide
+        (e.g. analysis/model.py and a future etl/model.py).
+        """
+        record = {
+            "stage": stage,
+            "inputs": {
+                (os.path.relpath(p, root) if root else p): (self.file_digest(p) if os.path.exists(p) else None)
+                for p in inputs
+            },
+            "params": params or {},
+            "code": {os.path.relpath(os.path.abspath(p), PROJECT_DIR): self.file_digest(p) for p in code},
+        }
+        blob = json.dumps(record, sort_keys=True, default=str).encode()
+        return hashlib.sha256(blob).hexdigest()
+
+    #------------------------------------Store / restore--------------------------------------
+
+    def _entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def is_forced(self, stage):
+        if isinstance(self.force, bool):
+            return self.force
+        return stage in self.force
+
+    def restore(self, stage, key, outputs):
+        """
+        Put the cached outputs of (stage, key) at the paths in `outputs`.
+        Returns True on a cache hit, False if the stage has to run.
+        """
+        if not self.enabled or self.is_forced(stage):
+            return False
+        entry = self._entry_dir(stage, key)
+        manifest_path = os.path.join(entry, "manifest.json")
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if len(manifest["outputs"]) != len(outputs):
+            return False
+        try:
+            for dst, stored in zip(outputs, manifest["outputs"]):
+                if stored is None:
+                    # output was not produced by this stage run (e.g. optional file), drop a stale one from another run
+                    if os.path.lexists(dst):
+                        os.unlink(dst)
+                    continue
+                src = os.path.join(entry, stored)
+                if os.path.exists(dst) and os.path.samefile(src, dst):
+                    continue
+                os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+                _link_or_copy(src, dst)
+        except OSError as e:
+            logging.warning(f"Cache entry {entry} is incomplete ({e}), recomputing {stage}")
+            return False
+
+        # Mark as recently used for eviction
+        manifest["last_used"] = time.time()
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        logging.info(f"Cache hit for {stage} ({key[:12]}), reused {sum(o is not None for o in manifest['outputs'])} outputs")
+        return True
+
+    def entry_record(self, stage, key):
+        """
+        The record saved with the entry (stage, key) by store(), None if there is none.
+        """
+        try:
+            with open(os.path.join(self._entry_dir(stage, key), "manifest.json")) as f:
+                return json.load(f).get("record")
+        except (OSError, ValueError):
+            return None
+
+    def store(self, stage, key, outputs, params=None, record=None):
+        """
+        Save the outputs of a finished stage under (stage, key), then evict old entries.
+        record: JSON data kept with the entry (see run_cached).
+        """
+        if not self.enabled:
+            return
+        entry = self._entry_dir(stage, key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix=".tmp-")
+        stored, size = [], 0
+        for i, src in enumerate(outputs):
+            if not os.path.exists(src):
+                stored.append(None)
+                continue
+            name = f"{i}_{os.path.basename(src)}"
+            _link_or_copy(src, os.path.join(tmp, name))
+            stored.append(name)
+            size += os.path.getsize(src)
+        manifest = {
+            "stage": stage,
+            "fingerprint": key,
+            "params": params or {},
+            "outputs": stored,
+            "record": record,
+            "bytes": size,
+            "created": time.time(),
+            "last_used": time.time(),
+        }
+        with open(os.path.join(tmp, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2, default=str)
+
+        # Atomic publish, another worker may have stored the same entry meanwhile
+        if os.path.exists(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        logging.info(f"Cached {stage} outputs ({size / 1e6:.1f} MB) as {key[:12]}")
+        self.evict()
+
+    def invalidate(self, outputs):
+        """
+        Remove stage outputs before recomputing them. Outputs may be hard links into the cache,
+        and writing into them in place would corrupt the cached copy.
+        """
+        for path in outputs:
+            if os.path.lexists(path):
+                os.unlink(path)
+
+    #------------------------------------Eviction--------------------------------------
+
+    def entries(self):
+        """
+        List all cache entries as (last_used, bytes, path), oldest first.
+        """
+        found = []
+        if not os.path.isdir(self.cache_dir):
+            return found
+        for stage in os.listdir(self.cache_dir):
+            stage_dir = os.path.join(self.cache_dir, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                try:
+                    with open(os.path.join(stage_dir, key, "manifest.json")) as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                found.append((manifest.get("last_used", 0), manifest.get("bytes", 0), os.path.join(stage_dir, key)))
+        return sorted(found)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is within max_bytes and max_entries.
+        """
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        while entries and (total > self.max_bytes or (self.max_entries is not None and len(entries) > self.max_entries)):
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            logging.info(f"Evicted cache entry {path} ({size / 1e6:.1f} MB)")
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self._digests = None
+
+
+def run_cached(cache, stage, func, inputs=(), outputs=(), params=None, code=(), invalidate=True, root=None,
+               save_record=None, restore_record=None):
+    """
+    Run func() unless `cache` holds outputs for the same fingerprint.
+    Returns func()'s result, or None when the outputs were restored from the cache.
+    invalidate=False keeps the old outputs for stages that replace their files atomically and reuse unchanged ones.
+    root: directory the input paths are keyed relative to (the job's data_dir)
+    save_record() is called after func() ran and returns JSON data stored with the entry, restore_record(data) gets it
+    back on a cache hit: what the stage wrote into a file shared with other stages, which is not one of its outputs
+    (restoring a stored copy of the whole file would undo what later stages wrote into it).
+    """
+    if cache is None or not cache.enabled:
+        return func()
+    key = cache.fingerprint(stage, inputs, params, code, root=root)
+    if cache.restore(stage, key, outputs):
+        if restore_record is not None:
+            restore_record(cache.entry_record(stage, key))
+        return None
+    if invalidate:
+        cache.invalidate(outputs)
+    result = func()
+    cache.store(stage, key, outputs, params, record=save_record() if save_record is not None else None)
+    return result
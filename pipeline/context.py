@@ -0,0 +1,119 @@
+'''
+Pipeline context: hands arrays, labels and fitted models from one stage to the next in memory.
+
+Stages used to talk to each other only through files (X.npy, y.csv, X_test.npy, the joblib model),
+so every run re-read the same voxel matrix several times.
+Now each stage stores its results on the context and the next stage takes them from there.
+
+Writing to disk is a persistence step:
+    - persist=True (default) also saves the intermediate files, needed for the stage cache and for re-running single stages
+    - persist=False keeps everything in memory (only the small CSV summaries and figures are written)
+The run's stage cache (None with --no-cache / --no-persist) rides along for stages that cache parts of their own work
+(the search folds, the figure fingerprints).
+If a value is not in memory (e.g. the stage producing it was restored from the stage cache), it is loaded from disk on first use.
+X is opened with memory mapping (pipeline/matrix.py) and the test set is read as rows of X through the split indices.
+With features="regions" the stages after parcellate get the timepoints x regions matrix (X_regions.npy) as X.
+Labels and predictions are read from the typed artifact files (labels.npz, predictions.npz, see pipeline/store.py).
+pandas is only imported when a CSV is actually read, so main.py starts fast when the stages that need it are skipped.
+
+Run main.py to execute the pipeline.
+'''
+import os
+import numpy as np
+from pipeline.paths import job_paths, MATRIX_FILES
+from pipeline.matrix import open_matrix, take_rows, load_split
+from pipeline.store import LABELS_FILE, PREDICTIONS_FILE, load_labels, decode_labels, load_predictions
+from pipeline.precision import get_dtype
+
+
+class PipelineContext:
+    """
+    In-memory state of one job, shared by all stages.
+    """
+
+    def __init__(self, paths=None, persist=True, features="voxels", cache=None):
+        self.paths = paths if paths is not None else job_paths()
+        self.persist = persist
+        self.features = features
+        self.cache = cache if persist else None  # StageCache of the run, None: nothing is cached
+
+        # extract
+        self.fMRI_img = None
+        self.events = None
+        # transform / load
+        self.X = None
+        self.y = None
+        self.rows = None  # (timepoint, run) of every row of X
+        # parcellate
+        self.X_regions = None
+        # model
+        self.clf = None
+        self.X_test = None
+        self.y_test = None
+        self.predictions = None
+
+    #------------------------------------Lazy loaders (fall back to the persisted files)--------------------------------------
+
+    def get_X(self, features=None):
+        """
+        Feature matrix of the job: voxels (X.npy) or regions (X_regions.npy), default: the context's features.
+        """
+        if (features or self.features) == "regions":
+            if self.X_regions is None:
+                self.X_regions = open_matrix(self.paths.processed(MATRIX_FILES["regions"]))
+            return self.X_regions
+        if self.X is None:
+            self.X = open_matrix(self.paths.processed(MATRIX_FILES["voxels"]))
+        return self.X
+
+    def get_y(self):
+        if self.y is None:
+            labels_path = self.paths.processed(LABELS_FILE)
+            if os.path.exists(labels_path):
+                self.y = decode_labels(*load_labels(labels_path))
+            else:
+                import pandas as pd  # y.csv written before the artifact store (pipeline/store.py)
+                self.y = pd.read_csv(self.paths.processed("y.csv"))["label"].values
+        return self.y
+
+    def get_rows(self):
+        """
+        (timepoint, run) arrays for the rows of X. Falls back to consecutive timepoints of one run
+        for X.npy files written before X_rows.npz existed.
+        """
+        if self.rows is None:
+            try:
+                with np.load(self.paths.processed("X_rows.npz")) as f:
+                    self.rows = f["timepoint"], f["run"]
+            except FileNotFoundError:
+                n = len(self.get_y())
+                self.rows = np.arange(n), np.ones(n, dtype=int)
+        return self.rows
+
+    def get_model(self):
+        if self.clf is None:
+            import joblib
+            self.clf = joblib.load(self.paths.output("decision_tree_model.joblib"))
+        return self.clf
+
+    def get_test_set(self):
+        if self.X_test is None or self.y_test is None:
+            _, test_idx = load_split(self.paths.output("split.npz"))
+            if self.X_test is None:
+                self.X_test = take_rows(self.get_X(), test_idx, dtype=get_dtype())
+            if self.y_test is None:
+                self.y_test = self.get_y()[test_idx]  # the test labels are the labels at the test rows, not stored twice
+        return self.X_test, self.y_test
+
+    def get_predictions(self):
+        """
+        (y_true, y_pred) of the test set, from memory or from predictions.npz.
+        Returns None if neither is available.
+        """
+        if self.predictions is not None and self.y_test is not None:
+            return self.y_test, self.predictions
+        try:
+            predictions = load_predictions(self.paths.output(PREDICTIONS_FILE))
+        except FileNotFoundError:
+            return None
+        return predictions["y_true"], predictions["y_pred"]
@@ -0,0 +1,156 @@
+'''
+Memory-mapped, chunked storage for the voxel matrix X (timepoints x voxels).
+
+X is saved as a plain .npy file, which numpy can open with memory mapping, so stages
+only page in the rows/columns they actually touch instead of loading the full matrix.
+The train/test split is stored as index arrays into that one file (split.npz), not as a second copy of X.
+
+Helpers:
+    - open_matrix: open X read-only with memory mapping
+    - create_matrix: create an X file on disk and fill it incrementally
+    - iter_rows / iter_cols: walk X in row or column chunks of bounded size
+    - take_rows: gather rows by index in chunks (optionally straight into float32, the dtype sklearn trees use)
+    - row_block: rows by index as a slice of the memory map when they are contiguous, take_rows otherwise
+    - copy_rows: same, but into a new .npy file instead of memory
+    - column_mean / column_std: per-voxel statistics over row chunks
+    - save_split / load_split: train/test index arrays
+
+Run main.py to execute the pipeline.
+'''
+import os
+import numpy as np
+
+CHUNK_BYTES = 64 * 1024**2  # target size of one chunk (64 MB)
+
+
+def open_matrix(path, mode="r"):
+    """
+    Open an .npy matrix with memory mapping (mode 'r' read-only, 'r+' read/write).
+    """
+    return np.load(path, mmap_mode=mode)
+
+
+def create_matrix(path, shape, dtype=np.float64):
+    """
+    Create an .npy file of the given shape and return it as a writable memory map.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+
+
+def save_matrix(path, X):
+    """
+    Save X as .npy (memory-mappable on load).
+    """
+    np.save(path, X)
+
+
+def chunk_size(n_other, itemsize, chunk_bytes=CHUNK_BYTES):
+    """
+    Number of rows (or columns) per chunk so a chunk stays around chunk_bytes.
+    """
+    return max(1, int(chunk_bytes // max(1, n_other * itemsize)))
+
+
+def iter_rows(X, chunk_rows=None):
+    """
+    Yield (start, stop, X[start:stop]) row chunks.
+    """
+    if chunk_rows is None:
+        chunk_rows = chunk_size(X.shape[1], X.dtype.itemsize)
+    for start in range(0, X.shape[0], chunk_rows):
+        stop = min(start + chunk_rows, X.shape[0])
+        yield start, stop, X[start:stop]
+
+
+def iter_cols(X, chunk_cols=None):
+    """
+    Yield (start, stop, X[:, start:stop]) column chunks (e.g. blocks of voxels).
+    """
+    if chunk_cols is None:
+        chunk_cols = chunk_size(X.shape[0], X.dtype.itemsize)
+    for start in range(0, X.shape[1], chunk_cols):
+        stop = min(start + chunk_cols, X.shape[1])
+        yield start, stop, X[:, start:stop]
+
+
+def take_rows(X, idx, dtype=None, chunk_rows=None):
+    """
+    Gather X[idx] chunk by chunk into a new in-memory array of `dtype` (default: X's dtype).
+    Only the selected rows are read from a memory-mapped X.
+    """
+    idx = np.asarray(idx)
+    dtype = X.dtype if dtype is None else np.dtype(dtype)
+    out = np.empty((len(idx), X.shape[1]), dtype=dtype)
+    if chunk_rows is None:
+        chunk_rows = chunk_size(X.shape[1], X.dtype.itemsize)
+    for start in range(0, len(idx), chunk_rows):
+        stop = min(start + chunk_rows, len(idx))
+        out[start:stop] = X[idx[start:stop]]
+    return out
+
+
+def row_block(X, idx, dtype=None):
+    """
+    X[idx] as a slice of X (no copy, a memory-mapped X stays on disk) when idx is one contiguous ascending range
+    and X already has `dtype`, else gathered with take_rows.
+    """
+    idx = np.asarray(idx)
+    dtype = X.dtype if dtype is None else np.dtype(dtype)
+    if len(idx) and X.dtype == dtype and idx[-1] - idx[0] == len(idx) - 1 and np.all(np.diff(idx) == 1):
+        return X[idx[0]:idx[-1] + 1]
+    return take_rows(X, idx, dtype=dtype)
+
+
+def copy_rows(X, idx, path, dtype=None, chunk_rows=None):
+    """
+    Write X[idx] to a new .npy file chunk by chunk and return it as a read-only memory map.
+    """
+    idx = np.asarray(idx)
+    dtype = X.dtype if dtype is None else np.dtype(dtype)
+    out = create_matrix(path, (len(idx), X.shape[1]), dtype=dtype)
+    if chunk_rows is None:
+        chunk_rows = chunk_size(X.shape[1], X.dtype.itemsize)
+    for start in range(0, len(idx), chunk_rows):
+        stop = min(start + chunk_rows, len(idx))
+        out[start:stop] = X[idx[start:stop]]
+    out.flush()
+    del out
+    return open_matrix(path)
+
+
+def column_mean(X, chunk_rows=None):
+    """
+    Mean of each column (X.mean(axis=0)) computed over row chunks.
+    """
+    total = np.zeros(X.shape[1], dtype=np.float64)
+    for _, _, block in iter_rows(X, chunk_rows):
+        total += block.sum(axis=0, dtype=np.float64)
+    return total / max(1, X.shape[0])
+
+
+def column_std(X, mean=None, chunk_rows=None):
+    """
+    Standard deviation of each column (X.std(axis=0)) over row chunks, a second pass around the column means.
+    """
+    mean = column_mean(X, chunk_rows) if mean is None else mean
+    total = np.zeros(X.shape[1], dtype=np.float64)
+    for _, _, block in iter_rows(X, chunk_rows):
+        centered = np.asarray(block, dtype=np.float64) - mean
+        total += np.einsum("ij,ij->j", centered, centered)
+    return np.sqrt(total / max(1, X.shape[0]))
+
+
+def save_split(path, train_idx, test_idx):
+    """
+    Save the train/test split as row indices into X.
+    """
+    np.savez(path, train_idx=np.asarray(train_idx), test_idx=np.asarray(test_idx))
+
+
+def load_split(path):
+    """
+    Load (train_idx, test_idx) saved by save_split.
+    """
+    with np.load(path) as split:
+        return split["train_idx"], split["test_idx"]
@@ -0,0 +1,275 @@
+'''
+Path layout for one pipeline job (subject, task, run).
+
+Every stage used to hard-code sub-01 and the 'Classification probe without feedback' task.
+A job is now described by a JobPaths object, and each stage reads and writes its files through it.
+
+Layout:
+    - The default job keeps the original layout (data/extracted, data/processed, data/outputs)
+    - Batch jobs write to data/jobs/<prefix>/ so several jobs can run side by side
+    - Raw downloads always go to data/raw, so they are shared between jobs
+
+Run main.py to execute the pipeline.
+'''
+import os
+from dataclasses import dataclass
+
+DEFAULT_SUBJECT = "sub-01"
+DEFAULT_TASK = "Classificationprobewithoutfeedback"
+
+# ds000011 tasks (see README.md), runs are only used by the two weather prediction tasks
+TASKS = (
+    "Classificationprobewithoutfeedback",
+    "Dualtaskweatherprediction",
+    "Singletaskweatherprediction",
+    "Tonecounting",
+)
+
+# Set OPENNEURO_URL to download from somewhere else (e.g. a local mirror or test server)
+OPENNEURO_URL = os.environ.get("OPENNEURO_URL", "https://s3.amazonaws.com/openneuro/ds000011/ds000011_R2.0.1/uncompressed")
+
+
+def job_prefix(subject=DEFAULT_SUBJECT, task=DEFAULT_TASK, run=None):
+    """
+    BIDS file prefix for a job, e.g. sub-01_task-Tonecounting or sub-02_task-Singletaskweatherprediction_run-01
+    """
+    prefix = f"{subject}_task-{task}"
+    if run is not None:
+        prefix += f"_run-{int(run):02d}"
+    return prefix
+
+
+CHECKSUM_SUFFIX = ".sha256"  # sidecar of a verified download
+
+
+@dataclass(frozen=True)
+class JobPaths:
+    """
+    All file locations used by one job.
+    """
+    subject: str = DEFAULT_SUBJECT
+    task: str = DEFAULT_TASK
+    run: int = None
+    data_dir: str = "data"      # per-job root (extracted, processed, outputs)
+    raw_dir: str = os.path.join("data", "raw")  # shared download directory
+
+    @property
+    def prefix(self):
+        return job_prefix(self.subject, self.task, self.run)
+
+    @property
+    def extracted_dir(self):
+        return os.path.join(self.data_dir, "extracted")
+
+    @property
+    def processed_dir(self):
+        return os.path.join(self.data_dir, "processed")
+
+    @property
+    def outputs_dir(self):
+        return os.path.join(self.data_dir, "outputs")
+
+    # Remote files
+    @property
+    def nii_url(self):
+        return f"{OPENNEURO_URL}/{self.subject}/func/{self.prefix}_bold.nii.gz"
+
+    @property
+    def events_url(self):
+        return f"{OPENNEURO_URL}/{self.subject}/func/{self.prefix}_events.tsv"
+
+    # Raw downloads
+    @property
+    def raw_nii(self):
+        return os.path.join(self.raw_dir, f"{self.prefix}_bold.nii.gz")
+
+    @property
+    def raw_events(self):
+        return os.path.join(self.raw_dir, f"{self.prefix}_events.tsv")
+
+    @property
+    def raw_checksums(self):
+        # "<sha256> <size>" sidecars written next to the raw files once they are verified (etl/download.py)
+        return [path + CHECKSUM_SUFFIX for path in (self.raw_nii, self.raw_events)]
+
+    # Extract outputs
+    @property
+    def extracted_nii(self):
+        return os.path.join(self.extracted_dir, f"{self.prefix}_bold.nii.gz")
+
+    @property
+    def extracted_nii_uncompressed(self):
+        return os.path.join(self.extracted_dir, f"{self.prefix}_bold.nii")
+
+    @property
+    def extracted_events(self):
+        return os.path.join(self.extracted_dir, f"{self.prefix}_events.tsv")
+
+    def processed(self, suffix):
+        """
+        Path of a transform output, e.g. processed("X.npy") -> data/processed/<prefix>_X.npy
+        """
+        return os.path.join(self.processed_dir, f"{self.prefix}_{suffix}")
+
+    def output(self, name):
+        """
+        Path of a model/evaluation/visualization output, e.g. output("split.npz")
+        """
+        return os.path.join(self.outputs_dir, name)
+
+    def make_dirs(self):
+        for d in (self.raw_dir, self.extracted_dir, self.processed_dir, self.outputs_dir):
+            os.makedirs(d, exist_ok=True)
+
+
+# Order in which main.py runs the stages
+STAGES = ("extract", "transform", "parcellate", "load", "model", "evaluate", "crossval", "visualize")
+
+# Run manifest (pipeline/store.py record_stage): every stage adds its own entry, so it is not a cached output of any of them,
+# a stage restored from the stage cache records its entry again (main.py run_stage)
+MANIFEST_FILE = "manifest.json"
+
+# Feature matrix the stages after transform read: one column per voxel, or per region (etl/parcellate.py)
+FEATURES = ("voxels", "regions")
+MATRIX_FILES = {"voxels": "X.npy", "regions": "X_regions.npy"}
+
+
+def stage_files(stage, paths, features="voxels"):
+    """
+    Input and output files of a stage for one job, used to fingerprint and cache the stage.
+    features: the matrix load, model, evaluate, crossval and visualize read (voxels: X.npy, regions: X_regions.npy).
+    Returns (inputs, outputs).
+    """
+    processed = paths.processed
+    output = paths.output
+    matrix = processed(MATRIX_FILES[features])
+    if stage == "extract":
+        # The raw files are fingerprinted by the checksums of their download sidecars: a cache hit neither reads nor downloads them
+        return paths.raw_checksums, [paths.extracted_nii, paths.extracted_events, paths.extracted_nii_uncompressed]
+    if stage == "transform":
+        return [paths.extracted_nii, paths.extracted_nii_uncompressed, paths.extracted_events], [
+            processed("mean_bold_map.nii.gz"),
+            processed("std_bold_map.nii.gz"),
+            processed("preprocessed.nii.gz"),  # --export-4d nii.gz / fast only
+            processed("preprocessed.nii"),     # --export-4d nii only
+            processed("mean_bold.csv"),
+            processed("X.npy"),
+            processed("labels.npz"),
+            processed("X_rows.npz"),
+            processed("masker.joblib"),
+            processed("bold_task_correlation.csv"),
+            processed("mean_bold_per_trial.csv"),
+            processed("condition_stats.npz"),
+            processed("condition_maps.nii.gz"),
+            processed("voxel_vs_time.npy"),  # streaming mode only
+        ]
+    if stage == "parcellate":
+        return [processed("X.npy"), processed("masker.joblib")], [
+            processed("X_regions.npy"),
+            processed("regions.npz"),
+            processed("regions.nii.gz"),
+        ]
+    if stage == "load":
+        return [matrix, processed("labels.npz")], []
+    if stage == "model":
+        return [matrix, processed("labels.npz"), processed("masker.joblib")], [
+            output("decision_tree_model.joblib"),
+            output("split.npz"),
+            output("predictions.npz"),
+            output("search_results.csv"),  # --search only
+        ]
+    if stage == "evaluate":
+        return [output("decision_tree_model.joblib"), matrix, output("split.npz"), processed("labels.npz")], [
+            output("predictions.npz"),
+            output("evaluation_metrics.csv"),
+        ]
+    if stage == "crossval":
+        return [matrix, processed("labels.npz"), processed("X_rows.npz")], [
+            output("cv_metrics.csv"),
+            output("cv_predictions.npz"),
+        ]
+    if stage == "visualize":
+        return [
+            matrix,
+            processed("labels.npz"),
+            processed("mean_bold_per_trial.csv"),
+            processed("mean_bold_map.nii.gz"),
+            output("decision_tree_model.joblib"),
+            output("evaluation_metrics.csv"),
+            output("predictions.npz"),
+        ], [
+            output("mean_signal_over_time.png"),
+            output("decision_tree_plot.png"),
+            output("confusion_matrix.png"),
+            output("mean_bold_per_voxel.png"),
+            output("mean_bold_brain_map.png"),
+            output("figures.json"),
+        ]
+    raise ValueError(f"Unknown stage '{stage}', expected one of {STAGES}")
+
+
+def required_inputs(stage, paths, features="voxels"):
+    """
+    Inputs a stage cannot run without: its stage_files() inputs minus the optional ones (the uncompressed .nii copy).
+    """
+    inputs, _ = stage_files(stage, paths, features)
+    return [p for p in inputs if p != paths.extracted_nii_uncompressed]
+
+
+def producer_stage(path, paths):
+    """
+    The stage that writes `path` for this job, None for files no stage writes (the raw downloads and their sidecars).
+    """
+    for stage in STAGES:
+        if path in stage_files(stage, paths)[1]:
+            return stage
+    return None
+
+
+def job_paths(subject=DEFAULT_SUBJECT, task=DEFAULT_TASK, run=None, data_dir=None, raw_dir=None):
+    """
+    Build the JobPaths for a job.
+    The default job (sub-01, classification probe, no run) writes straight into data/ like before,
+    other jobs get their own directory under data/jobs/.
+    """
+    if data_dir is None:
+        if (subject, task, run) == (DEFAULT_SUBJECT, DEFAULT_TASK, None):
+            data_dir = "data"
+        else:
+            data_dir = os.path.join("data", "jobs", job_prefix(subject, task, run))
+    if raw_dir is None:
+        raw_dir = os.path.join("data", "raw")
+    return JobPaths(subject=subject, task=task, run=run, data_dir=data_dir, raw_dir=raw_dir)
+
+
+def parse_job(spec):
+    """
+    Parse a job written as SUBJECT:TASK[:RUN], e.g. 'sub-02:Tonecounting' or 'sub-03:Singletaskweatherprediction:1'
+    """
+    parts = spec.strip().split(":")
+    if len(parts) not in (2, 3) or not all(parts):
+        raise ValueError(f"Invalid job '{spec}', expected SUBJECT:TASK[:RUN]")
+    subject, task = parts[0], parts[1]
+    if not subject.startswith("sub-"):
+        subject = f"sub-{int(subject):02d}"
+    run = int(parts[2]) if len(parts) == 3 else None
+    return subject, task, run
+
+
+def read_jobs_file(path):
+    """
+    Read a jobs file: one SUBJECT:TASK[:RUN] (or tab/comma separated subject, task, run) per line.
+    Blank lines and lines starting with '#' are ignored.
+    """
+    jobs = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            for sep in ("\t", ","):
+                if sep in line:
+                    line = ":".join(p.strip() for p in line.split(sep) if p.strip())
+                    break
+            jobs.append(parse_job(line))
+    return jobs
@@ -0,0 +1,183 @@
+'''
+Pipeline-wide floating point precision (dtype policy), with an equivalence check against float64.
+
+The voxel matrix used to come out of NiftiMasker as float64 and stay float64 through X.npy, the test rows and the
+figures, twice the memory and I/O the z-scored signal needs. The working dtype is now set once per run
+(main.py --precision float32, the default stays float64 so existing outputs do not change) and used by:
+    - transform: NiftiMasker(dtype=...) and stream_transform(), so voxel_vs_time, X.npy and voxel_vs_time.npy are in it
+    - storage: X is written and memory-mapped in it (pipeline/matrix.py keeps the file's dtype)
+    - modeling: the training / test rows, cross-validation and search folds and the pooled SGD chunks are read in it
+      (the tree converts to float32 internally, with float32 X that is no conversion)
+    - plotting: the summaries handed to the figure tasks (mean signal, maps) are cast to it
+Accumulators (column means/stds, per-condition statistics) stay float64 whatever the policy, so the
+summaries of a float32 matrix do not lose precision over many timepoints.
+
+check_precision() runs extract, transform, model and evaluate of one job twice, with a float64 reference and with
+the candidate dtype (float32), in data directories and processes of their own, and reports any drift: metric
+differences, labels and predictions that changed, the largest difference in X, and the artifact sizes and per-stage
+peak memory of both runs. Each run gets a fresh process so its peak memory is not inflated by the other one.
+The report is saved to outputs/precision_check.json of the job.
+
+Run main.py check-precision [--job SUBJECT:TASK[:RUN]] to execute the check.
+'''
+import os
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+PRECISIONS = ("float32", "float64")
+DEFAULT_PRECISION = "float64"    # main.py --precision default, float32 is opt-in
+CANDIDATE_PRECISION = "float32"  # what check_precision compares with the reference
+REFERENCE_PRECISION = "float64"
+METRIC_TOLERANCE = 0.01  # metric differences above this are reported as drift
+
+_dtype = np.dtype(DEFAULT_PRECISION)
+
+
+def set_precision(precision):
+    """
+    Set the working dtype of the pipeline (a name from PRECISIONS, None keeps the current one). Returns the previous name.
+    """
+    global _dtype
+    previous = _dtype.name
+    if precision is not None:
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+        _dtype = np.dtype(precision)
+    return previous
+
+
+def get_dtype():
+    return _dtype
+
+
+def as_working(array):
+    """
+    The array in the working dtype (no copy if it already is).
+    """
+    return np.asarray(array).astype(_dtype, copy=False)
+
+#------------------------------------Equivalence check--------------------------------------
+
+def _run(paths, precision):
+    """
+    Run extract -> evaluate of a job with one precision into its own data directory. Returns its summary.
+    """
+    from pipeline.paths import job_paths
+    from pipeline.context import PipelineContext
+    from pipeline.profiling import Profiler, set_profiler
+    from pipeline.store import LABELS_FILE, PREDICTIONS_FILE, load_labels, load_predictions
+    from etl.extract import extract_data
+    from etl.transform import transform_data
+    from analysis.model import build_model
+    from analysis.evaluate import evaluate_model
+
+    run_paths = job_paths(paths.subject, paths.task, paths.run,
+                          data_dir=os.path.join(paths.outputs_dir, "precision_check", precision), raw_dir=paths.raw_dir)
+    run_paths.make_dirs()
+    ctx = PipelineContext(run_paths)
+    profiler = Profiler(precision=precision)
+    previous_profiler, previous_precision = set_profiler(profiler), set_precision(precision)
+    try:
+        for stage, func in (("extract", lambda: extract_data(ctx)), ("transform", lambda: transform_data(ctx=ctx)),
+                            ("model", lambda: build_model(ctx)), ("evaluate", lambda: evaluate_model(ctx))):
+            with profiler.section(stage):
+                func()
+    finally:
+        set_profiler(previous_profiler)
+        set_precision(previous_precision)
+
+    import pandas as pd
+    artifact_bytes = sum(os.path.getsize(os.path.join(d, f)) for d in (run_paths.processed_dir, run_paths.outputs_dir)
+                         for f in os.listdir(d) if os.path.isfile(os.path.join(d, f)))
+    return {
+        "paths": run_paths,
+        "metrics": pd.read_csv(run_paths.output("evaluation_metrics.csv")).iloc[0].to_dict(),
+        "labels": load_labels(run_paths.processed(LABELS_FILE)),
+        "predictions": load_predictions(run_paths.output(PREDICTIONS_FILE)),
+        "X_dtype": str(np.load(run_paths.processed("X.npy"), mmap_mode="r").dtype),
+        "X_bytes": os.path.getsize(run_paths.processed("X.npy")),
+        "artifact_bytes": artifact_bytes,
+        "peak_rss_mb": {r["name"]: r["peak_rss_mb"] for r in profiler.records if r["parent"] is None},
+        "wall_s": {r["name"]: r["wall_s"] for r in profiler.records if r["parent"] is None},
+    }
+
+
+def _init_worker(log_file, level):
+    # Log to the parent's log file from the spawned process
+    if log_file:
+        logging.basicConfig(filename=log_file, level=level, format='%(asctime)s:%(process)d:%(levelname)s:%(message)s')
+
+
+def _run_isolated(paths, precision):
+    """
+    _run() in a fresh process: the peak memory (VmHWM) of its stages is not inflated by a run that came before it.
+    """
+    root = logging.getLogger()
+    log_file = next((h.baseFilename for h in root.handlers if isinstance(h, logging.FileHandler)), None)
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(log_file, root.level)) as pool:
+        return pool.submit(_run, paths, precision).result()
+
+
+def _max_abs_diff(path_a, path_b):
+    from pipeline.matrix import iter_rows
+    A, B = np.load(path_a, mmap_mode="r"), np.load(path_b, mmap_mode="r")
+    if A.shape != B.shape:
+        return None
+    diff = 0.0
+    for start, stop, block in iter_rows(A):
+        diff = max(diff, float(np.max(np.abs(np.asarray(block, dtype=np.float64) - B[start:stop]), initial=0.0)))
+    return diff
+
+
+def check_precision(paths=None, precision=CANDIDATE_PRECISION, reference=REFERENCE_PRECISION, tolerance=METRIC_TOLERANCE):
+    """
+    Compare a run in `precision` with a `reference` run of the same job, each in its own process. Returns the report
+    (also saved as outputs/precision_check.json), report["drift"] lists what differs beyond the tolerance.
+    """
+    from pipeline.paths import job_paths
+    paths = paths if paths is not None else job_paths()
+    ref, cand = _run_isolated(paths, reference), _run_isolated(paths, precision)
+
+    metric_diffs = {k: abs(cand["metrics"][k] - ref["metrics"][k]) for k in ref["metrics"]}
+    labels_identical = bool(np.array_equal(ref["labels"][0], cand["labels"][0]) and np.array_equal(ref["labels"][1], cand["labels"][1]))
+    same_rows = np.array_equal(ref["predictions"]["rows"], cand["predictions"]["rows"])
+    agreement = float(np.mean(ref["predictions"]["y_pred"] == cand["predictions"]["y_pred"])) if same_rows else None
+
+    drift = [f"{k} differs by {d:.4g}" for k, d in metric_diffs.items() if d > tolerance]
+    if not labels_identical:
+        drift.append("labels differ")
+    if agreement is None:
+        drift.append("test rows differ")
+    elif agreement < 1.0:
+        drift.append(f"{(1 - agreement) * 100:.1f}% of test predictions differ")
+
+    report = {
+        "job": paths.prefix,
+        "precision": precision,
+        "reference": reference,
+        "tolerance": tolerance,
+        "metrics": {precision: cand["metrics"], reference: ref["metrics"]},
+        "metric_diffs": metric_diffs,
+        "labels_identical": labels_identical,
+        "prediction_agreement": agreement,
+        "X_max_abs_diff": _max_abs_diff(cand["paths"].processed("X.npy"), ref["paths"].processed("X.npy")),
+        "X_dtype": {precision: cand["X_dtype"], reference: ref["X_dtype"]},
+        "X_bytes": {precision: cand["X_bytes"], reference: ref["X_bytes"]},
+        "artifact_bytes": {precision: cand["artifact_bytes"], reference: ref["artifact_bytes"]},
+        "peak_rss_mb": {precision: cand["peak_rss_mb"], reference: ref["peak_rss_mb"]},
+        "wall_s": {precision: cand["wall_s"], reference: ref["wall_s"]},
+        "drift": drift,
+    }
+    report_path = paths.output("precision_check.json")
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    if drift:
+        logging.warning(f"Precision check {precision} vs {reference}: drift found ({'; '.join(drift)}), report saved to {report_path}")
+    else:
+        logging.info(f"Precision check {precision} vs {reference}: no drift, report saved to {report_path}")
+    return report
@@ -0,0 +1,198 @@
+'''
+Per-stage profiling and resource instrumentation.
+
+main.py only logged "started / succeeded / failed". Every stage, and key steps inside the stages
+(fit_transform, inverse_transform, clf.fit, every figure, ...), now runs in a profiling section that records:
+    - wall_s: wall-clock time
+    - cpu_s: CPU time of this process plus finished child processes (e.g. figure workers)
+    - peak_rss_mb: peak resident memory during the section (Linux: VmHWM, reset at the start of each section;
+      elsewhere the process lifetime peak, peak_rss_scope = "process")
+    - read_bytes / write_bytes: bytes read and written by the process during the section (/proc/self/io rchar/wchar,
+      includes reads served from the page cache), disk_read_bytes / disk_write_bytes: what actually hit storage
+    - extra fields per section, e.g. bytes_in / bytes_out (size of a stage's input and output artifacts) and cached
+Sections nest (a figure inside visualize), every record has its parent's name.
+
+Records of one pipeline run are written to data/outputs/metrics.json (one file per job, machine-readable).
+profile_call() optionally runs one chosen stage under cProfile (main.py --profile-stage STAGE) and dumps
+profile_<stage>.prof (for snakeviz / pstats) and a profile_<stage>.txt summary next to it.
+
+Code in the stages calls section(name): it records into the current profiler, or does nothing if there is none.
+
+Run main.py to execute the pipeline.
+'''
+import os
+import json
+import time
+import pstats
+import socket
+import logging
+import cProfile
+import resource
+from contextlib import contextmanager
+
+_current = None  # profiler of the running pipeline, see set_profiler()
+
+
+def _peak_rss_kb():
+    """
+    Peak resident memory (kB) since the last reset, and whether it can be reset per section.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]), True
+    except OSError:
+        pass
+    # ru_maxrss: kB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (peak // 1024 if os.uname().sysname == "Darwin" else peak), False
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # resets VmHWM to the current RSS
+        return True
+    except OSError:
+        return False
+
+
+def _io_counters():
+    """
+    (read, write, disk read, disk write) bytes of this process so far.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["rchar"]), int(io["wchar"]), int(io["read_bytes"]), int(io["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return 0, 0, usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def _cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def file_bytes(paths):
+    """
+    Total size of the files in `paths` that exist.
+    """
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+class Profiler:
+    """
+    Collects one record per profiling section of a pipeline run.
+    """
+
+    def __init__(self, **meta):
+        self.meta = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "host": socket.gethostname(), "pid": os.getpid(), **meta}
+        self.records = []
+        self._stack = []
+        self._resettable = _reset_peak_rss()
+
+    @contextmanager
+    def section(self, name, **info):
+        """
+        Profile the block as section `name`. Yields the record dict, extra fields can be added to it.
+        """
+        # The peak so far belongs to every open section, then start a fresh peak for this one
+        peak, _ = _peak_rss_kb()
+        for open_record in self._stack:
+            open_record["_peak_kb"] = max(open_record["_peak_kb"], peak)
+        if self._resettable:
+            _reset_peak_rss()
+
+        record = {"name": name, "parent": self._stack[-1]["name"] if self._stack else None, **info}
+        record["_peak_kb"] = 0
+        io_start, cpu_start, wall_start = _io_counters(), _cpu_seconds(), time.perf_counter()
+        self._stack.append(record)
+        try:
+            yield record
+            record.setdefault("status", "ok")
+        except BaseException:
+            record["status"] = "failed"
+            raise
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = _cpu_seconds() - cpu_start
+            io_end = _io_counters()
+            peak, resettable = _peak_rss_kb()
+            self._stack.pop()
+            for open_record in self._stack:
+                open_record["_peak_kb"] = max(open_record["_peak_kb"], peak)
+            record.update({
+                "wall_s": round(wall, 4),
+                "cpu_s": round(cpu, 4),
+                "peak_rss_mb": round(max(record.pop("_peak_kb"), peak) / 1024, 1),
+                "peak_rss_scope": "section" if resettable and self._resettable else "process",
+                "read_bytes": io_end[0] - io_start[0],
+                "write_bytes": io_end[1] - io_start[1],
+                "disk_read_bytes": io_end[2] - io_start[2],
+                "disk_write_bytes": io_end[3] - io_start[3],
+            })
+            self.records.append(record)
+            logging.info(f"[profile] {name}: {wall:.2f}s wall, {cpu:.2f}s CPU, peak RSS {record['peak_rss_mb']} MB"
+                         + (" (cached)" if record.get("cached") else ""))
+
+    def add(self, record, parent=None):
+        """
+        Add a record measured elsewhere (e.g. by a Profiler in a worker process).
+        """
+        parent = parent or (self._stack[-1]["name"] if self._stack else None)
+        self.records.append({**record, "parent": parent})
+
+    def save(self, path, **meta):
+        """
+        Write the run's records to a JSON metrics file.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({**self.meta, **meta, "sections": self.records}, f, indent=2, default=str)
+        os.replace(tmp_path, path)
+        logging.info(f"Run metrics saved to {path}")
+        return path
+
+
+def set_profiler(profiler):
+    """
+    Make `profiler` the one section() records into (None to stop profiling). Returns the previous one.
+    """
+    global _current
+    previous, _current = _current, profiler
+    return previous
+
+
+def get_profiler():
+    return _current
+
+
+@contextmanager
+def section(name, **info):
+    """
+    Profiling section in the current profiler, a no-op (yielding a throwaway dict) when nothing is being profiled.
+    """
+    if _current is None:
+        yield dict(info)
+    else:
+        with _current.section(name, **info) as record:
+            yield record
+
+
+def profile_call(func, out_prefix, top=30):
+    """
+    Run func() under cProfile, dump the stats to <out_prefix>.prof and a summary of the top functions to <out_prefix>.txt.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        os.makedirs(os.path.dirname(out_prefix) or ".", exist_ok=True)
+        profiler.dump_stats(out_prefix + ".prof")
+        with open(out_prefix + ".txt", "w") as f:
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(top)
+        logging.info(f"cProfile stats saved to {out_prefix}.prof")
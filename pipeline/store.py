@@ -0,0 +1,201 @@
+'''
+Compact, typed artifact store of a run: labels, predictions and a manifest.
+
+Labels used to go through text files (y.csv, y_test.csv, test_predictions.csv) that every stage re-parsed
+with pandas and compared as Python object strings. Now:
+    - Labels are integer codes plus a category table (<prefix>_labels.npz: codes, categories), the test labels
+      are not stored at all, they are the labels at the test rows of split.npz
+    - Predictions are arrays of codes into one category table, with the rows of X they belong to
+      (predictions.npz: y_true, y_pred, categories, rows; cv_predictions.npz also has the fold of every row)
+    - outputs/manifest.json records, per stage, the parameters it ran with (masker parameters, TR, classifier, ...),
+      the shape, dtype and size of every artifact it wrote, and where the run came from (code commit, library
+      versions, host, time)
+.npz files are written uncompressed, loading is one read per array with no parsing. Small summaries meant for
+people (evaluation_metrics.csv, cv_metrics.csv) stay CSV.
+
+load_labels() and load_predictions() read the .npz files back (decode_labels() turns codes into label strings).
+
+Run main.py to execute the pipeline.
+'''
+import os
+import json
+import time
+import socket
+import logging
+import platform
+import subprocess
+import numpy as np
+from pipeline.paths import MANIFEST_FILE
+
+LABELS_FILE = "labels.npz"             # per job, in processed/ (paths.processed)
+PREDICTIONS_FILE = "predictions.npz"   # test set predictions, in outputs/
+CV_PREDICTIONS_FILE = "cv_predictions.npz"
+LIBRARIES = ("numpy", "pandas", "nibabel", "nilearn", "scikit-learn", "joblib")
+
+#------------------------------------Labels and predictions--------------------------------------
+
+def code_dtype(n_categories):
+    return np.int16 if n_categories < np.iinfo(np.int16).max else np.int32
+
+
+def encode_labels(labels, categories=None):
+    """
+    (codes, categories) for an array of labels. categories: sorted table to encode into (default: the labels' unique values).
+    """
+    labels = np.asarray(labels).astype(str)
+    if categories is None:
+        categories, codes = np.unique(labels, return_inverse=True)
+    else:
+        categories = np.asarray(categories).astype(str)
+        codes = np.searchsorted(categories, labels)
+        if len(categories) == 0 or np.any(categories[np.minimum(codes, len(categories) - 1)] != labels):
+            raise ValueError("Labels not in the category table")
+    return codes.astype(code_dtype(len(categories))), categories
+
+
+def decode_labels(codes, categories):
+    return np.asarray(categories)[codes]
+
+
+def save_labels(path, codes, categories):
+    """
+    Save labels as codes into a category table (an .npz with codes and categories).
+    """
+    categories = np.asarray(categories).astype(str)
+    np.savez(path, codes=np.asarray(codes).astype(code_dtype(len(categories))), categories=categories)
+    return path
+
+
+def load_labels(path):
+    """
+    (codes, categories) of a labels file.
+    """
+    with np.load(path) as f:
+        return f["codes"], f["categories"]
+
+
+def save_predictions(path, y_true, y_pred, rows=None, **extra):
+    """
+    Save true and predicted labels as codes into one category table, with the rows of X they belong to.
+    extra: more per-row arrays (e.g. fold for the cross-validation predictions).
+    """
+    categories = np.unique(np.concatenate([np.asarray(y_true).astype(str), np.asarray(y_pred).astype(str)]))
+    true_codes, _ = encode_labels(y_true, categories)
+    pred_codes, _ = encode_labels(y_pred, categories)
+    rows = np.arange(len(true_codes)) if rows is None else np.asarray(rows)
+    np.savez(path, y_true=true_codes, y_pred=pred_codes, categories=categories, rows=rows, **extra)
+    return path
+
+
+def load_predictions(path):
+    """
+    Predictions file as a dict of arrays, y_true / y_pred decoded to labels.
+    """
+    with np.load(path) as f:
+        data = {name: f[name] for name in f.files}
+    for name in ("y_true", "y_pred"):
+        data[name] = decode_labels(data[name], data["categories"])
+    return data
+
+#------------------------------------Manifest--------------------------------------
+
+def _commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5)
+        return result.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def provenance():
+    """
+    Where and with what the artifacts were made: code commit, Python and library versions, host.
+    """
+    from importlib import metadata
+    versions = {}
+    for name in LIBRARIES:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return {"commit": _commit(), "python": platform.python_version(), "libraries": versions, "host": socket.gethostname()}
+
+
+def describe(path):
+    """
+    Shape, dtype and size of an artifact (read from the file headers, arrays are not loaded).
+    """
+    info = {"file": os.path.basename(path), "bytes": os.path.getsize(path)}
+    if path.endswith(".npy"):
+        X = np.load(path, mmap_mode="r")
+        info.update(shape=list(X.shape), dtype=str(X.dtype))
+    elif path.endswith(".npz"):
+        with np.load(path) as f:
+            info["arrays"] = {}
+            for name in f.files:
+                array = f[name]
+                info["arrays"][name] = {"shape": list(array.shape), "dtype": str(array.dtype)}
+    return info
+
+
+def manifest_path(paths):
+    return paths.output(MANIFEST_FILE)
+
+
+def load_manifest(paths):
+    try:
+        with open(manifest_path(paths)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_stage(paths, stage, artifacts=(), params=None, **info):
+    """
+    Record in the job's manifest what a stage wrote (existing files of `artifacts`) and the parameters it ran with.
+    A stage's entry replaces the one from its previous run, other stages' entries are kept.
+    """
+    manifest = load_manifest(paths)
+    manifest.update({"job": paths.prefix, "subject": paths.subject, "task": paths.task, "run": paths.run})
+    manifest["provenance"] = provenance()
+    manifest.setdefault("stages", {})[stage] = {
+        "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": params or {},
+        **info,
+        "artifacts": {os.path.basename(p): describe(p) for p in artifacts if os.path.exists(p)},
+    }
+    path = manifest_path(paths)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, default=_json_default)
+    os.replace(tmp_path, path)
+    logging.info(f"Manifest updated for {stage}: {path}")
+    return manifest
+
+
+def stage_record(paths, stage):
+    """
+    The stage's entry in the job's manifest (None if it did not record one).
+    """
+    return load_manifest(paths).get("stages", {}).get(stage)
+
+
+def restore_stage_record(paths, stage, entry, outputs=()):
+    """
+    Record a stage restored from the stage cache again: the parameters and info of the entry it recorded when it ran
+    (stage_record), its artifacts (the restored files among `outputs`) described anew and marked cached.
+    """
+    info = {k: v for k, v in entry.items() if k not in ("finished", "params", "artifacts", "cached")}
+    artifacts = [p for p in outputs if os.path.basename(p) in entry.get("artifacts", {})]
+    return record_stage(paths, stage, artifacts, entry.get("params"), cached=True, **info)
+
+
+def _json_default(value):
+    # numpy scalars and arrays in parameters
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
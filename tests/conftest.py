@@ -0,0 +1,65 @@
+'''
+Shared fixtures: a tiny synthetic job (bench/synthetic.py) run through extract and transform.
+'''
+import pytest
+
+
+def process(paths):
+    # Extract and transform one synthetic run
+    from pipeline.context import PipelineContext
+    from etl.extract import extract_data
+    from etl.transform import transform_data
+
+    paths.make_dirs()
+    ctx = PipelineContext(paths)
+    extract_data(ctx)
+    transform_data(ctx=ctx)
+    return paths
+
+
+@pytest.fixture(scope="session")
+def processed_job(tmp_path_factory):
+    """
+    JobPaths of a tiny synthetic run with its processed files (X.npy, labels.npz, masker.joblib, ...).
+    """
+    from bench.synthetic import generate, SCALES
+
+    root = tmp_path_factory.mktemp("synthetic")
+    paths, = generate(shape=SCALES["tiny"]["shape"], n_timepoints=SCALES["tiny"]["n_timepoints"],
+                      data_dir=str(root / "job"), raw_dir=str(root / "raw"))
+    return process(paths)
+
+
+@pytest.fixture(scope="session")
+def first_runs(tmp_path_factory):
+    """
+    JobPaths of run 1 of two synthetic subjects, processed in their own job directories.
+    Same seed, so both runs get the same brain mask.
+    """
+    from bench.synthetic import generate, SCALES
+
+    root = tmp_path_factory.mktemp("subjects")
+    return [process(generate(subject, shape=SCALES["tiny"]["shape"], n_timepoints=SCALES["tiny"]["n_timepoints"], n_runs=2,
+                             data_dir=str(root / subject), raw_dir=str(root / "raw"))[0])
+            for subject in ("sub-01", "sub-02")]
+
+
+@pytest.fixture
+def shifted_mask_job(processed_job, tmp_path):
+    """
+    Copy of processed_job whose saved brain mask is shifted by one voxel: same number of columns, different voxels.
+    """
+    import shutil
+    import joblib
+    import numpy as np
+    import nibabel as nib
+    from pipeline.paths import job_paths
+
+    paths = job_paths(processed_job.subject, processed_job.task, processed_job.run,
+                      data_dir=str(tmp_path / "shifted"), raw_dir=processed_job.raw_dir)
+    shutil.copytree(processed_job.data_dir, paths.data_dir)
+    masker = joblib.load(paths.processed("masker.joblib"))
+    mask = np.asarray(masker.mask_img_.dataobj)
+    masker.mask_img_ = nib.Nifti1Image(np.roll(mask, 1, axis=0), masker.mask_img_.affine)
+    joblib.dump(masker, paths.processed("masker.joblib"))
+    return paths
@@ -0,0 +1,43 @@
+'''
+etl/aggregate.py grouped statistics against the per-condition fancy-index copies they replace.
+'''
+import numpy as np
+import pytest
+from pipeline.matrix import save_matrix, open_matrix
+from etl.aggregate import condition_stats, condition_summary
+
+
+@pytest.fixture
+def X_codes(tmp_path):
+    rng = np.random.default_rng(0)
+    codes = rng.integers(-1, 3, 80)  # -1 = rest
+    X = rng.normal(loc=np.linspace(0, 50, 23), scale=np.linspace(0.5, 4, 23), size=(80, 23))
+    save_matrix(str(tmp_path / "X.npy"), X)
+    return open_matrix(str(tmp_path / "X.npy")), codes
+
+
+def test_stats_match_the_fancy_index_copies(X_codes):
+    X, codes = X_codes
+    counts, means, variances = condition_stats(X, codes, 3, chunk_cols=5)  # blocks that do not divide the voxels
+    for g in range(3):
+        rows = np.asarray(X[codes == g])
+        assert counts[g] == len(rows)
+        assert np.allclose(means[g], rows.mean(axis=0))
+        assert np.allclose(variances[g], rows.var(axis=0))
+
+
+def test_summary_is_the_std_over_all_values(X_codes):
+    # Mean of the voxel variances plus the variance of the voxel means (law of total variance)
+    X, codes = X_codes
+    counts, means, variances = condition_stats(X, codes, 3)
+    grand_mean, grand_std = condition_summary(counts, means, variances)
+    for g in range(3):
+        rows = np.asarray(X[codes == g])
+        assert grand_mean[g] == pytest.approx(rows.mean())
+        assert grand_std[g] == pytest.approx(rows.std())
+
+
+def test_empty_condition_has_zero_count(X_codes):
+    X, codes = X_codes
+    counts, means, _ = condition_stats(X, np.where(codes == 2, -1, codes), 3)
+    assert counts[2] == 0 and not means[2].any()
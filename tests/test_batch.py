@@ -0,0 +1,49 @@
+'''
+Batch mode: job specs, jobs files and a failed job not stopping the others (main.py run_batch).
+'''
+import os
+import pandas as pd
+import pytest
+import main
+from pipeline.paths import parse_job, read_jobs_file, job_paths
+
+
+def test_parse_job():
+    assert parse_job("sub-02:Tonecounting") == ("sub-02", "Tonecounting", None)
+    assert parse_job(" 3:Singletaskweatherprediction:1 ") == ("sub-03", "Singletaskweatherprediction", 1)
+    for spec in ("sub-02", "sub-02::1", "sub-02:Tonecounting:1:2"):
+        with pytest.raises(ValueError, match="SUBJECT:TASK"):
+            parse_job(spec)
+
+
+def test_read_jobs_file(tmp_path):
+    path = tmp_path / "jobs.txt"
+    path.write_text("# subject, task, run\nsub-01:Tonecounting\n\n2\tSingletaskweatherprediction\t1\nsub-03, Tonecounting\n")
+    assert read_jobs_file(str(path)) == [
+        ("sub-01", "Tonecounting", None),
+        ("sub-02", "Singletaskweatherprediction", 1),
+        ("sub-03", "Tonecounting", None),
+    ]
+
+
+def test_jobs_get_their_own_directories():
+    assert job_paths().data_dir == "data"
+    assert job_paths("sub-02", "Tonecounting", 1).data_dir == os.path.join("data", "jobs", "sub-02_task-Tonecounting_run-01")
+
+
+def test_failed_job_does_not_stop_the_batch(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "configure_logging", lambda: None)
+
+    def run_pipeline(paths, cache, options):
+        if paths.subject == "sub-02":
+            raise MemoryError
+        return paths.subject == "sub-01"
+
+    monkeypatch.setattr(main, "run_pipeline", run_pipeline)
+    jobs = [("sub-03", "Tonecounting", None), ("sub-02", "Tonecounting", None), ("sub-01", "Tonecounting", None)]
+    summary = main.run_batch(jobs, workers=1, options={"stages": ["model"], "no_cache": True})
+    assert [r["status"] for r in summary] == ["failed", "failed", "succeeded"]
+    assert summary[0]["error"] == "see pipeline.log" and "MemoryError" in summary[1]["error"]
+    saved = pd.read_csv(tmp_path / "data" / "jobs" / "batch_summary.csv")
+    assert list(saved["subject"]) == ["sub-03", "sub-02", "sub-01"]
@@ -0,0 +1,50 @@
+'''
+bench/benchmark.py regression comparison and table, and one tiny benchmark run.
+'''
+import os
+import pytest
+from bench.benchmark import compare, format_table, run_benchmarks, save_results, plot_scaling, BENCH_STAGES
+
+
+def results(times, scale="tiny", n_voxels=100, n_timepoints=10):
+    return {"scales": {scale: {"n_voxels": n_voxels, "n_timepoints": n_timepoints,
+                               "stages": {stage: {"wall_s": s} for stage, s in times.items()}}}}
+
+
+def test_compare_flags_slower_stages_only():
+    baseline = results({"extract": 1.0, "transform": 2.0, "model": 0.01, "transform/fit_transform": 1.0})
+    current = results({"extract": 1.1, "transform": 3.0, "model": 0.05, "transform/fit_transform": 5.0, "visualize": 1.0})
+    rows = {(scale, stage): row for scale, stage, *row in compare(baseline, current, threshold=0.2, min_seconds=0.05)}
+    # 10% slower is within the threshold, 50% slower is a regression
+    assert rows[("tiny", "extract")][3] is False
+    assert rows[("tiny", "transform")] == [2.0, 3.0, 1.5, True]
+    # 5x slower but only 40 ms: too short to call
+    assert rows[("tiny", "model")][3] is False
+    # Steps inside a stage and stages missing from the baseline are not compared
+    assert ("tiny", "transform/fit_transform") not in rows and ("tiny", "visualize") not in rows
+
+
+def test_compare_skips_scales_missing_from_the_baseline():
+    assert compare(results({"extract": 1.0}, scale="tiny"), results({"extract": 9.0}, scale="small")) == []
+
+
+def test_format_table():
+    table = format_table(results({"extract": 1.23456, "model": 0.5}))
+    header, *lines = table.splitlines()
+    assert "tiny (1000)" in header
+    assert len(lines) == len(BENCH_STAGES)
+    assert lines[0].split() == ["extract", "1.235s"]
+    assert lines[BENCH_STAGES.index("transform")].split() == ["transform", "-"]
+
+
+@pytest.mark.slow
+def test_tiny_benchmark_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the figure cache of the visualize stage lives under data/
+    current = run_benchmarks(scales=("tiny",), repeats=1, bench_dir=str(tmp_path / "bench"))
+    stages = current["scales"]["tiny"]["stages"]
+    assert set(BENCH_STAGES) <= set(stages)
+    assert all(stages[stage]["repeats"] == 1 and stages[stage]["wall_s"] > 0 for stage in BENCH_STAGES)
+    save_results(current, str(tmp_path / "results" / "run.json"))
+    assert not any(row[-1] for row in compare(current, current))
+    plot_scaling(current, str(tmp_path / "results" / "scaling.png"))
+    assert os.path.exists(tmp_path / "results" / "scaling.png")
@@ -0,0 +1,90 @@
+'''
+pipeline/cache.py fingerprints and store/restore, and main.py's code fingerprint.
+'''
+import os
+from pipeline.cache import StageCache, run_cached
+from main import module_files
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_inputs_are_keyed_by_relative_path(tmp_path):
+    cache = StageCache(cache_dir=str(tmp_path / "cache"))
+    a, b = str(tmp_path / "job" / "a" / "X.npy"), str(tmp_path / "job" / "b" / "X.npy")
+    write(a, "one")
+    write(b, "three")
+    root = str(tmp_path / "job")
+    # Same file names in different directories: swapping their contents changes the fingerprint
+    # (contents of different sizes, a same-size rewrite within one mtime tick keeps the remembered digest)
+    before = cache.fingerprint("model", [a, b], root=root)
+    write(a, "three")
+    write(b, "one")
+    assert cache.fingerprint("model", [a, b], root=root) != before
+    # The job directory itself is not part of the key
+    other = str(tmp_path / "other")
+    write(os.path.join(other, "a", "X.npy"), "three")
+    write(os.path.join(other, "b", "X.npy"), "one")
+    assert cache.fingerprint("model", [os.path.join(other, "a", "X.npy"), os.path.join(other, "b", "X.npy")], root=other) == \
+        cache.fingerprint("model", [a, b], root=root)
+
+
+def test_code_is_keyed_by_project_path(tmp_path):
+    # Two code files with the same name: a change to the first one is not hidden by the second one
+    cache = StageCache(cache_dir=str(tmp_path / "cache"))
+    a, b = str(tmp_path / "analysis" / "model.py"), str(tmp_path / "etl" / "model.py")
+    write(a, "x = 1")
+    write(b, "y = 2")
+    before = cache.fingerprint("model", code=[a, b])
+    write(a, "x = 10")
+    assert cache.fingerprint("model", code=[a, b]) != before
+
+
+def test_restore_removes_stale_optional_output(tmp_path):
+    cache = StageCache(cache_dir=str(tmp_path / "cache"))
+    src = str(tmp_path / "in.txt")
+    out, optional = str(tmp_path / "out.txt"), str(tmp_path / "optional.txt")
+    write(src, "input")
+
+    def stage():
+        write(out, "result")
+
+    run_cached(cache, "stage", stage, [src], [out, optional])
+    # A later run with other parameters left an optional output behind
+    write(optional, "stale")
+    os.unlink(out)
+    assert run_cached(cache, "stage", lambda: 1 / 0, [src], [out, optional]) is None
+    with open(out) as f:
+        assert f.read() == "result"
+    assert not os.path.exists(optional)
+
+
+def test_code_fingerprint_follows_project_imports():
+    files = {os.path.relpath(f, os.path.dirname(os.path.dirname(__file__))) for f in module_files(["etl.transform"])}
+    assert {"etl/transform.py", "etl/labels.py", "etl/aggregate.py", "etl/streaming.py", "etl/export.py",
+            "pipeline/store.py", "pipeline/matrix.py", "pipeline/precision.py"} <= files
+    files = {os.path.basename(f) for f in module_files(["analysis.crossval"])}
+    assert {"crossval.py", "model.py", "features.py", "sparse.py"} <= files
+
+
+def test_record_is_replayed_on_a_cache_hit(tmp_path):
+    # State a stage shares with other stages is saved with the entry, not restored as an output
+    cache = StageCache(cache_dir=str(tmp_path / "cache"))
+    src, out = str(tmp_path / "in.txt"), str(tmp_path / "out.txt")
+    write(src, "input")
+    replayed = []
+    run_cached(cache, "stage", lambda: write(out, "result"), [src], [out],
+               save_record=lambda: {"rows": 3}, restore_record=replayed.append)
+    assert not replayed
+    run_cached(cache, "stage", lambda: 1 / 0, [src], [out], save_record=lambda: {"rows": 4}, restore_record=replayed.append)
+    assert replayed == [{"rows": 3}]
+
+
+def test_stages_do_not_cache_the_manifest():
+    from pipeline.paths import job_paths, stage_files, STAGES, MANIFEST_FILE
+    paths = job_paths()
+    for stage in STAGES:
+        assert paths.output(MANIFEST_FILE) not in stage_files(stage, paths)[1]
@@ -0,0 +1,94 @@
+'''
+analysis/crossval.py folds and the parallel fold fitting.
+'''
+import numpy as np
+import pytest
+import main
+from pipeline.matrix import row_block, save_matrix, open_matrix
+from analysis.crossval import blocked_folds, run_folds, cross_validate, crossvalidate_jobs, stack_jobs
+
+
+def test_blocked_folds_leave_a_gap_around_the_test_block():
+    timepoints = np.arange(50)
+    folds = blocked_folds(timepoints, n_folds=5, gap=3)
+    assert np.array_equal(np.concatenate([test for _, test in folds]), timepoints)
+    train, test = folds[2]
+    assert np.array_equal(test, np.arange(20, 30))
+    assert np.array_equal(train, np.concatenate([np.arange(0, 17), np.arange(33, 50)]))
+    # Edge blocks only lose rows on their inner side
+    train, test = folds[0]
+    assert np.array_equal(train, np.arange(13, 50))
+
+
+def test_blocked_folds_gap_stays_within_a_run():
+    # Two runs of 10 timepoints, stored run 2 first: folds follow (run, timepoint) order
+    runs = np.repeat([2, 1], 10)
+    timepoints = np.tile(np.arange(10), 2)
+    train, test = blocked_folds(timepoints, runs, n_folds=2, gap=2)[0]
+    assert set(runs[test]) == {1}
+    # The gap removes run 1 rows only, run 2 rows at the same timepoints stay in training
+    assert set(train) == set(np.flatnonzero(runs == 2))
+
+
+def test_run_folds_need_two_runs():
+    with pytest.raises(ValueError, match="at least 2 runs"):
+        run_folds(np.ones(10))
+    folds = run_folds([1, 1, 2, 2, 3])
+    assert [list(test) for _, test in folds] == [[0, 1], [2, 3], [4]]
+
+
+def test_row_block_slices_contiguous_rows(tmp_path):
+    path = str(tmp_path / "X.npy")
+    save_matrix(path, np.arange(40, dtype=np.float32).reshape(10, 4))
+    X = open_matrix(path)
+    block = row_block(X, np.arange(3, 7), dtype=np.float32)
+    assert isinstance(block, np.memmap) and np.shares_memory(block, X)
+    gathered = row_block(X, [1, 5, 6], dtype=np.float32)
+    assert not np.shares_memory(gathered, X)
+    assert np.array_equal(gathered, X[[1, 5, 6]])
+    assert row_block(X, np.arange(3, 7), dtype=np.float64).dtype == np.float64
+
+
+def test_parallel_folds_match_serial(tmp_path):
+    rng = np.random.default_rng(0)
+    y = np.repeat(np.array(["a", "b"]), 30)
+    X = rng.normal(size=(60, 20)) + (y == "b")[:, None] * 2.0
+    save_matrix(str(tmp_path / "X.npy"), X.astype(np.float32))
+    X = open_matrix(str(tmp_path / "X.npy"))
+    folds = blocked_folds(np.arange(60), n_folds=3, gap=2)
+    serial, serial_preds = cross_validate(X, y, folds, n_jobs=1)
+    parallel, parallel_preds = cross_validate(X, y, folds, n_jobs=2)
+    assert serial.equals(parallel)
+    assert serial_preds.equals(parallel_preds)
+
+
+def test_stacked_jobs_are_cross_validated_run_by_run(processed_job, tmp_path):
+    # Two copies of one job without run numbers are stacked as runs 1 and 2
+    metrics = crossvalidate_jobs([processed_job, processed_job], str(tmp_path / "crossval"), n_jobs=1)
+    assert list(metrics["fold"]) == [0, 1, "mean", "std"]
+    X = open_matrix(str(tmp_path / "crossval" / "X.npy"))
+    assert len(X) == 2 * len(open_matrix(processed_job.processed("X.npy")))
+    assert (tmp_path / "crossval" / "cv_metrics.csv").exists()
+
+
+def test_subjects_with_the_same_run_number_are_separate_runs(first_runs, tmp_path):
+    assert [paths.run for paths in first_runs] == [1, 1]
+    X, y, timepoints, runs = stack_jobs(first_runs, str(tmp_path / "X.npy"))
+    assert list(np.unique(runs)) == [1, 2]
+    # Every fold tests exactly the rows of one subject
+    n_rows = len(open_matrix(first_runs[0].processed("X.npy")))
+    assert [list(test_idx) for _, test_idx in run_folds(runs)] == [list(range(n_rows)), list(range(n_rows, len(X)))]
+
+
+def test_jobs_with_different_masks_are_not_stacked(processed_job, shifted_mask_job, tmp_path):
+    with pytest.raises(ValueError, match="different brain masks"):
+        stack_jobs([processed_job, shifted_mask_job], str(tmp_path / "X.npy"))
+
+
+def test_main_rejects_runs_scheme_for_single_jobs(monkeypatch, capsys):
+    monkeypatch.setattr(main, "configure_logging", lambda: None)
+    # Leave-one-run-out is the crossval command's, a single job only offers blocked folds
+    with pytest.raises(SystemExit) as exit_info:
+        main.main(["--cv", "runs"])
+    assert exit_info.value.code == 2
+    assert "invalid choice: 'runs'" in capsys.readouterr().err
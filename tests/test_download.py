@@ -0,0 +1,207 @@
+'''
+etl/download.py against a local HTTP stand-in server with Range support.
+'''
+import os
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from etl.download import fetch, fetch_many, is_complete, DownloadError
+
+FILES = {
+    "/a.bin": os.urandom(300_000),
+    "/b.bin": os.urandom(123_457),
+    "/c.bin": os.urandom(50_000),
+}
+
+
+class StandIn:
+    """
+    Serves FILES with HEAD, GET and single byte ranges. Records the Range header of every GET.
+    head_size / etag: per-path overrides to make the server lie about a file.
+    errors: number of requests (HEAD or GET) per path answered with 503 before the file is served.
+    """
+
+    def __init__(self):
+        self.ranges = []
+        self.head_size = {}
+        self.etag = {}
+        self.errors = {}
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _headers(self, status, length, path):
+                self.send_response(status)
+                self.send_header("Content-Length", str(length))
+                if path in stand_in.etag:
+                    self.send_header("ETag", f'"{stand_in.etag[path]}"')
+                self.end_headers()
+
+            def _unavailable(self):
+                if stand_in.errors.get(self.path, 0) > 0:
+                    stand_in.errors[self.path] -= 1
+                    self._headers(503, 0, self.path)
+                    return True
+                return False
+
+            def do_HEAD(self):
+                if self._unavailable():
+                    return
+                data = FILES.get(self.path)
+                if data is None:
+                    self._headers(404, 0, self.path)
+                    return
+                self._headers(200, stand_in.head_size.get(self.path, len(data)), self.path)
+
+            def do_GET(self):
+                if self._unavailable():
+                    return
+                data = FILES.get(self.path)
+                if data is None:
+                    self._headers(404, 0, self.path)
+                    return
+                byte_range = self.headers.get("Range")
+                stand_in.ranges.append((self.path, byte_range))
+                if byte_range:
+                    start = int(byte_range.split("=")[1].split("-")[0])
+                    if start >= len(data):
+                        self._headers(416, 0, self.path)
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+                    self.send_header("Content-Length", str(len(data) - start))
+                    self.end_headers()
+                    self.wfile.write(data[start:])
+                else:
+                    self._headers(200, len(data), self.path)
+                    self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def server():
+    stand_in = StandIn()
+    yield stand_in
+    stand_in.close()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_full_fetch_marks_complete(server, tmp_path):
+    dest = str(tmp_path / "a.bin")
+    fetch(server.url + "/a.bin", dest, sha256=hashlib.sha256(FILES["/a.bin"]).hexdigest())
+    assert read(dest) == FILES["/a.bin"]
+    assert not os.path.exists(dest + ".part")
+    assert is_complete(dest)
+    # A complete file is not downloaded again
+    fetch(server.url + "/a.bin", dest)
+    assert len(server.ranges) == 1
+
+
+def test_resume_from_truncated_part(server, tmp_path):
+    dest = str(tmp_path / "a.bin")
+    with open(dest + ".part", "wb") as f:
+        f.write(FILES["/a.bin"][:100_000])
+    fetch(server.url + "/a.bin", dest)
+    assert server.ranges == [("/a.bin", "bytes=100000-")]
+    assert read(dest) == FILES["/a.bin"]
+    assert is_complete(dest)
+
+
+def test_legacy_file_without_sidecar_is_resumed(server, tmp_path):
+    dest = str(tmp_path / "b.bin")
+    with open(dest, "wb") as f:
+        f.write(FILES["/b.bin"][:1000])  # interrupted download from before the sidecar existed
+    assert not is_complete(dest)
+    fetch(server.url + "/b.bin", dest)
+    assert server.ranges == [("/b.bin", "bytes=1000-")]
+    assert read(dest) == FILES["/b.bin"]
+
+
+def test_sha256_mismatch_raises(server, tmp_path):
+    dest = str(tmp_path / "a.bin")
+    with pytest.raises(DownloadError, match="sha256"):
+        fetch(server.url + "/a.bin", dest, sha256="0" * 64)
+    assert not os.path.exists(dest)
+    assert not os.path.exists(dest + ".part")
+
+
+def test_size_mismatch_raises_and_keeps_part(server, tmp_path):
+    server.head_size["/c.bin"] = len(FILES["/c.bin"]) + 10
+    dest = str(tmp_path / "c.bin")
+    with pytest.raises(DownloadError, match="expected"):
+        fetch(server.url + "/c.bin", dest)
+    assert not os.path.exists(dest)
+    assert os.path.exists(dest + ".part")
+
+
+def test_etag_md5_mismatch_raises(server, tmp_path):
+    server.etag["/c.bin"] = "f" * 32
+    with pytest.raises(DownloadError, match="ETag"):
+        fetch(server.url + "/c.bin", str(tmp_path / "c.bin"))
+
+
+def test_etag_md5_match(server, tmp_path):
+    server.etag["/c.bin"] = hashlib.md5(FILES["/c.bin"]).hexdigest()
+    dest = str(tmp_path / "c.bin")
+    fetch(server.url + "/c.bin", dest)
+    assert read(dest) == FILES["/c.bin"]
+
+
+def test_http_error_is_download_error(server, tmp_path):
+    with pytest.raises(DownloadError, match="404"):
+        fetch(server.url + "/missing.bin", str(tmp_path / "missing.bin"))
+
+
+def test_server_errors_are_retried(server, tmp_path, monkeypatch):
+    monkeypatch.setattr("etl.download.BACKOFF", 0)
+    server.errors["/c.bin"] = 2  # the HEAD request, then its retry
+    dest = str(tmp_path / "c.bin")
+    fetch(server.url + "/c.bin", dest)
+    assert read(dest) == FILES["/c.bin"] and is_complete(dest)
+    # More failures than attempts: the last one is reported
+    server.errors["/a.bin"] = 5
+    with pytest.raises(DownloadError, match="503"):
+        fetch(server.url + "/a.bin", str(tmp_path / "a.bin"), retries=2)
+
+
+def test_legacy_file_is_adopted_offline(tmp_path, monkeypatch):
+    monkeypatch.setattr("etl.download.BACKOFF", 0)
+    offline = "http://127.0.0.1:9/a.bin"  # nothing listens on the discard port
+    dest = str(tmp_path / "a.bin")
+    with open(dest, "wb") as f:
+        f.write(FILES["/a.bin"])  # complete download from before the sidecar existed
+    with pytest.raises(DownloadError, match="does not match"):
+        fetch(offline, dest, sha256="0" * 64, retries=1)
+    assert not is_complete(dest)
+    fetch(offline, dest, retries=1)
+    assert is_complete(dest, hashlib.sha256(FILES["/a.bin"]).hexdigest())
+    assert read(dest) == FILES["/a.bin"]
+    # Without a file to adopt, an unreachable server is an error
+    with pytest.raises(DownloadError, match="Cannot download"):
+        fetch(offline, str(tmp_path / "b.bin"), retries=1)
+
+
+def test_fetch_many_concurrent(server, tmp_path):
+    items = [(server.url + name, str(tmp_path / name.lstrip("/"))) for name in FILES]
+    items.append((server.url + "/missing.bin", str(tmp_path / "missing.bin")))
+    results = fetch_many(items, workers=4)
+    for name in FILES:
+        dest = str(tmp_path / name.lstrip("/"))
+        assert results[dest] is None
+        assert read(dest) == FILES[name]
+    assert isinstance(results[str(tmp_path / "missing.bin")], DownloadError)
@@ -0,0 +1,47 @@
+'''
+etl/export.py summary maps from the 2D matrix and the on-demand 4D export.
+'''
+import os
+import joblib
+import numpy as np
+import nibabel as nib
+import pytest
+from etl.extract import extracted_image_path
+from etl.export import export_job, export_path
+
+
+def in_mask(paths, image_path):
+    # Voxels of an image inside the job's brain mask, without running the masker's preprocessing again
+    mask = np.asarray(joblib.load(paths.processed("masker.joblib")).mask_img_.dataobj).astype(bool)
+    return np.asarray(nib.load(image_path).dataobj)[mask].T
+
+
+def preprocessed(paths):
+    # Every timepoint through the saved masker (X.npy only keeps the task timepoints)
+    masker = joblib.load(paths.processed("masker.joblib"))
+    return masker.transform(nib.load(extracted_image_path(paths)))
+
+
+def test_summary_maps_match_the_matrix(processed_job):
+    X = preprocessed(processed_job)
+    mean_map = in_mask(processed_job, processed_job.processed("mean_bold_map.nii.gz"))
+    std_map = in_mask(processed_job, processed_job.processed("std_bold_map.nii.gz"))
+    assert np.allclose(mean_map, X.mean(axis=0), atol=1e-5)
+    assert np.allclose(std_map, X.std(axis=0), atol=1e-5)
+
+
+@pytest.mark.parametrize("fmt", ["nii", "fast"])
+def test_export_on_request(processed_job, fmt):
+    out_path = export_path(processed_job, fmt)
+    assert not os.path.exists(out_path)  # transform did not write it
+    try:
+        assert export_job(processed_job, fmt) == out_path
+        assert np.allclose(in_mask(processed_job, out_path), preprocessed(processed_job), atol=1e-5)
+    finally:
+        if os.path.exists(out_path):
+            os.unlink(out_path)
+
+
+def test_unknown_format(processed_job):
+    with pytest.raises(ValueError, match="4D export format"):
+        export_path(processed_job, "zip")
@@ -0,0 +1,37 @@
+'''
+etl/extract.py links the downloaded image instead of rewriting it, with an optional uncompressed copy.
+'''
+import os
+import numpy as np
+import nibabel as nib
+from pipeline.context import PipelineContext
+from etl.extract import link_file, extract_data, extracted_image_path
+
+
+def test_link_replaces_a_stale_file(tmp_path):
+    src, dest = tmp_path / "src.nii.gz", tmp_path / "dest.nii.gz"
+    src.write_bytes(b"new")
+    dest.write_bytes(b"old")
+    link_file(str(src), str(dest))
+    assert os.path.samefile(src, dest) and dest.read_bytes() == b"new"
+    link_file(str(src), str(dest))  # already linked: left alone
+    assert os.path.samefile(src, dest)
+
+
+def test_extract_links_and_optionally_decompresses(tmp_path):
+    from bench.synthetic import generate, SCALES
+    paths, = generate(shape=SCALES["tiny"]["shape"], n_timepoints=SCALES["tiny"]["n_timepoints"],
+                      data_dir=str(tmp_path / "job"), raw_dir=str(tmp_path / "raw"))
+    paths.make_dirs()
+    extract_data(PipelineContext(paths), uncompressed=True)
+    assert os.path.samefile(paths.extracted_nii, paths.raw_nii)
+    assert extracted_image_path(paths) == paths.extracted_nii_uncompressed
+    # The .nii copy is memory-mapped by nibabel, with the same voxels as the downloaded .nii.gz
+    data = np.asanyarray(nib.load(paths.extracted_nii_uncompressed).dataobj)
+    assert isinstance(data, np.memmap)
+    assert np.array_equal(data, np.asarray(nib.load(paths.raw_nii).dataobj))
+
+    # A run without --uncompressed removes the copy of the earlier run
+    extract_data(PipelineContext(paths))
+    assert not os.path.exists(paths.extracted_nii_uncompressed)
+    assert extracted_image_path(paths) == paths.extracted_nii
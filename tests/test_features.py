@@ -0,0 +1,72 @@
+'''
+analysis/features.py reducers in front of the decision tree and the voxel names of the tree's inputs.
+'''
+import numpy as np
+import pytest
+from sklearn.tree import DecisionTreeClassifier
+from analysis.features import make_reducer, with_reducer, feature_indices, used_feature_names, compare_reducers, compare_job_reducers
+
+
+@pytest.fixture
+def data():
+    # Only voxels 3 and 17 carry the label
+    rng = np.random.default_rng(0)
+    y = np.repeat(np.array(["a", "b"]), 40)
+    X = rng.normal(size=(80, 30))
+    X[:, 3] += (y == "b") * 4.0
+    X[:, 17] -= (y == "b") * 4.0
+    return X, y
+
+
+def test_reducer_sizes_are_clamped():
+    assert make_reducer("none") is None
+    assert make_reducer("anova", 1000, n_input_features=30).k == 30
+    pca = make_reducer("pca", 1000, n_samples=50, n_input_features=30, batch_size=10)
+    assert pca.n_components == 30 and pca.batch_size == 30
+    with pytest.raises(ValueError, match="Unknown feature reduction"):
+        make_reducer("lasso")
+
+
+def test_anova_keeps_voxel_indices(data):
+    X, y = data
+    model = with_reducer(DecisionTreeClassifier(random_state=0), make_reducer("anova", 2, n_input_features=X.shape[1]))
+    model.fit(X, y)
+    assert list(feature_indices(model)) == [3, 17]
+    # The tree's inputs are named after the voxels they came from, not their position after the reducer
+    names = used_feature_names(model, X.shape[1])
+    assert len(names) == 2 and set(names) <= {"v3", "v17"}
+
+
+def test_variance_keeps_the_most_variable_training_voxels(data):
+    _, y = data
+    X = np.random.default_rng(1).normal(size=(80, 30)) * np.linspace(0.5, 3.0, 30)
+    reducer = make_reducer("variance", 5, n_input_features=X.shape[1]).fit(X[:60], y[:60])
+    assert list(reducer.get_support(indices=True)) == sorted(np.argsort(X[:60].var(axis=0))[-5:])
+    assert reducer.get_support(indices=True).min() >= 20  # the last voxels vary the most
+
+
+def test_pca_and_plain_tree_names(data):
+    X, y = data
+    pca_model = with_reducer(DecisionTreeClassifier(random_state=0), make_reducer("pca", 5, *X.shape)).fit(X, y)
+    assert feature_indices(pca_model) is None
+    assert used_feature_names(pca_model, X.shape[1])[0] == "pc0"
+    tree = DecisionTreeClassifier(random_state=0).fit(X, y)
+    assert feature_indices(tree) is None
+    assert len(used_feature_names(tree, X.shape[1], prefix="r")) == 30 and used_feature_names(tree, 30, prefix="r")[3] == "r3"
+
+
+def test_compare_reducers(data, tmp_path):
+    X, y = data
+    df = compare_reducers(X[::2], y[::2], X[1::2], y[1::2], lambda: DecisionTreeClassifier(random_state=0),
+                          [("none", None), ("anova", 2), ("variance", 10)], out_csv=str(tmp_path / "reduction.csv"))
+    assert list(df["classifier_inputs"]) == [30, 2, 10]
+    assert df["accuracy"].min() > 0.75  # well above chance on the informative voxels
+    assert (tmp_path / "reduction.csv").exists()
+
+
+def test_compare_reducers_on_a_processed_job(processed_job, tmp_path):
+    out_csv = str(tmp_path / "feature_reduction.csv")
+    df = compare_job_reducers(processed_job, sizes=(5,), out_csv=out_csv)
+    assert list(df["method"]) == ["none", "anova", "variance", "pca"]
+    assert list(df["classifier_inputs"])[1:] == [5, 5, 5]
+    assert (tmp_path / "feature_reduction.csv").exists()
@@ -0,0 +1,71 @@
+'''
+analysis/incremental.py chunked partial_fit over memory-mapped sources.
+'''
+import numpy as np
+import pytest
+from sklearn.linear_model import SGDClassifier
+from pipeline.matrix import save_matrix, open_matrix
+from pipeline.precision import get_dtype, set_precision
+from analysis.incremental import iter_chunks, fit_incremental, predict_rows, train_pooled, INCREMENTAL_PARAMS
+
+
+def make_source(tmp_path, name, n_rows=60, n_cols=8, seed=0):
+    rng = np.random.default_rng(seed)
+    y = np.repeat(np.array(["a", "b", "c"]), n_rows // 3)  # sorted, so early chunks hold a single class
+    X = rng.normal(size=(n_rows, n_cols))
+    X[:, 0] += (y == "b") * 4.0
+    X[:, 1] += (y == "c") * 4.0
+    save_matrix(str(tmp_path / f"{name}.npy"), X)
+    rows = np.arange(n_rows)
+    return {"name": name, "X": open_matrix(str(tmp_path / f"{name}.npy")), "y": y, "train": rows[rows % 4 != 0], "test": rows[rows % 4 == 0]}
+
+
+@pytest.mark.parametrize("precision", ["float32", "float64"])
+def test_shuffled_chunks_cover_every_row_once(tmp_path, precision):
+    sources = [make_source(tmp_path, "one"), make_source(tmp_path, "two", seed=1)]
+    seen = {"one": [], "two": []}
+    previous = set_precision(precision)
+    try:
+        chunks = list(iter_chunks(sources, "train", chunk_rows=7, rng=np.random.default_rng(0)))
+    finally:
+        set_precision(previous)
+    for source, idx, X_chunk in chunks:
+        assert len(idx) <= 7 and X_chunk.dtype == np.dtype(precision)  # rows come in the working precision
+        assert np.array_equal(X_chunk, np.asarray(source["X"][idx], dtype=precision))
+        seen[source["name"]].extend(idx)
+    for source in sources:
+        assert sorted(seen[source["name"]]) == list(source["train"])
+
+
+def test_one_chunk_matches_partial_fit_on_all_rows(tmp_path):
+    source = make_source(tmp_path, "one")
+    clf = fit_incremental([source], epochs=1, chunk_rows=len(source["train"]), shuffle=False)
+    reference = SGDClassifier(loss=INCREMENTAL_PARAMS["loss"], alpha=INCREMENTAL_PARAMS["alpha"], random_state=INCREMENTAL_PARAMS["random_state"])
+    reference.partial_fit(np.asarray(source["X"][source["train"]], dtype=get_dtype()), source["y"][source["train"]], classes=["a", "b", "c"])
+    assert np.allclose(clf.coef_, reference.coef_)
+
+
+def test_small_chunks_still_learn_every_class(tmp_path):
+    source = make_source(tmp_path, "one")
+    clf = fit_incremental([source], chunk_rows=5)
+    assert list(clf.classes_) == ["a", "b", "c"]
+    predictions = predict_rows(clf, source, "test", chunk_rows=4)
+    assert np.array_equal(predictions, clf.predict(np.asarray(source["X"][source["test"]], dtype=get_dtype())))
+    assert np.mean(predictions == source["y"][source["test"]]) > 0.7  # chance is 1/3
+
+
+def test_sources_must_share_columns(tmp_path):
+    with pytest.raises(ValueError, match="cannot be pooled"):
+        fit_incremental([make_source(tmp_path, "one"), make_source(tmp_path, "two", n_cols=9)])
+
+
+def test_pooled_metrics_per_job(processed_job, tmp_path):
+    metrics = train_pooled([processed_job, processed_job], str(tmp_path / "pooled"), epochs=1)
+    assert list(metrics["job"]) == [processed_job.prefix] * 2 + ["pooled"]
+    assert metrics["n_test"].iloc[-1] == metrics["n_test"].iloc[:2].sum()
+    assert (tmp_path / "pooled" / "decision_tree_model.joblib").exists()
+
+
+def test_jobs_with_different_masks_are_not_pooled(processed_job, shifted_mask_job, tmp_path):
+    with pytest.raises(ValueError, match="different brain masks"):
+        train_pooled([processed_job, shifted_mask_job], str(tmp_path / "pooled"))
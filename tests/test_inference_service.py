@@ -0,0 +1,85 @@
+'''
+analysis/inference.py HTTP service: localhost only, inputs under the input root, outputs under the server's out_dir.
+'''
+import os
+import json
+import threading
+import urllib.request
+import urllib.error
+import pytest
+from analysis.inference import make_server, resolve_inputs, SERVICE_HOST
+
+
+class RecordingEngine:
+    """
+    Stands in for InferenceEngine: records the scans and out_dir of every request.
+    """
+    model_path = "model.joblib"
+    n_voxels = 10
+
+    def __init__(self):
+        self.calls = []
+
+    def predict_many(self, inputs, out_dir):
+        self.calls.append((list(inputs), out_dir))
+        return [{"path": p, "output": os.path.join(out_dir, "x.csv"), "n_timepoints": 0, "predictions": {}} for p in inputs]
+
+
+@pytest.fixture
+def service(tmp_path):
+    root = tmp_path / "scans"
+    root.mkdir()
+    (root / "a_bold.nii.gz").write_bytes(b"")
+    (tmp_path / "outside_bold.nii.gz").write_bytes(b"")
+    os.symlink(tmp_path / "outside_bold.nii.gz", root / "link_bold.nii.gz")
+    engine = RecordingEngine()
+    server = make_server(engine, port=0, out_dir=str(tmp_path / "out"), input_root=str(root))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield engine, server, tmp_path
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body):
+    request = urllib.request.Request(f"http://{SERVICE_HOST}:{server.server_port}/predict", data=json.dumps(body).encode(), method="POST")
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_binds_to_localhost_only(service):
+    _, server, _ = service
+    assert server.server_address[0] == "127.0.0.1"
+
+
+def test_request_out_dir_is_ignored(service):
+    engine, server, tmp_path = service
+    status, _ = post(server, {"paths": ["a_bold.nii.gz"], "out_dir": "/tmp/elsewhere"})
+    assert status == 200
+    scans, out_dir = engine.calls[-1]
+    assert out_dir == str(tmp_path / "out")
+    assert scans == [os.path.join(os.path.realpath(tmp_path / "scans"), "a_bold.nii.gz")]
+
+
+@pytest.mark.parametrize("path", ["../outside_bold.nii.gz", "link_bold.nii.gz", "/etc/passwd"])
+def test_paths_outside_the_input_root_are_refused(service, path):
+    engine, server, _ = service
+    status, body = post(server, {"paths": [path]})
+    assert status == 403 and "outside the input root" in body["error"]
+    assert engine.calls == []
+
+
+def test_directory_inputs_are_checked_per_scan(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "a_bold.nii").write_bytes(b"")
+    assert resolve_inputs(["."], str(root)) == [os.path.join(os.path.realpath(root), "a_bold.nii")]
+    # A symlinked directory whose scans live outside the root
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "b_bold.nii").write_bytes(b"")
+    os.symlink(tmp_path / "other", root / "linked")
+    with pytest.raises(PermissionError):
+        resolve_inputs(["linked"], str(root))
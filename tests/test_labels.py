@@ -0,0 +1,67 @@
+'''
+etl/labels.py overlap resolution and the TR read from the NIfTI header.
+'''
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import pytest
+from etl.labels import _event_winners, label_timepoints, label_runs, tr_from_img, REST_CODE
+
+
+def loop_winners(onsets, durations, n_timepoints, tr):
+    # The old transform.py loop over onset-sorted events: later events overwrite earlier ones
+    winner = np.full(n_timepoints, -1)
+    times = np.arange(n_timepoints) * tr
+    for i in np.argsort(onsets, kind="stable"):
+        winner[(times >= onsets[i]) & (times < onsets[i] + durations[i])] = i
+    return winner
+
+
+def test_overlaps_go_to_the_latest_onset():
+    onsets = np.array([4.0, 0.0, 2.0])
+    durations = np.array([4.0, 6.0, 1.0])
+    # Event 1 covers t=0..5, event 2 (onset 2) takes t=2, event 0 (onset 4) takes t=4..7
+    assert list(_event_winners(onsets, durations, 10, 1.0)) == [1, 1, 2, 1, 0, 0, 0, 0, -1, -1]
+
+
+def test_equal_onsets_go_to_the_later_row():
+    assert list(_event_winners(np.array([2.0, 2.0]), np.array([3.0, 1.0]), 6, 1.0)) == [-1, -1, 1, 0, 0, -1]
+
+
+def test_winners_match_the_loop_in_any_row_order():
+    rng = np.random.default_rng(0)
+    onsets = rng.integers(0, 100, 40).astype(float)
+    durations = rng.integers(0, 12, 40).astype(float)
+    expected = loop_winners(onsets, durations, 60, 2.0)
+    assert np.array_equal(_event_winners(onsets, durations, 60, 2.0), expected)
+    # Shuffling the rows of events.tsv does not change which event covers a timepoint
+    perm = rng.permutation(40)
+    shuffled = _event_winners(onsets[perm], durations[perm], 60, 2.0)
+    covered = shuffled >= 0
+    assert np.array_equal(covered, expected >= 0)
+    assert np.array_equal(onsets[perm][shuffled[covered]], onsets[expected[covered]])
+
+
+def test_runs_are_labeled_with_their_own_tr_and_shift():
+    events = pd.DataFrame({"onset": [0.0, 4.0], "duration": [2.0, 2.0], "trial_type": ["b", "a"]})
+    codes, categories = label_timepoints(events, 4, 2.0, hrf_shift=2.0)
+    assert list(categories) == ["a", "b"]
+    assert list(codes) == [REST_CODE, 1, REST_CODE, 0]
+    codes, _, run_index = label_runs([(events, 3), (events, 6)], tr=[2.0, 1.0])
+    assert list(codes) == [1, REST_CODE, 0] + [1, 1, REST_CODE, REST_CODE, 0, 0]
+    assert list(run_index) == [0] * 3 + [1] * 6
+
+
+@pytest.mark.parametrize("unit, zoom", [("sec", 2.0), ("msec", 2000.0), ("usec", 2e6)])
+def test_tr_is_read_in_seconds(unit, zoom):
+    img = nib.Nifti1Image(np.zeros((2, 2, 2, 3), dtype=np.float32), np.eye(4))
+    img.header.set_zooms((3.0, 3.0, 3.0, zoom))
+    img.header.set_xyzt_units("mm", unit)
+    assert tr_from_img(img) == pytest.approx(2.0)
+
+
+def test_missing_tr_uses_the_default():
+    img = nib.Nifti1Image(np.zeros((2, 2, 2), dtype=np.float32), np.eye(4))
+    assert tr_from_img(img, default=1.5) == 1.5
+    with pytest.raises(ValueError, match="repetition time"):
+        tr_from_img(img)
@@ -0,0 +1,140 @@
+'''
+main.py stage selection and tools: argument checks and what each command hands to its module.
+'''
+import os
+import sys
+import subprocess
+import pytest
+import main
+from pipeline.store import record_stage, load_manifest
+
+
+@pytest.fixture(autouse=True)
+def no_log_file(monkeypatch):
+    monkeypatch.setattr(main, "configure_logging", lambda: None)
+
+
+def record(monkeypatch, module, name, result=None):
+    # Replace module.name with a function that records its arguments
+    calls = []
+    monkeypatch.setattr(main.stage_module(module), name, lambda *args, **kwargs: calls.append((args, kwargs)) or result)
+    return calls
+
+
+def test_crossval_needs_two_jobs(capsys):
+    assert main.main(["crossval", "--job", "sub-02:Singletaskweatherprediction:1"]) == 2
+    assert "at least two --job" in capsys.readouterr().err
+
+
+def test_crossval_stacks_the_given_jobs(monkeypatch):
+    calls = record(monkeypatch, "analysis.crossval", "crossvalidate_jobs")
+    assert main.main(["crossval", "--job", "sub-02:Singletaskweatherprediction:1", "--job", "sub-02:Singletaskweatherprediction:2",
+                      "--gap", "3", "--workers", "2"]) == 0
+    (paths_list, out_dir), kwargs = calls[0]
+    assert [paths.run for paths in paths_list] == [1, 2]
+    # Options that were not given are left to the module's defaults
+    assert kwargs == {"n_jobs": 2, "features": "voxels", "gap": 3}
+
+
+def test_realtime_passes_only_given_options(monkeypatch):
+    calls = record(monkeypatch, "analysis.realtime", "replay_job", result={})
+    assert main.main(["realtime", "--job", "sub-02:Singletaskweatherprediction:1", "--speed", "0"]) == 0
+    (paths, scan), kwargs = calls[0]
+    assert paths.prefix == main.job_paths("sub-02", "Singletaskweatherprediction", 1).prefix and scan is None
+    assert kwargs["speed"] == 0 and "warmup" not in kwargs and "budget_fraction" not in kwargs
+
+
+def test_check_precision_fails_on_drift(monkeypatch):
+    record(monkeypatch, "pipeline.precision", "check_precision", result={"drift": ["accuracy differs by 0.02"]})
+    assert main.main(["check-precision"]) == 1
+
+
+def test_export_writes_the_given_format(monkeypatch):
+    calls = record(monkeypatch, "etl.export", "export_job")
+    assert main.main(["export", "--job", "sub-01:Tonecounting", "--format", "nii"]) == 0
+    (paths, fmt), _ = calls[0]
+    assert paths.prefix == main.job_paths("sub-01", "Tonecounting").prefix and fmt == "nii"
+
+
+def test_compare_reducers_sizes(monkeypatch):
+    calls = record(monkeypatch, "analysis.features", "compare_job_reducers")
+    assert main.main(["compare-reducers", "--n-features", "10", "50"]) == 0
+    (paths,), kwargs = calls[0]
+    assert paths.prefix == main.job_paths().prefix
+    assert kwargs == {"features": "voxels", "out_csv": None, "sizes": [10, 50]}
+
+
+def test_failed_tool_returns_1(monkeypatch):
+    def fail(*args, **kwargs):
+        raise FileNotFoundError("X.npy")
+    monkeypatch.setattr(main.stage_module("analysis.incremental"), "train_pooled", fail)
+    assert main.main(["pool"]) == 1
+
+
+def test_cache_hit_keeps_the_manifest_entries_of_later_stages(tmp_path):
+    paths = main.job_paths(data_dir=str(tmp_path / "job"))
+    paths.make_dirs()
+    cache = main.StageCache(cache_dir=str(tmp_path / "cache"))
+
+    def stage(name, output, **info):
+        with open(paths.output(output), "w") as f:
+            f.write(name)
+        record_stage(paths, name, [paths.output(output)], params={"stage": name}, **info)
+
+    main.run_stage(cache, "evaluate", paths, "analysis.evaluate", lambda: stage("evaluate", "evaluation_metrics.csv", accuracy=0.5))
+    main.run_stage(cache, "crossval", paths, "analysis.crossval", lambda: stage("crossval", "cv_metrics.csv"))
+    # evaluate is restored from the cache: its entry comes back, crossval's entry stays
+    main.run_stage(cache, "evaluate", paths, "analysis.evaluate", lambda: 1 / 0)
+    stages = load_manifest(paths)["stages"]
+    assert set(stages) == {"evaluate", "crossval"}
+    assert stages["evaluate"]["cached"] and stages["evaluate"]["accuracy"] == 0.5 and stages["evaluate"]["params"] == {"stage": "evaluate"}
+    assert list(stages["evaluate"]["artifacts"]) == [os.path.basename(paths.output("evaluation_metrics.csv"))]
+
+
+def test_extract_cache_hit_needs_no_download(tmp_path, monkeypatch):
+    from bench.synthetic import generate, SCALES
+    paths, = generate(shape=SCALES["tiny"]["shape"], n_timepoints=SCALES["tiny"]["n_timepoints"],
+                      data_dir=str(tmp_path / "job"), raw_dir=str(tmp_path / "raw"))
+    cache = main.StageCache(cache_dir=str(tmp_path / "cache"))
+    assert main.run_pipeline(paths, cache, {"stages": ["extract"]})
+
+    # The raw files are gone and the server cannot be reached: the checksum sidecars are enough for a cache hit
+    os.unlink(paths.raw_nii)
+    os.unlink(paths.raw_events)
+
+    def offline(paths):
+        raise ConnectionError("no network")
+    monkeypatch.setattr(main.stage_module("etl.extract"), "download_raw", offline)
+    assert main.run_pipeline(paths, cache, {"stages": ["extract"]})  # a cache miss would download, and fail
+
+
+def test_stage_names_are_not_commands():
+    # crossval is a stage and a command, after --only it stays a stage
+    args = main.parse_args(["--only", "model", "crossval", "--cv", "blocked"])
+    assert args.only == ["model", "crossval"] and args.command is None
+
+
+def test_select_stages_ranges():
+    assert main.select_stages("model", "evaluate") == ["model", "evaluate"]
+    # crossval and parcellate are only in a range when asked for
+    assert "crossval" not in main.select_stages("model") and "crossval" in main.select_stages("model", cv="blocked")
+    assert "parcellate" not in main.select_stages() and "parcellate" in main.select_stages(features="regions")
+    assert main.select_stages(only=["visualize", "model"]) == ["model", "visualize"]
+    with pytest.raises(ValueError, match="comes after"):
+        main.select_stages("evaluate", "transform")
+
+
+def test_plan_adds_only_missing_upstream_stages(processed_job, tmp_path):
+    empty = main.job_paths(data_dir=str(tmp_path / "job"))
+    assert main.plan_stages(["evaluate"], empty) == ["extract", "transform", "model", "evaluate"]
+    assert main.plan_stages(["visualize"], empty, features="regions")[:3] == ["extract", "transform", "parcellate"]
+    # X.npy and the labels are on disk, so transform does not run again
+    planned = main.plan_stages(["evaluate"], processed_job)
+    assert "extract" not in planned and "transform" not in planned and planned[-1] == "evaluate"
+
+
+def test_importing_main_loads_no_stage_libraries():
+    code = "import sys, main; print(sorted(m for m in ('sklearn', 'nilearn', 'matplotlib', 'scipy') if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=main.base_dir, env={**os.environ, "PYTHONPATH": main.base_dir})
+    assert result.stdout.strip() == "[]"
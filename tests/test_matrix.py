@@ -0,0 +1,38 @@
+'''
+pipeline/matrix.py chunked access to the memory-mapped X and the train/test split as indices.
+'''
+import numpy as np
+from sklearn.model_selection import train_test_split
+from pipeline.matrix import (save_matrix, open_matrix, take_rows, copy_rows, column_mean, column_std, iter_cols,
+                             save_split, load_split)
+from analysis.model import split_indices, MODEL_PARAMS
+
+
+def memmap(tmp_path, X):
+    save_matrix(str(tmp_path / "X.npy"), X)
+    return open_matrix(str(tmp_path / "X.npy"))
+
+
+def test_chunked_reads_match_in_memory(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.normal(loc=1000.0, size=(53, 11))
+    X = memmap(tmp_path, data)
+    assert isinstance(X, np.memmap) and not X.flags.writeable
+    idx = rng.permutation(53)[:20]
+    # Chunks that do not divide the rows or columns
+    assert np.array_equal(take_rows(X, idx, chunk_rows=7), data[idx])
+    assert take_rows(X, idx, dtype=np.float32).dtype == np.float32
+    assert np.array_equal(copy_rows(X, idx, str(tmp_path / "rows.npy"), chunk_rows=3), data[idx])
+    assert np.allclose(column_mean(X, chunk_rows=4), data.mean(axis=0))
+    assert np.allclose(column_std(X, chunk_rows=4), data.std(axis=0))
+    assert np.array_equal(np.hstack([block for _, _, block in iter_cols(X, 4)]), data)
+
+
+def test_split_indices_give_the_rows_of_splitting_X(tmp_path):
+    data = np.arange(40.0).reshape(20, 2)
+    train_idx, test_idx = split_indices(len(data))
+    X_train, X_test = train_test_split(data, test_size=MODEL_PARAMS["test_size"], random_state=MODEL_PARAMS["random_state"])
+    assert np.array_equal(data[train_idx], X_train) and np.array_equal(data[test_idx], X_test)
+    save_split(str(tmp_path / "split.npz"), train_idx, test_idx)
+    loaded_train, loaded_test = load_split(str(tmp_path / "split.npz"))
+    assert np.array_equal(loaded_train, train_idx) and np.array_equal(loaded_test, test_idx)
@@ -0,0 +1,30 @@
+'''
+analysis/model.py and analysis/incremental.py with and without persisted outputs.
+'''
+import os
+import numpy as np
+import pytest
+from pipeline.paths import job_paths
+from pipeline.context import PipelineContext
+from pipeline.store import PREDICTIONS_FILE
+from analysis.model import build_model
+from analysis.incremental import incremental_model
+
+
+def in_memory_context(processed_job, data_dir):
+    # X and y of the synthetic job, outputs to a directory of its own
+    source = PipelineContext(processed_job)
+    ctx = PipelineContext(job_paths(processed_job.subject, processed_job.task, processed_job.run, data_dir=str(data_dir)), persist=False)
+    ctx.X, ctx.y = np.asarray(source.get_X()), source.get_y()
+    return ctx
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("train", [build_model, incremental_model])
+def test_no_persist_writes_nothing(processed_job, tmp_path, train):
+    ctx = in_memory_context(processed_job, tmp_path)
+    clf, _, y_test, predictions = train(ctx)
+    assert len(predictions) == len(y_test) and ctx.predictions is predictions
+    written = [os.path.join(d, f) for d, _, files in os.walk(tmp_path) for f in files]
+    assert written == []
+    assert not os.path.exists(ctx.paths.output(PREDICTIONS_FILE))
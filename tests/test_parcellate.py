@@ -0,0 +1,62 @@
+'''
+etl/parcellate.py region features: averaging, training-row statistics and clustering on the training split.
+'''
+import numpy as np
+import pytest
+from etl.parcellate import (voxel_regions, averaging_matrix, region_signals, region_means, region_stats,
+                            parcellate, load_regions, load_region_stats, save_regions, warn_fitted_regions, REGIONS_FILE)
+from analysis.model import split_indices
+
+
+def test_voxel_regions_and_averaging():
+    voxel_region = voxel_regions(np.array([3, 0, 3, 7, 9]), np.array([3, 7, 8]))
+    assert list(voxel_region) == [0, -1, 0, 1, -1]
+    X = np.array([[1.0, 100.0, 3.0, 5.0, 100.0]])
+    assert np.allclose(X @ averaging_matrix(voxel_region, 3).toarray(), [[2.0, 5.0, 0.0]])
+
+
+def test_region_signals_use_given_stats():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(30, 6))
+    voxel_region = np.array([0, 0, 1, 1, 2, 2])
+    means = region_means(X, voxel_region, 3)
+    stats = region_stats(means, np.arange(20))
+    R = region_signals(X, voxel_region, 3, stats=stats)
+    assert np.allclose(R, (means - means[:20].mean(axis=0)) / means[:20].std(axis=0))
+    # Without stats every call standardizes over its own rows
+    assert np.allclose(region_signals(X, voxel_region, 3).mean(axis=0), 0)
+
+
+@pytest.mark.slow
+def test_clusters_and_stats_come_from_training_rows(processed_job):
+    from pipeline.context import PipelineContext
+    ctx = PipelineContext(processed_job)
+    X_regions = parcellate(ctx, method="kmeans", n_regions=8)
+    X = ctx.get_X("voxels")
+    train_idx = np.sort(split_indices(X.shape[0])[0])
+    path = processed_job.processed(REGIONS_FILE)
+    voxel_region, region_ids, method = load_regions(path)
+    mean, std = load_region_stats(path)
+    assert method == "kmeans" and X_regions.shape == (X.shape[0], len(region_ids))
+    assert np.allclose(X_regions[train_idx].mean(axis=0), 0, atol=1e-6)
+    assert np.allclose(mean, region_means(X, voxel_region, len(region_ids))[train_idx].mean(axis=0))
+
+    # Test rows have no say in the regions: changing them leaves the clusters as they are
+    X_changed = np.array(X)
+    test_idx = np.setdiff1d(np.arange(X.shape[0]), train_idx)
+    X_changed[test_idx] = np.random.default_rng(1).normal(size=(len(test_idx), X.shape[1]))
+    ctx.X = X_changed
+    parcellate(ctx, method="kmeans", n_regions=8)
+    assert np.array_equal(load_regions(path)[0], voxel_region)
+
+
+@pytest.mark.parametrize("method, warned", [("ward", True), ("kmeans", True), ("atlas", False)])
+def test_folds_on_fitted_regions_are_flagged(tmp_path, caplog, method, warned):
+    from pipeline.paths import job_paths
+    from pipeline.context import PipelineContext
+    paths = job_paths(data_dir=str(tmp_path / "job"))
+    paths.make_dirs()
+    save_regions(paths.processed(REGIONS_FILE), np.array([0, 1, 1]), np.arange(2), method)
+    assert warn_fitted_regions(PipelineContext(paths, features="regions"), "Cross-validation") == warned
+    assert ("optimistic" in caplog.text) == warned
+    assert not warn_fitted_regions(PipelineContext(paths), "Cross-validation")  # voxel features
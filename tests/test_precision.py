@@ -0,0 +1,34 @@
+'''
+pipeline/precision.py dtype policy and the float32 vs float64 check.
+'''
+import numpy as np
+import pytest
+from pipeline.precision import set_precision, get_dtype, as_working, check_precision, DEFAULT_PRECISION
+
+
+def test_default_is_float64_and_policy_is_restorable():
+    assert DEFAULT_PRECISION == "float64"
+    previous = set_precision("float32")
+    try:
+        assert get_dtype() == np.float32
+        assert as_working(np.ones(3)).dtype == np.float32
+    finally:
+        set_precision(previous)
+    assert get_dtype() == np.dtype(previous)
+    with pytest.raises(ValueError):
+        set_precision("float16")
+
+
+@pytest.mark.slow
+def test_check_precision_runs_each_precision_in_its_own_process(tmp_path):
+    from bench.synthetic import generate, SCALES
+    paths, = generate(shape=SCALES["tiny"]["shape"], n_timepoints=SCALES["tiny"]["n_timepoints"],
+                      data_dir=str(tmp_path / "job"), raw_dir=str(tmp_path / "raw"))
+    report = check_precision(paths)
+    assert report["X_dtype"] == {"float32": "float32", "float64": "float64"}
+    assert report["X_bytes"]["float32"] * 2 == pytest.approx(report["X_bytes"]["float64"], rel=0.01)
+    assert report["labels_identical"]
+    assert report["X_max_abs_diff"] < 1e-4
+    assert set(report["peak_rss_mb"]["float32"]) == {"extract", "transform", "model", "evaluate"}
+    # The runs happened in other processes, this one keeps its policy
+    assert get_dtype() == np.dtype(DEFAULT_PRECISION)
@@ -0,0 +1,59 @@
+'''
+pipeline/profiling.py section records, nesting and the no-op outside a profiled run.
+'''
+import json
+import os
+import numpy as np
+import pytest
+from pipeline.profiling import Profiler, set_profiler, section, profile_call
+
+
+@pytest.fixture
+def profiler():
+    profiler = Profiler(job="test")
+    previous = set_profiler(profiler)
+    yield profiler
+    set_profiler(previous)
+
+
+def test_nested_sections_and_peak_memory(profiler, tmp_path):
+    with section("stage", stage="model"):
+        with section("fit") as record:
+            block = np.ones(40 * 1024 * 1024 // 8)  # 40 MB
+            record["rows"] = len(block)
+            del block
+    fit, stage = profiler.records  # inner sections finish first
+    assert (fit["name"], fit["parent"], fit["rows"]) == ("fit", "stage", 5242880)
+    assert (stage["parent"], stage["stage"], stage["status"]) == (None, "model", "ok")
+    # The outer section's peak includes what the inner one allocated
+    assert stage["peak_rss_mb"] >= fit["peak_rss_mb"] >= 40
+    assert stage["wall_s"] >= fit["wall_s"] >= 0
+    path = profiler.save(str(tmp_path / "metrics.json"), ok=True)
+    with open(path) as f:
+        saved = json.load(f)
+    assert saved["job"] == "test" and saved["ok"] and [s["name"] for s in saved["sections"]] == ["fit", "stage"]
+
+
+def test_failed_section_is_recorded(profiler):
+    with pytest.raises(KeyError):
+        with section("load"):
+            raise KeyError("X.npy")
+    assert profiler.records[0]["status"] == "failed"
+
+
+def test_section_without_profiler_records_nothing():
+    previous = set_profiler(None)
+    try:
+        with section("fit", rows=3) as record:
+            record["extra"] = 1
+    finally:
+        set_profiler(previous)
+    assert record == {"rows": 3, "extra": 1}
+
+
+def test_profile_call_dumps_stats(tmp_path):
+    prefix = str(tmp_path / "profile_model")
+    assert profile_call(lambda: sum(range(1000)), prefix) == 499500
+    assert os.path.getsize(prefix + ".prof") > 0
+    with open(prefix + ".txt") as f:
+        assert "function calls" in f.read()
@@ -0,0 +1,80 @@
+'''
+analysis/realtime.py OnlineCleaner: each step with running state against the same step over the past volumes,
+and which volumes of a replayed run are scored.
+'''
+import shutil
+import numpy as np
+import pandas as pd
+from scipy import signal as sp_signal
+from pipeline.paths import job_paths
+from pipeline.context import PipelineContext
+from pipeline.matrix import load_split
+from analysis.model import build_model
+from analysis.realtime import OnlineCleaner, replay_job
+
+T_R = 2.0
+
+
+def series(n=60, n_voxels=7, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n)[:, None]
+    return rng.normal(size=(n, n_voxels)) + 0.05 * t + np.sin(t / 3.0)
+
+
+def clean_all(cleaner, X):
+    return np.array([cleaner.update(x) for x in X])
+
+
+def test_filter_state_matches_one_causal_pass():
+    X = series()
+    cleaner = OnlineCleaner(X.shape[1], T_R, detrend=False, standardize=False, high_pass=0.01, low_pass=0.1)
+    expected = sp_signal.sosfilt(cleaner.sos, X, axis=0)
+    assert np.allclose(clean_all(cleaner, X), expected)
+
+
+def test_detrend_uses_the_line_through_past_volumes():
+    X = series()
+    online = clean_all(OnlineCleaner(X.shape[1], T_R, standardize=False), X)
+    for t in (1, 10, 59):
+        slope, intercept = np.polyfit(np.arange(t + 1), X[:t + 1], 1)
+        assert np.allclose(online[t], X[t] - (intercept + slope * t))
+
+
+def test_zscore_uses_the_stats_so_far():
+    X = series()
+    online = clean_all(OnlineCleaner(X.shape[1], T_R, detrend=False), X)
+    assert not online[0].any()  # one volume has no spread
+    for t in (5, 59):
+        past = X[:t + 1]
+        assert np.allclose(online[t], (X[t] - past.mean(axis=0)) / past.std(axis=0))
+
+
+def test_later_volumes_do_not_change_earlier_output():
+    X, Y = series(seed=0), series(seed=0)
+    Y[30:] = series(seed=1)[30:]
+    make = lambda: OnlineCleaner(X.shape[1], T_R, high_pass=0.01, low_pass=0.1)
+    a, b = clean_all(make(), X), clean_all(make(), Y)
+    assert np.allclose(a[:30], b[:30])
+    assert not np.allclose(a[30:], b[30:])
+
+
+def test_low_pass_above_nyquist_is_dropped():
+    assert OnlineCleaner(3, T_R, low_pass=0.3).sos is None
+    assert OnlineCleaner(3, T_R, high_pass=0.01, low_pass=0.3).sos.shape[0] == 3  # order 5 high-pass only
+
+
+def test_own_run_is_only_scored_on_held_out_volumes(processed_job, tmp_path):
+    # A copy of the processed job, so its model stays out of the shared fixture
+    data_dir = str(tmp_path / "job")
+    shutil.copytree(processed_job.data_dir, data_dir)
+    paths = job_paths(processed_job.subject, processed_job.task, processed_job.run, data_dir=data_dir, raw_dir=processed_job.raw_dir)
+    build_model(PipelineContext(paths))
+
+    summary = replay_job(paths, speed=0, warmup=2, out_path=str(tmp_path / "latency.csv"))
+    assert "held_out_accuracy" in summary and "online_accuracy" not in summary
+    latency = pd.read_csv(tmp_path / "latency.csv")
+    assert len(latency) == summary["volumes"]  # every volume still goes through the decoder
+    _, test_idx = load_split(paths.output("split.npz"))
+    test_volumes = PipelineContext(paths).get_rows()[0][test_idx]
+    assert set(latency.loc[latency["held_out"], "volume"]) == set(test_volumes)
+    assert 0 < summary["accuracy_volumes"] <= len(test_idx)
@@ -0,0 +1,64 @@
+'''
+analysis/search.py fold preparation through the stage cache and successive halving.
+'''
+import os
+import shutil
+import numpy as np
+import main
+from pipeline.cache import StageCache
+from pipeline.matrix import save_matrix, open_matrix
+from analysis.search import prepare_folds, successive_halving
+
+
+def make_X(tmp_path):
+    rng = np.random.default_rng(0)
+    y = np.tile(np.repeat(np.array(["a", "b"]), 10), 4)
+    X = rng.normal(size=(len(y), 30)) + (y == "b")[:, None] * np.linspace(0, 3, 30)
+    save_matrix(str(tmp_path / "X.npy"), X.astype(np.float32))
+    return open_matrix(str(tmp_path / "X.npy")), y
+
+
+def test_folds_are_restored_from_the_cache(tmp_path):
+    X, y = make_X(tmp_path)
+    rows, timepoints, runs = np.arange(len(y)), np.arange(len(y)), np.ones(len(y), dtype=int)
+    cache = StageCache(cache_dir=str(tmp_path / "cache"))
+    fold_dir = str(tmp_path / "folds")
+    folds = prepare_folds(X, y, rows, timepoints, runs, "features", fold_dir, n_folds=3, gap=2, cache=cache)
+    first = [open_matrix(f["X_train"]).copy() for f in folds]
+    assert len(cache.entries()) == 1
+
+    # The search removes its working copies, a second search restores them from the cache
+    shutil.rmtree(fold_dir)
+    folds = prepare_folds(X, y, rows, timepoints, runs, "features", fold_dir, n_folds=3, gap=2, cache=cache)
+    assert all(np.array_equal(a, open_matrix(f["X_train"])) for a, f in zip(first, folds))
+    assert len(cache.entries()) == 1
+
+    best, results = successive_halving(folds, [{"max_depth": 1}, {"max_depth": 3}], "features", X.shape[1], factor=2)
+    assert best in ({"max_depth": 1}, {"max_depth": 3})
+    assert set(results["round"]) == {0, 1}
+
+
+def test_forced_model_rebuilds_the_folds(tmp_path):
+    X, y = make_X(tmp_path)
+    rows, runs = np.arange(len(y)), np.ones(len(y), dtype=int)
+    fold_dir = str(tmp_path / "folds")
+    prepare_folds(X, y, rows, rows, runs, "features", fold_dir, n_folds=2, gap=0, cache=StageCache(cache_dir=str(tmp_path / "cache")))
+    shutil.rmtree(fold_dir)
+    forced = StageCache(cache_dir=str(tmp_path / "cache"), force={"model"})
+    restored = []
+    forced.restore = lambda *args: restored.append(args) or True
+    folds = prepare_folds(X, y, rows, rows, runs, "features", fold_dir, n_folds=2, gap=0, cache=forced)
+    assert not restored and all(os.path.exists(f["X_train"]) for f in folds)
+
+
+def test_folds_without_cache_stay_in_fold_dir(tmp_path):
+    X, y = make_X(tmp_path)
+    rows = np.arange(len(y))
+    folds = prepare_folds(X, y, rows, rows, np.ones(len(y), dtype=int), "samples", str(tmp_path / "folds"), n_folds=2, gap=0)
+    assert len(folds) == 2 and all(os.path.exists(f["X_test"]) for f in folds)
+
+
+def test_main_rejects_search_with_reduce(monkeypatch, capsys):
+    monkeypatch.setattr(main, "configure_logging", lambda: None)
+    assert main.main(["--search", "--reduce", "anova", "--n-features", "10"]) == 2
+    assert "--search cannot be combined" in capsys.readouterr().err
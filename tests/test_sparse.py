@@ -0,0 +1,48 @@
+'''
+analysis/sparse.py: the sparse-voxel path gives the same model inputs as the full NiftiMasker preprocessing.
+'''
+import numpy as np
+import pytest
+from nilearn.maskers import NiftiMasker
+from sklearn.tree import DecisionTreeClassifier
+from bench.synthetic import make_events, make_image
+from etl.transform import MASKER_PARAMS
+from analysis.sparse import voxel_spec, used_voxels, SparseVoxelExtractor
+
+
+@pytest.fixture(scope="module")
+def fitted(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    events = make_events(50, rng=rng)
+    img = make_image(events, (14, 14, 10), 50, rng=rng)
+    root = tmp_path_factory.mktemp("sparse")
+    for name in ("scan.nii", "scan.nii.gz"):
+        img.to_filename(str(root / name))
+    masker = NiftiMasker(mask_strategy="epi", **MASKER_PARAMS).fit(img)
+    X = masker.transform(img)
+    y = np.where(X[:, :X.shape[1] // 2].mean(axis=1) > 0, "a", "b")
+    model = DecisionTreeClassifier(max_depth=5, random_state=42).fit(X, y)
+    return masker, model, X, root
+
+
+@pytest.mark.parametrize("name", ["scan.nii", "scan.nii.gz"])
+def test_used_voxels_match_masker_transform(fitted, name):
+    masker, model, X, root = fitted
+    spec = voxel_spec(model, masker)
+    voxels = used_voxels(model)
+    assert np.array_equal(spec["voxels"], voxels) and 0 < len(voxels) <= 31
+    extractor = SparseVoxelExtractor(spec)
+    np.testing.assert_allclose(extractor.transform(str(root / name)), X[:, voxels], rtol=1e-5, atol=1e-5)
+    # Same predictions from the sparse matrix as from the full one
+    assert np.array_equal(model.predict(extractor.transform_sparse(str(root / name))), model.predict(X))
+
+
+def test_every_voxel_including_edges(fitted):
+    # All masked voxels, so the boxes clipped at the image border are covered too
+    masker, model, X, root = fitted
+    spec = voxel_spec(model, masker)
+    mask = np.asarray(masker.mask_img_.dataobj).astype(bool)
+    spec["voxels"] = np.arange(int(mask.sum()))
+    spec["ijk"] = np.argwhere(mask)
+    series = SparseVoxelExtractor(spec).transform(str(root / "scan.nii"))
+    np.testing.assert_allclose(series, X, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,44 @@
+'''
+pipeline/store.py typed label / prediction files and the per-stage manifest.
+'''
+import numpy as np
+import pytest
+from pipeline.paths import job_paths
+from pipeline.store import (encode_labels, save_labels, load_labels, save_predictions, load_predictions, record_stage,
+                            load_manifest)
+
+
+def test_labels_roundtrip(tmp_path):
+    labels = np.array(["b", "a", "rest", "b"], dtype=object)
+    codes, categories = encode_labels(labels)
+    assert codes.dtype == np.int16 and list(categories) == ["a", "b", "rest"]
+    path = save_labels(str(tmp_path / "labels.npz"), codes, categories)
+    codes, categories = load_labels(path)
+    assert list(categories[codes]) == list(labels)
+    with pytest.raises(ValueError, match="category table"):
+        encode_labels(["c"], categories)
+
+
+def test_predictions_share_one_category_table(tmp_path):
+    # A class that is only predicted (or only true) still gets a code
+    path = save_predictions(str(tmp_path / "predictions.npz"), ["a", "b"], ["c", "b"], rows=[7, 3], fold=np.array([0, 1]))
+    data = load_predictions(path)
+    assert list(data["y_true"]) == ["a", "b"] and list(data["y_pred"]) == ["c", "b"]
+    assert list(data["rows"]) == [7, 3] and list(data["fold"]) == [0, 1]
+    assert list(data["categories"]) == ["a", "b", "c"]
+
+
+def test_manifest_keeps_other_stages(tmp_path):
+    paths = job_paths(data_dir=str(tmp_path / "job"))
+    artifact = str(tmp_path / "X.npy")
+    np.save(artifact, np.zeros((4, 3), dtype=np.float32))
+    record_stage(paths, "transform", [artifact, str(tmp_path / "missing.npy")], params={"t_r": np.float64(2.0)})
+    record_stage(paths, "model", params={"max_depth": 5})
+    record_stage(paths, "model", params={"max_depth": 3})
+    manifest = load_manifest(paths)
+    assert set(manifest["stages"]) == {"transform", "model"}
+    assert manifest["stages"]["model"]["params"] == {"max_depth": 3}
+    transform = manifest["stages"]["transform"]
+    assert transform["params"] == {"t_r": 2.0}
+    assert transform["artifacts"] == {"X.npy": {"file": "X.npy", "bytes": 176, "shape": [4, 3], "dtype": "float32"}}
+    assert "libraries" in manifest["provenance"]
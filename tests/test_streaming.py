@@ -0,0 +1,48 @@
+'''
+etl/streaming.py chunked preprocessing against nilearn's NiftiMasker on a small synthetic image.
+'''
+import numpy as np
+import nibabel as nib
+import pytest
+from nilearn.maskers import NiftiMasker
+from nilearn import masking
+from bench.synthetic import make_events, make_image
+from etl.transform import MASKER_PARAMS
+from etl.streaming import stream_transform, stream_inverse_transform, streamed_epi_mask
+
+
+@pytest.fixture(scope="module")
+def image():
+    n_timepoints = 60
+    rng = np.random.default_rng(0)
+    events = make_events(n_timepoints, rng=rng)
+    return make_image(events, (14, 14, 10), n_timepoints, rng=rng)
+
+
+@pytest.mark.parametrize("chunk_volumes, chunk_voxels", [(7, 100), (64, 100000)])
+def test_stream_transform_matches_nifti_masker(image, tmp_path, chunk_volumes, chunk_voxels):
+    mask_img = masking.compute_epi_mask(image)
+    expected = NiftiMasker(mask_img=mask_img, **MASKER_PARAMS).fit_transform(image)
+    X = stream_transform(image, mask_img, MASKER_PARAMS, str(tmp_path / "X.npy"),
+                         chunk_volumes=chunk_volumes, chunk_voxels=chunk_voxels)
+    assert X.shape == expected.shape
+    np.testing.assert_allclose(X, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_streamed_mask_matches_epi_mask(image):
+    assert np.array_equal(streamed_epi_mask(image, chunk_volumes=9).get_fdata(), masking.compute_epi_mask(image).get_fdata())
+
+
+@pytest.mark.parametrize("name, compresslevel", [("out.nii", None), ("out.nii.gz", 1)])
+def test_stream_inverse_transform_matches_unmask(image, tmp_path, name, compresslevel):
+    mask_img = masking.compute_epi_mask(image)
+    X = np.random.default_rng(1).normal(size=(image.shape[3], int(mask_img.get_fdata().sum()))).astype(np.float32)
+    path = str(tmp_path / name)
+    stream_inverse_transform(X, mask_img, path, chunk_volumes=7, compresslevel=compresslevel)
+    # The hand-written header (vox_offset 352, no extensions) has to be a valid NIfTI-1 file for nibabel
+    written = nib.load(path)
+    assert written.dataobj.offset == 352
+    expected = masking.unmask(X, mask_img)
+    assert written.shape == expected.shape
+    np.testing.assert_allclose(written.affine, expected.affine)
+    np.testing.assert_array_equal(written.get_fdata(dtype=np.float32), expected.get_fdata(dtype=np.float32))
@@ -0,0 +1,47 @@
+'''
+vis/visualizations.py figures as parallel tasks, skipped when their inputs are unchanged.
+'''
+import os
+import json
+import shutil
+import pytest
+from pipeline.paths import job_paths
+from pipeline.context import PipelineContext
+from pipeline.cache import StageCache
+from pipeline.store import PREDICTIONS_FILE, load_predictions, save_predictions
+from analysis.model import build_model
+from analysis.evaluate import evaluate_model
+from vis.visualizations import create_visualizations, FIGURES
+
+
+@pytest.mark.slow
+def test_only_changed_figures_are_rendered_again(processed_job, tmp_path, monkeypatch):
+    monkeypatch.setenv("MPLBACKEND", "Agg")
+    monkeypatch.chdir(tmp_path)  # nothing may go to the default data/cache of the working directory
+    # A copy of the processed job, so its model and figures stay out of the shared fixture
+    data_dir = str(tmp_path / "job")
+    shutil.copytree(processed_job.data_dir, data_dir)
+    paths = job_paths(processed_job.subject, processed_job.task, processed_job.run, data_dir=data_dir, raw_dir=processed_job.raw_dir)
+    build_model(PipelineContext(paths))
+    evaluate_model(PipelineContext(paths))
+
+    cache = StageCache(str(tmp_path / "cache"))  # figure fingerprints need the run's cache
+    create_visualizations(PipelineContext(paths, cache=cache), workers=2)
+    pngs = {name: paths.output(f"{name}.png") for name in FIGURES}
+    assert all(os.path.getsize(png) > 0 for png in pngs.values())
+    with open(paths.output("figures.json")) as f:
+        assert set(json.load(f)) == set(FIGURES)
+    mtimes = {name: os.stat(png).st_mtime_ns for name, png in pngs.items()}
+
+    # New predictions: only the confusion matrix reads them
+    predictions = load_predictions(paths.output(PREDICTIONS_FILE))
+    save_predictions(paths.output(PREDICTIONS_FILE), predictions["y_true"], predictions["y_true"][::-1], rows=predictions["rows"])
+    create_visualizations(PipelineContext(paths, cache=cache), workers=2)
+    changed = {name for name, png in pngs.items() if os.stat(png).st_mtime_ns != mtimes[name]}
+    assert changed == {"confusion_matrix"}
+
+    # Without a cache (--no-cache) nothing is fingerprinted and every figure is rendered
+    mtimes = {name: os.stat(png).st_mtime_ns for name, png in pngs.items()}
+    create_visualizations(PipelineContext(paths), workers=2)
+    assert all(os.stat(png).st_mtime_ns != mtimes[name] for name, png in pngs.items())
+    assert not os.path.exists(os.path.join("data", "cache"))
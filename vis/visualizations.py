@@ -12,106 +12,247 @@ To visualize transform outputs:
 To visuliaze brain signal segregation:
     - Brain map visualization 
 
+Rendering:
+    - Every figure is an independent task, tasks run in a process pool with the non-interactive Agg backend
+    - A figure is skipped when its input files and this code are unchanged (fingerprints in outputs/figures.json),
+      unless the run has no stage cache (--no-cache)
+    - Tasks get small precomputed summaries instead of the full artifacts: the mean signal over time,
+      the fitted tree with only the names of the voxels it splits on, and the 3D mean map from transform
+      (mean_bold_map.nii.gz) instead of the preprocessed 4D NIfTI
+    - Figures are written to a temporary file and renamed into place (they may be hard links into the stage cache)
+    - Every figure is a profiling section (figure:<name>), measured inside the worker that rendered it
+
 Run main.py to execute this script.
 """
 #Load necessary libraries
 import os
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 import seaborn as sns
-import logging
 from sklearn.tree import plot_tree
-import joblib
-from nilearn import image, plotting
+import nibabel as nib
+from nilearn import plotting
+from pipeline.paths import MATRIX_FILES
+from pipeline.context import PipelineContext
+from pipeline.matrix import column_mean
+from pipeline.precision import as_working
+from pipeline.profiling import Profiler, get_profiler, section
+from analysis.features import final_estimator, used_feature_names
+
+FIGURES = ("mean_signal_over_time", "decision_tree_plot", "confusion_matrix", "mean_bold_per_voxel", "mean_bold_brain_map")
 
-def create_visualizations():
-    """
-    Create visualizations for fMRI data and model evaluation.
-    - Normalized Confusion Matrix
-    - Mean signal over time plot
-    - Decision Tree visualization
-    - Bar plot of mean signal per trial type
-    - Brain map visualization
-    """
-    # Load time series (already saved as numpy array in data/processed)
-    X = np.load('data/processed/sub-01_task-Classificationprobewithoutfeedback_X.npy')  # filtered voxel_vs_time
-    y = pd.read_csv("data/processed/sub-01_task-Classificationprobewithoutfeedback_y.csv") #Trial labels as CSV (for visualization)
 
-    # Plot average signal over time (linear model)
-    mean_signal_over_time = X.mean(axis=0)  # mean across voxels for each timepoint
+def _save_figure(out_path, fig=None):
+    # Write next to the target and rename, so a hard-linked copy in the stage cache is never overwritten
+    tmp_path = out_path + ".tmp.png"
+    (fig or plt).savefig(tmp_path)
+    os.replace(tmp_path, out_path)
+
+#------------------------------------Figure tasks (run in worker processes)--------------------------------------
+
+def plot_mean_signal(mean_signal_over_time, out_path):
     plt.figure(figsize=(12,6))
     plt.plot(mean_signal_over_time)
     plt.title("Mean fMRI Signal Over Time")
     plt.xlabel("Timepoint") #Each timepoint is equal to the RepetitionTime, so each timepoint is 2.0 seconds for 'Classification probe without feedback'
     plt.ylabel("Mean Signal") #This is z-score normailized, so 0 is the mean and values are staggered by 1 standard deviation from the mean
-    plt.savefig("data/outputs/mean_signal_over_time.png")
+    _save_figure(out_path)
     plt.close()
     logging.info("Saved mean signal over time plot.")
 
-    # Load and display evaluation metrics
-    metrics_path = "data/outputs/evaluation_metrics.csv"
-    if os.path.exists(metrics_path):
-        metrics = pd.read_csv(metrics_path)
-        print(f"Evaluation Metrics: {metrics}")
-    else:
-        logging.warning(f"Metrics file not found at {metrics_path}")
-
-    #Making Decision Tree model as visualization, load voxel_vs_time and labels as X and Y
-    #Trained Decision Tree for the main model: 
-    clf = joblib.load("data/outputs/decision_tree_model.joblib")
 
+def plot_decision_tree(tree, feature_names, class_names, out_path):
     #Visualize Decision tree model using plot_tree()
     plt.figure(figsize=(15, 10))
-    plot_tree(clf, filled=True, feature_names=[f"v{i}" for i in range(X.shape[1])], class_names=list(y["label"].unique()))
+    plot_tree(tree, filled=True, feature_names=feature_names, class_names=class_names)
     plt.title("Decision Tree Classifier")
-    plt.savefig("data/outputs/decision_tree_plot.png")
+    _save_figure(out_path)
     plt.close()
     logging.info("Saved Decision Tree plot")
 
-    #-----------------------------Confusion Matrix, Tidy CSV plot, and brain map visualization-----------------------------:
 
+def plot_confusion_matrix(y_true, y_pred, out_path):
     #Confusion matrix to visualize how well the model fits
-    preds_df_path = "data/outputs/test_predictions.csv"
-    if os.path.exists(preds_df_path):
-        preds_df = pd.read_csv(preds_df_path)
-        y_true = preds_df["y_true"]
-        y_pred = preds_df["y_pred"]
-        cm = pd.crosstab(y_true, y_pred, rownames=['Actual'], colnames=['Predicted'], normalize='index')
-        
-        plt.figure(figsize=(8, 6))
-        sns.heatmap(cm, annot=True, fmt=".2f", cmap="Blues")
-        plt.title("Confusion Matrix (Normalized)")
-        plt.savefig("data/outputs/confusion_matrix.png")
-        plt.close()
-        logging.info("Saved confusion matrix heatmap.")
-    else:
-        logging.warning(f"Test predictions file not found at {preds_df_path}")
+    cm = pd.crosstab(pd.Series(y_true), pd.Series(y_pred), rownames=['Actual'], colnames=['Predicted'], normalize='index')
+    plt.figure(figsize=(8, 6))
+    sns.heatmap(cm, annot=True, fmt=".2f", cmap="Blues")
+    plt.title("Confusion Matrix (Normalized)")
+    _save_figure(out_path)
+    plt.close()
+    logging.info("Saved confusion matrix heatmap.")
+
 
+def plot_trial_means(tidy_trial_df, out_path):
     #Tidy CSV to plot barplot of trial_type and mean signal for each (from aggregated csv from transform.py)
-    tidy_trial_csv = 'data/processed/sub-01_task-Classificationprobewithoutfeedback_mean_bold_per_trial.csv'  # From transform.py
-    if os.path.exists(tidy_trial_csv):
-        tidy_trial_df = pd.read_csv(tidy_trial_csv)
-        plt.figure(figsize=(10, 6))
-        sns.barplot(x='trial_type', y='mean_bold', data=tidy_trial_df)
-        plt.title("Mean BOLD signal per Trial")
-        plt.xlabel("Trial Type")
-        plt.ylabel("Mean BOLD signal")
-        plt.xticks(rotation=45, ha="right")  # rotate labels 45° and align right
-        plt.tight_layout() #spacing automatically adjusts
-        plt.savefig("data/outputs/mean_bold_per_voxel.png")
-        plt.close()
-        logging.info("Saved tidy CSV plot for mean BOLD signals.")
-    else: 
-        logging.warning(f"Trial-type CSV not found at {tidy_trial_csv}")
-
-    #Brain map visualization using plot_stat_map:
-    preprocessed_img_path = 'data/processed/sub-01_task-Classificationprobewithoutfeedback_preprocessed.nii.gz'
-    if os.path.exists(preprocessed_img_path):
-        mean_img = image.mean_img(preprocessed_img_path)
-        plotting.plot_stat_map(mean_img, title="Mean BOLD Activity", output_file="data/outputs/mean_bold_brain_map.png")
-        plt.close()
-        logging.info("Saved brain map visualization.")
+    plt.figure(figsize=(10, 6))
+    sns.barplot(x='trial_type', y='mean_bold', data=tidy_trial_df)
+    plt.title("Mean BOLD signal per Trial")
+    plt.xlabel("Trial Type")
+    plt.ylabel("Mean BOLD signal")
+    plt.xticks(rotation=45, ha="right")  # rotate labels 45° and align right
+    plt.tight_layout() #spacing automatically adjusts
+    _save_figure(out_path)
+    plt.close()
+    logging.info("Saved tidy CSV plot for mean BOLD signals.")
+
+
+def plot_brain_map(mean_map_path, out_path):
+    #Brain map visualization using plot_stat_map (3D mean map, not the 4D preprocessed image)
+    display = plotting.plot_stat_map(mean_map_path, title="Mean BOLD Activity")
+    _save_figure(out_path, display)
+    display.close()
+    plt.close()
+    logging.info("Saved brain map visualization.")
+
+
+def _init_worker():
+    # Non-interactive backend in the worker processes
+    os.environ["MPLBACKEND"] = "Agg"
+    matplotlib.use("Agg")
+
+
+def _render(name, func, args):
+    # Profiled in the worker (time, CPU and memory of the worker), the record is merged into the parent's profiler
+    profiler = Profiler()
+    with profiler.section(f"figure:{name}"):
+        func(*args)
+    return profiler.records[0]
+
+#------------------------------------Summaries for the figure tasks--------------------------------------
+
+def mean_map(paths):
+    """
+    3D mean map of the preprocessed signal, written by transform.py from the 2D matrix (mean_bold_map.nii.gz).
+    Outputs from before the mean map existed fall back to a mean over the exported 4D image, computed slab by slab.
+    Returns the path, None if there is neither.
+    """
+    map_path = paths.processed("mean_bold_map.nii.gz")
+    preprocessed_img_path = paths.processed("preprocessed.nii.gz")
+    if not os.path.exists(map_path) and os.path.exists(preprocessed_img_path):
+        from etl.streaming import streamed_mean_img
+        streamed_mean_img(nib.load(preprocessed_img_path)).to_filename(map_path)
+        logging.info(f"Mean brain map computed from {preprocessed_img_path}: {map_path}")
+    return map_path if os.path.exists(map_path) else None
+
+
+def figure_inputs(paths, features="voxels"):
+    """
+    Input files of every figure, used to skip figures whose inputs did not change.
+    """
+    return {
+        "mean_signal_over_time": [paths.processed(MATRIX_FILES[features])],
+        "decision_tree_plot": [paths.output("decision_tree_model.joblib"), paths.processed("labels.npz")],
+        "confusion_matrix": [paths.output("predictions.npz")],
+        "mean_bold_per_voxel": [paths.processed("mean_bold_per_trial.csv")],
+        "mean_bold_brain_map": [paths.processed("mean_bold_map.nii.gz")],
+    }
+
+
+def _figure_task(name, ctx):
+    """
+    (function, arguments) of one figure with its precomputed summary, None if its inputs are missing.
+    """
+    paths = ctx.paths
+    out_path = paths.output(f"{name}.png")
+    if name == "mean_signal_over_time":
+        # Plot average signal over time (linear model)
+        return plot_mean_signal, (as_working(column_mean(ctx.get_X())), out_path)  # same as X.mean(axis=0), over row chunks of the memory-mapped X
+    if name == "decision_tree_plot":
+        #Trained Decision Tree for the main model, only the names of the voxels (or regions) it splits on are passed along
+        clf = ctx.get_model()
+        if not hasattr(final_estimator(clf), "tree_"):
+            logging.info(f"Skipped {name}.png, the model is not a decision tree ({type(final_estimator(clf)).__name__})")
+            return None
+        return plot_decision_tree, (final_estimator(clf), used_feature_names(clf, ctx.get_X().shape[1], prefix="r" if ctx.features == "regions" else "v"),
+                                    list(pd.unique(ctx.get_y())), out_path)
+    if name == "confusion_matrix":
+        preds = ctx.get_predictions()
+        if preds is None:
+            logging.warning(f"Test predictions file not found at {paths.output('predictions.npz')}")
+            return None
+        return plot_confusion_matrix, (preds[0], preds[1], out_path)
+    if name == "mean_bold_per_voxel":
+        tidy_trial_csv = paths.processed("mean_bold_per_trial.csv")  # From transform.py
+        if not os.path.exists(tidy_trial_csv):
+            logging.warning(f"Trial-type CSV not found at {tidy_trial_csv}")
+            return None
+        return plot_trial_means, (pd.read_csv(tidy_trial_csv), out_path)
+    if name == "mean_bold_brain_map":
+        map_path = mean_map(paths)
+        if map_path is None:
+            logging.warning(f"Mean brain map not found at {paths.processed('mean_bold_map.nii.gz')}")
+            return None
+        return plot_brain_map, (map_path, out_path)
+    raise ValueError(f"Unknown figure '{name}', expected one of {FIGURES}")
+
+
+def create_visualizations(ctx=None, workers=None, force=False):
+    """
+    Create visualizations for fMRI data and model evaluation.
+    - Normalized Confusion Matrix
+    - Mean signal over time plot
+    - Decision Tree visualization
+    - Bar plot of mean signal per trial type
+    - Brain map visualization
+    Arrays, labels and the model come from the pipeline context (loaded from disk only when not in memory).
+    Figures with unchanged inputs are skipped (force=True renders all), the others are rendered by `workers` processes.
+    """
+    if ctx is None:
+        ctx = PipelineContext()
+    paths = ctx.paths
+    workers = workers or os.cpu_count() or 1
+
+    # Load and display evaluation metrics
+    metrics_path = paths.output("evaluation_metrics.csv")
+    if os.path.exists(metrics_path):
+        metrics = pd.read_csv(metrics_path)
+        print(f"Evaluation Metrics: {metrics}")
+    else:
+        logging.warning(f"Metrics file not found at {metrics_path}")
+
+    # Fingerprint of every figure's input files and of this code, hashed through the run's stage cache.
+    # Without a cache (--no-cache, --no-persist: the inputs may live in memory only) every figure is rendered.
+    manifest_path = paths.output("figures.json")
+    try:
+        with open(manifest_path) as f:
+            rendered = json.load(f)
+    except (OSError, ValueError):
+        rendered = {}
+    cache = ctx.cache
+    fingerprints = {}
+    tasks = []
+    for name, inputs in figure_inputs(paths, ctx.features).items():
+        if cache is not None:
+            fingerprints[name] = cache.fingerprint(f"figure:{name}", inputs, code=[__file__], root=paths.data_dir)
+            if not force and rendered.get(name) == fingerprints[name] and os.path.exists(paths.output(f"{name}.png")):
+                logging.info(f"Skipped {name}.png, inputs unchanged")
+                continue
+        task = _figure_task(name, ctx)
+        if task is not None:
+            tasks.append((name, task))
+
+    if len(tasks) > 1 and workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_init_worker) as pool:
+            futures = [(name, pool.submit(_render, name, *task)) for name, task in tasks]
+            for name, future in futures:
+                record = future.result()
+                if get_profiler() is not None:
+                    get_profiler().add(record)
     else:
-        logging.warning(f"Preprocessed NIfTI not found at {preprocessed_img_path}")
+        for name, (func, args) in tasks:
+            with section(f"figure:{name}"):
+                func(*args)
 
+    # Remember what the rendered figures were made from
+    for name, _ in tasks:
+        if name in fingerprints:
+            rendered[name] = fingerprints[name]
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(rendered, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    logging.info(f"Rendered {len(tasks)} of {len(FIGURES)} figures")